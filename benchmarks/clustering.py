@@ -0,0 +1,165 @@
+"""
+Benchmark of the clustering of embeddings at ingest.
+
+This script:
+1. Writes random embeddings around a few centers to a memory-mapped file
+2. Clusters them with K-Means (`cluster_embeddings`) and mini-batch K-Means
+   (`cluster_embeddings_minibatch`), streaming or trained on a sample
+3. Reports the wall time, the peak memory allocated and the mean squared distance of the
+   embeddings to their centroid
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from nilrag.utils.process import (DEFAULT_CLUSTER_BATCH_SIZE,
+                                  cluster_embeddings,
+                                  cluster_embeddings_minibatch)
+from nilrag.utils.transform import from_fixed_point
+
+DEFAULT_NUM_EMBEDDINGS = 100_000
+DEFAULT_DIMENSION = 384
+DEFAULT_NUM_CLUSTERS = 64
+METHODS = ["kmeans", "minibatch", "minibatch-sample"]
+
+
+def write_embeddings(
+    path: str, num_embeddings: int, dimension: int, num_clusters: int
+) -> np.ndarray:
+    """
+    Write random float32 embeddings around `num_clusters` centers to `path`.
+
+    Returns:
+        np.ndarray: The embeddings, memory-mapped read-only
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(num_clusters, dimension)).astype(np.float32)
+    embeddings = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(num_embeddings, dimension)
+    )
+    for start in range(0, num_embeddings, DEFAULT_CLUSTER_BATCH_SIZE):
+        stop = min(start + DEFAULT_CLUSTER_BATCH_SIZE, num_embeddings)
+        embeddings[start:stop] = centers[
+            rng.integers(0, num_clusters, stop - start)
+        ] + 0.3 * rng.normal(size=(stop - start, dimension))
+    embeddings.flush()
+    del embeddings
+    return np.load(path, mmap_mode="r")
+
+
+def mean_squared_distance(
+    embeddings: np.ndarray, labels: np.ndarray, centroids: list
+) -> float:
+    """Mean squared distance of the embeddings to the centroid of their cluster."""
+    centroids = from_fixed_point(np.asarray(centroids, dtype=np.float64))
+    total = 0.0
+    for start in range(0, len(embeddings), DEFAULT_CLUSTER_BATCH_SIZE):
+        stop = start + DEFAULT_CLUSTER_BATCH_SIZE
+        differences = embeddings[start:stop] - centroids[labels[start:stop]]
+        total += float(np.einsum("ij,ij->", differences, differences))
+    return total / len(embeddings)
+
+
+def cluster(method: str, embeddings: np.ndarray, num_clusters: int, sample_size: int):
+    """Cluster the embeddings with `method` and return (labels, centroids)."""
+    if method == "kmeans":
+        return cluster_embeddings(embeddings, num_clusters)
+    if method == "minibatch":
+        return cluster_embeddings_minibatch(embeddings, num_clusters)
+    return cluster_embeddings_minibatch(
+        embeddings, num_clusters, sample_size=sample_size
+    )
+
+
+def run_method(
+    method: str, embeddings: np.ndarray, num_clusters: int, sample_size: int
+) -> tuple:
+    """
+    Cluster the embeddings with `method`, once timed and once with memory tracing
+    (which slows down allocations).
+
+    Returns:
+        tuple: (labels, centroids, wall time in seconds, peak memory allocated in MB)
+    """
+    start_time = time.perf_counter()
+    labels, centroids = cluster(method, embeddings, num_clusters, sample_size)
+    seconds = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    cluster(method, embeddings, num_clusters, sample_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return labels, centroids, seconds, peak / 2**20
+
+
+def main():
+    """
+    Compare K-Means and mini-batch K-Means on wall time, memory and cluster quality.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the clustering at ingest")
+    parser.add_argument(
+        "-n",
+        "--num-embeddings",
+        type=int,
+        default=DEFAULT_NUM_EMBEDDINGS,
+        help=f"Number of embeddings (default: {DEFAULT_NUM_EMBEDDINGS})",
+    )
+    parser.add_argument(
+        "--dimension",
+        type=int,
+        default=DEFAULT_DIMENSION,
+        help=f"Dimension of the embeddings (default: {DEFAULT_DIMENSION})",
+    )
+    parser.add_argument(
+        "--num-clusters",
+        type=int,
+        default=DEFAULT_NUM_CLUSTERS,
+        help=f"Number of clusters (default: {DEFAULT_NUM_CLUSTERS})",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=None,
+        help="Number of embeddings minibatch-sample trains on "
+        "(default: a tenth of the embeddings)",
+    )
+    parser.add_argument(
+        "--methods",
+        nargs="+",
+        choices=METHODS,
+        default=METHODS,
+        help=f"Methods to compare (default: {' '.join(METHODS)})",
+    )
+    args = parser.parse_args()
+    sample_size = args.sample_size or max(args.num_embeddings // 10, args.num_clusters)
+
+    with tempfile.TemporaryDirectory() as directory:
+        embeddings = write_embeddings(
+            os.path.join(directory, "embeddings.npy"),
+            args.num_embeddings,
+            args.dimension,
+            args.num_clusters,
+        )
+        print(
+            f"{args.num_embeddings} embeddings of dimension {args.dimension} "
+            f"({embeddings.nbytes / 2**20:.0f} MB), {args.num_clusters} clusters"
+        )
+        for method in args.methods:
+            labels, centroids, seconds, peak_mb = run_method(
+                method, embeddings, args.num_clusters, sample_size
+            )
+            print(
+                f"{method:>16}: {seconds:.2f}s, peak memory {peak_mb:.0f} MB, "
+                "mean squared distance "
+                f"{mean_squared_distance(embeddings, labels, centroids):.4f}"
+            )
+        del embeddings
+
+
+if __name__ == "__main__":
+    main()
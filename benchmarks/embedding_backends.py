@@ -0,0 +1,130 @@
+"""
+Benchmark of the embedding backends used to encode queries.
+
+This script:
+1. Loads the embedding model with each backend in a fresh process
+2. Measures the per-query encode latency and the peak memory of the process
+3. Compares the embeddings with the PyTorch ones (cosine similarity)
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from nilrag.utils.embedding_backends import DEFAULT_BACKEND
+from nilrag.utils.model_registry import DEFAULT_MODEL_NAME
+from nilrag.utils.process import generate_embeddings_huggingface
+
+DEFAULT_BACKENDS = ["torch", "onnx", "onnx-int8"]
+DEFAULT_NUM_QUERIES = 100
+QUERIES = [
+    "Who is Michelle Ross?",
+    "What is the capital of Japan?",
+    "How does climate change affect sea levels?",
+    "Explain the difference between a process and a thread.",
+]
+
+
+def run_backend(backend: str, num_queries: int) -> dict:
+    """
+    Encode queries one at a time with `backend` and return the measurements.
+
+    Returns:
+        dict: Load time, encode latencies, peak memory and the embeddings of QUERIES.
+    """
+    start_time = time.perf_counter()
+    embeddings = generate_embeddings_huggingface(QUERIES, backend=backend)
+    load_seconds = time.perf_counter() - start_time
+
+    latencies = []
+    for i in range(num_queries):
+        start_time = time.perf_counter()
+        generate_embeddings_huggingface(QUERIES[i % len(QUERIES)], backend=backend)
+        latencies.append(time.perf_counter() - start_time)
+    return {
+        "load_seconds": load_seconds,
+        "latencies": latencies,
+        # Kilobytes on Linux
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "embeddings": np.asarray(embeddings).tolist(),
+    }
+
+
+def cosine_similarities(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Row-wise cosine similarity of two embedding matrices."""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return np.sum(a * b, axis=1) / (
+        np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    )
+
+
+def main():
+    """
+    Compare the embedding backends on per-query encode latency and memory.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the embedding backends")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=DEFAULT_BACKENDS,
+        help=f"Backends to compare (default: {' '.join(DEFAULT_BACKENDS)})",
+    )
+    parser.add_argument(
+        "-n",
+        "--num-queries",
+        type=int,
+        default=DEFAULT_NUM_QUERIES,
+        help=f"Number of queries encoded one at a time (default: {DEFAULT_NUM_QUERIES})",
+    )
+    parser.add_argument("--worker", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # Child process: measure one backend and report as JSON
+        print(json.dumps(run_backend(args.worker, args.num_queries)))
+        return
+
+    results = {}
+    for backend in args.backends:
+        # One process per backend, so that peak memory is not shared between them
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--worker",
+                backend,
+                "--num-queries",
+                str(args.num_queries),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[backend] = json.loads(output.splitlines()[-1])
+
+    print(f"Model: {DEFAULT_MODEL_NAME}")
+    reference = results.get(DEFAULT_BACKEND)
+    for backend, result in results.items():
+        latencies = np.array(result["latencies"]) * 1000
+        line = (
+            f"{backend:>10}: load {result['load_seconds']:.2f}s, "
+            f"encode p50 {np.percentile(latencies, 50):.2f}ms "
+            f"p95 {np.percentile(latencies, 95):.2f}ms, "
+            f"peak memory {result['peak_memory_mb']:.0f} MB"
+        )
+        if reference is not None and backend != DEFAULT_BACKEND:
+            similarity = cosine_similarities(
+                result["embeddings"], reference["embeddings"]
+            )
+            line += f", min cosine vs {DEFAULT_BACKEND} {similarity.min():.4f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
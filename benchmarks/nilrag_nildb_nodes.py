@@ -11,11 +11,14 @@ import time
 from dotenv import load_dotenv
 
 from nilrag.nildb.org_config import ORG_CONFIG
-from nilrag.rag_vault import RAGVault
+from nilrag.rag_vault import AdaptiveProbing, RAGVault
+from nilrag.utils.embedding_backends import DEFAULT_BACKEND, EMBEDDING_BACKENDS
 
 DEFAULT_PROMPT = "Who is Michelle Ross?"
 DEFAULT_NUM_CHUNKS = 2
 DEFAULT_NUM_CLUSTERS = 1
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_CONCURRENCY = 1
 ENABLE_BENCHMARKS = True
 
 
@@ -50,6 +53,61 @@ async def main():
         default=DEFAULT_NUM_CLUSTERS,
         help=f"Number of clusters to search through (default: {DEFAULT_NUM_CLUSTERS})",
     )
+    parser.add_argument(
+        "--num-coarse-clusters",
+        type=int,
+        default=1,
+        help="Number of coarse clusters to select the clusters from, with a two-level "
+        "index (default: 1)",
+    )
+    parser.add_argument(
+        "--adaptive-probing",
+        action="store_true",
+        help="Pick the number of clusters to search through per query, "
+        "instead of --num-clusters",
+    )
+    parser.add_argument(
+        "--max-distance-ratio",
+        type=float,
+        default=AdaptiveProbing.max_distance_ratio,
+        help="Only probe clusters at most this many times as far as the closest one "
+        f"(default: {AdaptiveProbing.max_distance_ratio})",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of copies of the prompt to retrieve in one batched call "
+        f"(default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "-e",
+        "--embedding-backend",
+        choices=sorted(EMBEDDING_BACKENDS),
+        default=DEFAULT_BACKEND,
+        help=f"Runtime of the embedding model (default: {DEFAULT_BACKEND})",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of copies of the prompt retrieved concurrently on one vault "
+        f"(default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--cpu-pool",
+        choices=["thread", "process"],
+        default="thread",
+        help="Worker pool of the CPU-bound query stages (default: thread)",
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        default=None,
+        help="Size of the worker pool, 0 to run on the event loop "
+        "(default: number of CPUs)",
+    )
     args = parser.parse_args()
 
     # Load environment variables
@@ -58,6 +116,7 @@ async def main():
     schema_id = os.getenv("SCHEMA_ID")
     clusters_schema_id = os.getenv("CLUSTERS_SCHEMA_ID")
     subtract_query_id = os.getenv("QUERY_ID")
+    batch_subtract_query_id = os.getenv("BATCH_QUERY_ID")
 
     # Initialize vault
     rag = await RAGVault.create(
@@ -66,16 +125,57 @@ async def main():
         schema_id=schema_id,
         clusters_schema_id=clusters_schema_id,
         subtract_query_id=subtract_query_id,
+        batch_subtract_query_id=batch_subtract_query_id,
+        embedding_backend=args.embedding_backend,
+        cpu_pool=args.cpu_pool,
+        cpu_workers=args.cpu_workers,
+        num_coarse_clusters=args.num_coarse_clusters,
+    )
+
+    probing = (
+        AdaptiveProbing(max_distance_ratio=args.max_distance_ratio)
+        if args.adaptive_probing
+        else None
     )
 
     print("Perform nilRAG...")
     start_time = time.time()
-    top_chunks = await rag.top_num_chunks_execute(
-        args.prompt, args.num_chunks, ENABLE_BENCHMARKS, args.num_clusters
-    )
+    if args.batch_size > 1:
+        top_chunks = await rag.top_num_chunks_execute_batch(
+            [args.prompt] * args.batch_size,
+            args.num_chunks,
+            ENABLE_BENCHMARKS,
+            args.num_clusters,
+            probing=probing,
+        )
+    elif args.concurrency > 1:
+        top_chunks = await asyncio.gather(
+            *(
+                rag.top_num_chunks_execute(
+                    args.prompt,
+                    args.num_chunks,
+                    ENABLE_BENCHMARKS,
+                    args.num_clusters,
+                    probing=probing,
+                )
+                for _ in range(args.concurrency)
+            )
+        )
+    else:
+        top_chunks = await rag.top_num_chunks_execute(
+            args.prompt,
+            args.num_chunks,
+            ENABLE_BENCHMARKS,
+            args.num_clusters,
+            probing=probing,
+        )
     end_time = time.time()
     print(json.dumps(top_chunks, indent=4))
     print(f"Query took {end_time - start_time:.2f} seconds")
+    num_queries = max(args.batch_size, args.concurrency)
+    if num_queries > 1:
+        print(f"Throughput: {num_queries / (end_time - start_time):.2f} queries/sec")
+    await rag.aclose()
 
 
 if __name__ == "__main__":
@@ -13,7 +13,7 @@ from dotenv import load_dotenv
 from faker import Faker
 
 from nilrag.nildb.org_config import ORG_CONFIG
-from nilrag.rag_vault import RAGVault
+from nilrag.rag_vault import AdaptiveProbing, RAGVault
 from nilrag.utils.process import generate_embeddings_huggingface
 
 DEFAULT_NUM_CHUNKS = 10
@@ -71,6 +71,12 @@ async def main():
         default=DEFAULT_NUM_CLUSTERS,
         help=f"Number of clusters to search through (default: {DEFAULT_NUM_CLUSTERS})",
     )
+    parser.add_argument(
+        "--adaptive-probing",
+        action="store_true",
+        help="Pick the number of clusters to search through per query, "
+        "instead of --num-clusters",
+    )
     parser.add_argument(
         "-q",
         "--num-queries",
@@ -114,7 +120,11 @@ async def main():
         print(json.dumps(top_chunks, indent=4))
         start_times.append(time.time())
         selected_chunks = await rag.top_num_chunks_execute(
-            prompt, args.num_chunks, ENABLE_BENCHMARKS, args.num_clusters
+            prompt,
+            args.num_chunks,
+            ENABLE_BENCHMARKS,
+            args.num_clusters,
+            probing=AdaptiveProbing() if args.adaptive_probing else None,
         )
         end_times.append(time.time())
         print(json.dumps(selected_chunks, indent=4))
@@ -126,6 +136,7 @@ async def main():
     )
     print(f"Precision {np.mean(precisions):.2f} +- {np.std(precisions):.2f}")
     print(f"nDCG {np.mean(ndcgs):.2f} +- {np.std(ndcgs):.2f}")
+    await rag.aclose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+"""
+Benchmarks for the cold import time of nilRAG using pytest-benchmark.
+
+This script:
+1. Imports `nilrag` and `nilrag.rag_vault` in fresh interpreters
+2. Checks that the heavy dependencies (sentence-transformers, torch, sklearn) are not
+   loaded at import time, only when embeddings are generated or clustered
+3. Guards the import time against a budget
+"""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+# Modules that must only be imported on first use
+HEAVY_MODULES = ["sentence_transformers", "torch", "sklearn", "transformers"]
+# Cold import budget in seconds, generous enough for slow CI machines
+IMPORT_BUDGET = 2.0
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def cold_import(module: str) -> dict:
+    """
+    Import `module` in a new interpreter.
+
+    Returns:
+        dict: Import time in seconds and names of the modules loaded.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", ["nilrag", "nilrag.rag_vault"])
+def test_cold_import(benchmark, module):
+    """
+    Benchmark the cold import of `module` and check that it stays lightweight.
+
+    Args:
+        benchmark: pytest-benchmark fixture for performance testing
+        module: Name of the module to import
+    """
+    result = benchmark.pedantic(cold_import, args=(module,), iterations=1, rounds=5)
+
+    loaded = [name for name in HEAVY_MODULES if name in result["modules"]]
+    assert not loaded, f"import {module} loads {loaded}"
+    assert result["seconds"] < IMPORT_BUDGET
@@ -62,10 +62,11 @@ async def main():
         max_tokens=2048,
         stream=False,
     )
-    response = rag.nilai_chat_completion(config)
+    response = await rag.nilai_chat_completion_async(config)
     end_time = time.time()
     print(json.dumps(response, indent=4))
     print(f"Query took {end_time - start_time:.2f} seconds")
+    await rag.aclose()
 
 
 if __name__ == "__main__":
@@ -43,6 +43,7 @@ async def main():
     if with_clustering:
         rag.schema_id = clusters_schema_id
         await rag.flush_data()
+    await rag.aclose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+"""
+Script to incrementally sync a corpus to nilDB using nilRAG.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from dotenv import load_dotenv
+
+from nilrag.nildb.org_config import ORG_CONFIG
+from nilrag.rag_vault import RAGVault
+from nilrag.utils.embedding_cache import EmbeddingCache
+
+DEFAULT_MANIFEST_PATH = "sync-manifest.json"
+DEFAULT_CHUNK_SIZE = 50
+
+
+async def main():
+    """
+    Sync a corpus to nilDB using nilRAG.
+
+    This script:
+    1. Loads the nilDB configuration
+    2. Compares the chunks of the corpus with the manifest of uploaded documents
+    3. Uploads the new chunks and deletes the removed ones from the nilDB nodes
+    """
+
+    # Parser
+    parser = argparse.ArgumentParser(
+        description="Incrementally sync a corpus to nilDB using nilRAG"
+    )
+    parser.add_argument(
+        "source",
+        type=str,
+        help="Directory, file path or glob pattern of the corpus",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=DEFAULT_MANIFEST_PATH,
+        help=f"Path of the sync manifest (default: {DEFAULT_MANIFEST_PATH})",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"Chunk size to use (default: {DEFAULT_CHUNK_SIZE})",
+    )
+    parser.add_argument(
+        "--embedding-cache",
+        type=str,
+        default=None,
+        help="Directory of a persistent embedding cache",
+    )
+    args = parser.parse_args()
+
+    # Load environment variables
+    load_dotenv(override=True)
+
+    # Initialize vault
+    rag = await RAGVault.create(
+        ORG_CONFIG["nodes"],
+        ORG_CONFIG["org_credentials"],
+        schema_id=os.getenv("SCHEMA_ID"),
+        embedding_cache=(
+            EmbeddingCache(args.embedding_cache) if args.embedding_cache else None
+        ),
+    )
+
+    print(f"Syncing {args.source}...")
+    start_time = time.time()
+    stats = await rag.sync_rag_data(
+        args.source, args.manifest, chunk_size=args.chunk_size
+    )
+    print(f"Corpus synced in {time.time() - start_time:.2f} seconds: {stats}")
+    await rag.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
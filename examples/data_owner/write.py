@@ -12,11 +12,16 @@ from dotenv import load_dotenv
 
 from nilrag.nildb.org_config import ORG_CONFIG
 from nilrag.rag_vault import RAGVault
-from nilrag.utils.process import cluster_embeddings
+from nilrag.utils.embedding_cache import EmbeddingCache
+from nilrag.utils.process import (cluster_embeddings,
+                                  cluster_embeddings_hierarchical,
+                                  cluster_embeddings_minibatch,
+                                  cluster_spreads)
 
 DEFAULT_FILE_PATH = "examples/data/20-fake.txt"
 DEFAULT_NUMBER_CLUSTERS = 0
 DEFAULT_CHUNK_SIZE = 50
+DEFAULT_MAX_IN_FLIGHT = 4
 
 
 async def main():
@@ -44,15 +49,100 @@ async def main():
         default=DEFAULT_NUMBER_CLUSTERS,
         help=f"Number of clusters to use (default: {DEFAULT_NUMBER_CLUSTERS})",
     )
+    parser.add_argument(
+        "--num-coarse-clusters",
+        type=int,
+        default=0,
+        help="Build a two-level index of this many coarse clusters, each split into "
+        "--num-clusters fine clusters (default: 0, i.e. one level)",
+    )
+    parser.add_argument(
+        "--minibatch",
+        action="store_true",
+        help="Cluster with mini-batch K-Means, for large corpora",
+    )
+    parser.add_argument(
+        "--cluster-sample-size",
+        type=int,
+        default=None,
+        help="With --minibatch, train the centroids on a random sample of this many "
+        "embeddings (default: all embeddings, one mini-batch at a time)",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Append the documents to the existing clusters, without re-clustering",
+    )
     parser.add_argument(
         "--chunk-size",
         type=int,
         default=DEFAULT_CHUNK_SIZE,
         help=f"Chunk size to use (default: {DEFAULT_CHUNK_SIZE})",
     )
+    parser.add_argument(
+        "--chunking",
+        choices=["words", "tokens"],
+        default="words",
+        help="Chunk by --chunk-size words, or pack chunks up to the embedding model's "
+        "token limit (default: words)",
+    )
+    parser.add_argument(
+        "--token-stats",
+        action="store_true",
+        help="With --chunking words, also print how many chunks the embedding model "
+        "truncates (loads its tokenizer)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT,
+        help=f"Number of batches uploaded concurrently (default: {DEFAULT_MAX_IN_FLIGHT})",
+    )
+    parser.add_argument(
+        "--target-batch-bytes",
+        type=int,
+        default=None,
+        help="Size batches by payload bytes instead of a fixed number of documents",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        help="Path of an ingest journal; re-run with the same path to resume an "
+        "interrupted upload",
+    )
+    parser.add_argument(
+        "--files",
+        type=str,
+        default=None,
+        help="Directory or glob pattern of files to ingest in parallel (no clustering)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes for --files (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--embedding-cache",
+        type=str,
+        default=None,
+        help="Directory of a persistent embedding cache, to skip re-embedding chunks "
+        "that did not change",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Embed, encrypt and upload concurrently in a streaming pipeline "
+        "(no clustering)",
+    )
     args = parser.parse_args()
 
-    with_clustering = args.num_clusters > 1
+    if args.append and args.num_clusters > 1:
+        parser.error("--append keeps the existing clusters, drop --num-clusters")
+    with_clustering = args.num_clusters > 1 or args.append
+    if (args.stream or args.files) and with_clustering:
+        parser.error("--stream and --files do not support clustering")
 
     # Load environment variables
     load_dotenv(override=True)
@@ -69,40 +159,123 @@ async def main():
         schema_id=schema_id,
         clusters_schema_id=clusters_schema_id,
         subtract_query_id=subtract_query_id,
+        embedding_cache=(
+            EmbeddingCache(args.embedding_cache) if args.embedding_cache else None
+        ),
     )
 
+    if args.files:
+        print(f"Ingesting {args.files}...")
+        await rag.ingest_files(
+            args.files,
+            chunk_size=args.chunk_size,
+            max_workers=args.workers,
+            max_in_flight=args.max_in_flight,
+        )
+        await rag.aclose()
+        return
+
+    if args.stream:
+        print("Streaming RAG data...")
+        start_time = time.time()
+        uploaded = await rag.ingest_stream(
+            args.file, chunk_size=args.chunk_size, max_in_flight=args.max_in_flight
+        )
+        print(f"{uploaded} chunks written in {time.time() - start_time:.2f} seconds")
+        await rag.aclose()
+        return
+
     # Process RAG data by creating embeddings, chunks and corresponding shares
     print(f"Process RAG data...")
     start_time = time.time()
-    embeddings, embeddings_shares, chunks_shares = await rag.process_rag_data(
-        args.file, chunk_size=args.chunk_size
+    embeddings, embeddings_shares, chunks_shares, doc_ids = await rag.process_rag_data(
+        args.file,
+        chunk_size=args.chunk_size,
+        return_ids=True,
+        chunking=args.chunking,
+        report_token_stats=args.token_stats,
     )
     end_time = time.time()
     print(f"RAG data processed in {end_time - start_time:.2f} seconds")
 
+    if args.append:
+        print("Appending data to the existing clusters...")
+        start_time = time.time()
+        drift = await rag.append_rag_data(
+            embeddings,
+            embeddings_shares,
+            chunks_shares,
+            max_in_flight=args.max_in_flight,
+            target_batch_bytes=args.target_batch_bytes,
+            doc_ids=doc_ids,
+            journal_path=args.journal,
+        )
+        print(f"Data appended in {time.time() - start_time:.2f} seconds")
+        if drift.needs_reclustering():
+            print("Re-run without --append, with --num-clusters, to re-cluster")
+        await rag.aclose()
+        return
+
     # Create clustering embeddings
-    if args.num_clusters > 1:
+    parents, coarse_centroids = None, None
+    if args.num_clusters > 1 and args.num_coarse_clusters > 1:
+        print("Starting two-level clustering process:")
+        print(f"    Number of embeddings: {len(embeddings)}")
+        print(
+            f"    Requested number of clusters: {args.num_coarse_clusters} coarse, "
+            f"{args.num_clusters} fine per coarse cluster"
+        )
+        start_time = time.time()
+        labels, centroids, parents, coarse_centroids = cluster_embeddings_hierarchical(
+            embeddings, args.num_coarse_clusters, args.num_clusters
+        )
+        print(f"Data clustered in {time.time() - start_time:.2f} seconds")
+        sizes = np.bincount(labels, minlength=len(centroids))
+        print(
+            f"{len(centroids)} fine clusters of {sizes.min()} to {sizes.max()} documents"
+        )
+    elif args.num_clusters > 1:
         print("Starting clustering process:")
         print(f"    Number of embeddings: {len(embeddings)}")
         print(f"    Requested number of clusters: {args.num_clusters}")
         start_time = time.time()
-        labels, centroids = cluster_embeddings(embeddings, args.num_clusters)
-        print(f"Data clustered in {end_time - start_time:.2f} seconds")
+        if args.minibatch:
+            labels, centroids = cluster_embeddings_minibatch(
+                embeddings, args.num_clusters, sample_size=args.cluster_sample_size
+            )
+        else:
+            labels, centroids = cluster_embeddings(embeddings, args.num_clusters)
+        print(f"Data clustered in {time.time() - start_time:.2f} seconds")
         print("Cluster sizes:")
         for i in range(args.num_clusters):
             print(f"    Cluster {i}: {np.sum(labels == i)} documents")
     else:
         labels = None
         centroids = None
+    # Reference to measure the drift of documents appended later
+    spreads = (
+        cluster_spreads(embeddings, labels, centroids) if labels is not None else None
+    )
 
     # Write data
     print("Writing data...")
     start_time = time.time()
     await rag.write_rag_data(
-        embeddings_shares, chunks_shares, labels=labels, centroids=centroids
+        embeddings_shares,
+        chunks_shares,
+        labels=labels,
+        centroids=centroids,
+        max_in_flight=args.max_in_flight,
+        target_batch_bytes=args.target_batch_bytes,
+        doc_ids=doc_ids,
+        journal_path=args.journal,
+        parents=parents,
+        coarse_centroids=coarse_centroids,
+        spreads=spreads,
     )
     end_time = time.time()
     print(f"Data written in {end_time - start_time:.2f} seconds")
+    await rag.aclose()
 
 
 if __name__ == "__main__":
@@ -42,9 +42,11 @@ async def main():
     print(f"   SCHEMA_ID             = {schema_id}")
     print(f"   CLUSTERS_SCHEMA_ID    = {clusters_schema_id}")
     print(f"   QUERY_ID              = {query_id}")
+    print(f"   BATCH_QUERY_ID        = {rag.batch_subtract_query_id}")
     for idx, node in enumerate(ORG_CONFIG["nodes"], start=1):
         print(f"   URL{idx}               = {node['url']}")
         print(f"   DID{idx}               = {node['did']}")
+    await rag.aclose()
 
 
 if __name__ == "__main__":
@@ -6,20 +6,44 @@ from .nildb.initialization import NilDBInit
 from .nildb.operations import NilDBOps
 from .nildb.org_config import ORG_CONFIG
 from .utils.benchmark import benchmark_time, benchmark_time_async
-from .utils.process import (cluster_embeddings, create_chunks,
-                            generate_embeddings_huggingface, load_file)
+from .utils.embedding_backends import EMBEDDING_BACKENDS, register_backend
+from .utils.embedding_cache import EmbeddingCache
+from .utils.model_registry import MODEL_REGISTRY, ModelRegistry, warmup
+from .utils.process import (chunk_token_stats, cluster_embeddings,
+                            cluster_embeddings_hierarchical,
+                            cluster_embeddings_minibatch, cluster_spreads,
+                            create_chunks, create_token_chunks, embed_chunks,
+                            generate_chunk_ids,
+                            generate_embeddings_huggingface, get_tokenizer,
+                            iter_chunks, iter_paragraphs, load_file)
 from .utils.transform import (decrypt_float_list, encrypt_float_list,
                               group_shares_by_id, to_fixed_point)
 
 __all__ = [
     "NilDBInit",
     "NilDBOps",
+    "MODEL_REGISTRY",
+    "ModelRegistry",
+    "warmup",
+    "EMBEDDING_BACKENDS",
+    "register_backend",
+    "EmbeddingCache",
     "benchmark_time",
     "benchmark_time_async",
     "cluster_embeddings",
+    "cluster_embeddings_hierarchical",
+    "cluster_embeddings_minibatch",
+    "cluster_spreads",
     "load_file",
     "create_chunks",
+    "create_token_chunks",
+    "chunk_token_stats",
+    "get_tokenizer",
+    "iter_paragraphs",
+    "iter_chunks",
+    "generate_chunk_ids",
     "generate_embeddings_huggingface",
+    "embed_chunks",
     "cluster_embeddings",
     "decrypt_float_list",
     "encrypt_float_list",
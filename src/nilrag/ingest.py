@@ -0,0 +1,441 @@
+# pylint: disable=no-member
+"""
+This module provides the streaming ingestion of text files into nilDB, overlapping
+loading, embedding, encryption and upload.
+"""
+
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from typing import Awaitable, Callable, Dict, Iterable, List, Union
+
+from .utils.manifest import SyncManifest, content_hash
+from .utils.pipeline import END, batched, iterate_queue, run_stages
+from .utils.process import (create_chunks, embed_chunks, expand_sources,
+                            iter_chunks, iter_paragraphs, load_and_chunk_file)
+from .utils.transform import encrypt_rag_batch, generate_rag_keys
+
+
+class RAGIngest:
+    """
+    RAGIngest provides ingestion pipelines that run the load, chunk, embed, encrypt and
+    upload stages concurrently, connected by bounded queues.
+    """
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-locals
+    async def ingest_stream(
+        self,
+        source: Union[str, Iterable[str]],
+        chunk_size: int = 50,
+        overlap: int = 10,
+        batch_size: int = 64,
+        queue_size: int = 4,
+        max_in_flight: int = 2,
+    ) -> int:
+        """
+        Ingest a source into nilDB as a streaming pipeline.
+
+        The stages load → chunk → embed → encrypt → upload run concurrently and are
+        connected by queues holding at most `queue_size` batches of `batch_size` chunks,
+        so the encoder, the encryption and the uploads overlap and only a bounded number
+        of batches is in memory at any time. Clustering is not performed, since it needs
+        all embeddings at once.
+
+        Args:
+            source (str or iterable): Path of the text file to ingest, or an iterable of
+                paragraphs.
+            chunk_size (int, optional): Maximum number of words per chunk. Defaults to 50.
+            overlap (int, optional): Number of overlapping words between chunks.
+                Defaults to 10.
+            batch_size (int, optional): Number of chunks embedded, encrypted and uploaded
+                together. Defaults to 64.
+            queue_size (int, optional): Number of batches each queue holds.
+                Defaults to 4.
+            max_in_flight (int, optional): Number of batches uploaded concurrently.
+                Defaults to 2.
+
+        Returns:
+            int: Number of chunks uploaded.
+        """
+
+        async def produce(chunk_queue: asyncio.Queue) -> None:
+            if isinstance(source, str):
+                # Read paragraphs lazily from a memory-mapped file
+                chunks = (
+                    chunk.text
+                    for chunk in iter_chunks(
+                        iter_paragraphs(source), chunk_size, overlap
+                    )
+                )
+            else:
+                chunks = (
+                    chunk
+                    for paragraph in source
+                    for chunk in create_chunks([paragraph], chunk_size, overlap)
+                )
+            for batch in batched(chunks, batch_size):
+                await chunk_queue.put((batch, [None] * len(batch), None))
+
+        return await self._run_ingest_pipeline(
+            produce, batch_size, queue_size, max_in_flight
+        )
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-locals
+    async def ingest_files(
+        self,
+        source: Union[str, List[str]],
+        chunk_size: int = 50,
+        overlap: int = 10,
+        batch_size: int = 64,
+        max_workers: int | None = None,
+        queue_size: int = 4,
+        max_in_flight: int = 2,
+    ) -> Dict[str, float]:
+        """
+        Ingest many files into nilDB, e.g. a whole directory.
+
+        Files are loaded and chunked in a process pool, which also encrypts the batches.
+        A dedicated embedding worker batches chunks across files, and the stages run
+        concurrently as in `ingest_stream`. Chunks get deterministic ids (see
+        `generate_chunk_ids`), and a line is printed as each file is fully uploaded.
+
+        Args:
+            source (str or list): Directory (all `*.txt` files below it), file path or
+                glob pattern, or a list of them.
+            chunk_size (int, optional): Maximum number of words per chunk. Defaults to 50.
+            overlap (int, optional): Number of overlapping words between chunks.
+                Defaults to 10.
+            batch_size (int, optional): Number of chunks embedded, encrypted and uploaded
+                together. Defaults to 64.
+            max_workers (int, optional): Size of the process pool. Defaults to the
+                number of CPUs.
+            queue_size (int, optional): Number of batches each queue holds.
+                Defaults to 4.
+            max_in_flight (int, optional): Number of batches uploaded concurrently.
+                Defaults to 2.
+
+        Returns:
+            dict: Number of files and chunks ingested, elapsed seconds and chunks/sec.
+        """
+        loop = asyncio.get_running_loop()
+        paths = expand_sources(source)
+        workers = max_workers or os.cpu_count() or 1
+        start_time = time.time()
+        file_chunks = {}
+        uploaded_chunks = {}
+        files_done = 0
+
+        def report_file(path: str) -> None:
+            nonlocal files_done
+            files_done += 1
+            print(
+                f"[{files_done}/{len(paths)}] {path}: "
+                f"{file_chunks[path]} chunks uploaded"
+            )
+
+        def on_uploaded(sources: List[str]) -> None:
+            for path in sources:
+                uploaded_chunks[path] = uploaded_chunks.get(path, 0) + 1
+                if uploaded_chunks[path] == file_chunks[path]:
+                    report_file(path)
+
+        with (
+            ProcessPoolExecutor(max_workers=workers) as pool,
+            ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="nilrag-embed"
+            ) as embed_executor,
+        ):
+            # Bound the number of files loaded but not yet queued
+            window = workers * 2
+
+            async def produce(chunk_queue: asyncio.Queue) -> None:
+                async def queue_file(future: asyncio.Future) -> None:
+                    path, (chunks, doc_ids) = await future
+                    file_chunks[path] = len(chunks)
+                    if not chunks:
+                        report_file(path)
+                    for start in range(0, len(chunks), batch_size):
+                        end = start + batch_size
+                        await chunk_queue.put(
+                            (chunks[start:end], doc_ids[start:end], path)
+                        )
+
+                async def load(path: str):
+                    return path, await loop.run_in_executor(
+                        pool, load_and_chunk_file, path, chunk_size, overlap
+                    )
+
+                pending = set()
+                for path in paths:
+                    if len(pending) >= window:
+                        done, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            await queue_file(future)
+                    pending.add(asyncio.ensure_future(load(path)))
+                for future in asyncio.as_completed(pending):
+                    await queue_file(future)
+
+            uploaded = await self._run_ingest_pipeline(
+                produce,
+                batch_size,
+                queue_size,
+                max_in_flight,
+                embed_executor=embed_executor,
+                encrypt_executor=pool,
+                on_uploaded=on_uploaded,
+            )
+
+        elapsed = time.time() - start_time
+        stats = {
+            "files": len(paths),
+            "chunks": uploaded,
+            "seconds": elapsed,
+            "chunks_per_sec": uploaded / elapsed if elapsed else 0.0,
+        }
+        print(
+            f"Ingested {stats['files']} files, {stats['chunks']} chunks in "
+            f"{elapsed:.2f} seconds ({stats['chunks_per_sec']:.1f} chunks/sec)"
+        )
+        return stats
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-locals
+    async def sync_rag_data(
+        self,
+        source: Union[str, List[str]],
+        manifest_path: str,
+        chunk_size: int = 50,
+        overlap: int = 10,
+        batch_size: int = 64,
+        max_workers: int | None = None,
+        max_in_flight: int = 2,
+    ) -> Dict[str, int]:
+        """
+        Incrementally sync a corpus to nilDB against a local manifest of uploaded documents.
+
+        The chunks of the corpus get deterministic ids (see `generate_chunk_ids`) and are
+        compared with the manifest: new chunks are uploaded, edited ones replace the
+        document of the same id, then the documents that are no longer part of the corpus
+        are deleted from every node. Unchanged documents
+        stay in place, so queries keep working while the corpus is refreshed. The
+        manifest describes the whole corpus: files left out of `source` are removed.
+
+        Clustering is not supported, since new chunks would need cluster labels.
+
+        Args:
+            source (str or list): Directory (all `*.txt` files below it), file path or
+                glob pattern, or a list of them.
+            manifest_path (str): Path of the manifest, created on the first sync.
+            chunk_size (int, optional): Maximum number of words per chunk. Defaults to 50.
+            overlap (int, optional): Number of overlapping words between chunks.
+                Defaults to 10.
+            batch_size (int, optional): Number of chunks embedded, encrypted and uploaded
+                together, and of ids per delete request. Defaults to 64.
+            max_workers (int, optional): Size of the process pool that loads and chunks
+                the files. Defaults to the number of CPUs.
+            max_in_flight (int, optional): Number of batches uploaded concurrently.
+                Defaults to 2.
+
+        Returns:
+            dict: Number of added, changed, removed and unchanged documents.
+        """
+        if self.with_clustering:
+            raise ValueError("Incremental sync does not support clustering")
+        loop = asyncio.get_running_loop()
+        paths = expand_sources(source)
+        manifest = SyncManifest(manifest_path, self.schema_id)
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        pool, load_and_chunk_file, path, chunk_size, overlap
+                    )
+                    for path in paths
+                )
+            )
+        texts = {}
+        for chunks, doc_ids in results:
+            texts.update(zip(doc_ids, chunks))
+        current = {doc_id: content_hash(text) for doc_id, text in texts.items()}
+        diff = manifest.diff(current)
+        print(
+            f"Sync plan: {len(diff.added)} added, {len(diff.changed)} changed, "
+            f"{len(diff.removed)} removed, {diff.unchanged} unchanged"
+        )
+
+        # Documents left by an interrupted sync and the old versions of changed ids
+        # must go before their ids are uploaded again
+        stale = manifest.pending + diff.changed
+        if stale:
+            await self.delete_rag_data(stale, batch_size=batch_size)
+        to_upload = diff.added + diff.changed
+        if to_upload:
+            for doc_id in diff.changed:
+                del manifest.documents[doc_id]
+            manifest.pending = to_upload
+            manifest.save()
+
+            async def produce(chunk_queue: asyncio.Queue) -> None:
+                for batch in batched(to_upload, batch_size):
+                    await chunk_queue.put(
+                        ([texts[doc_id] for doc_id in batch], batch, None)
+                    )
+
+            await self._run_ingest_pipeline(
+                produce, batch_size, queue_size=4, max_in_flight=max_in_flight
+            )
+            manifest.documents.update({doc_id: current[doc_id] for doc_id in to_upload})
+            manifest.pending = []
+            manifest.save()
+        elif manifest.pending:
+            manifest.pending = []
+            manifest.save()
+
+        # Delete removed documents last, once their replacements are queryable
+        if diff.removed:
+            await self.delete_rag_data(diff.removed, batch_size=batch_size)
+            for doc_id in diff.removed:
+                del manifest.documents[doc_id]
+            manifest.save()
+
+        return {
+            "added": len(diff.added),
+            "changed": len(diff.changed),
+            "removed": len(diff.removed),
+            "unchanged": diff.unchanged,
+        }
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-locals
+    async def _run_ingest_pipeline(
+        self,
+        produce: Callable[[asyncio.Queue], Awaitable[None]],
+        batch_size: int,
+        queue_size: int,
+        max_in_flight: int,
+        embed_executor: Executor | None = None,
+        encrypt_executor: Executor | None = None,
+        on_uploaded: Callable[[List[str]], None] | None = None,
+    ) -> int:
+        """
+        Run the embed → encrypt → upload stages on the chunks `produce` puts in a queue.
+
+        `produce` puts `(chunks, doc_ids, source)` tuples in the queue; the embedding
+        stage regroups them into batches of `batch_size` chunks, across sources. After
+        each upload, `on_uploaded` is called with the source of every uploaded chunk.
+
+        Returns:
+            int: Number of chunks uploaded.
+        """
+        loop = asyncio.get_running_loop()
+        additive_key, xor_key = generate_rag_keys(len(self.nodes))
+        chunk_queue = asyncio.Queue(maxsize=queue_size)
+        embedding_queue = asyncio.Queue(maxsize=queue_size)
+        upload_queue = asyncio.Queue(maxsize=queue_size)
+        start_time = time.time()
+        uploaded = 0
+
+        async def chunk_stage():
+            try:
+                await produce(chunk_queue)
+            finally:
+                await chunk_queue.put(END)
+
+        async def embed_stage():
+            async def embed(chunks, doc_ids, sources):
+                embeddings = await loop.run_in_executor(
+                    embed_executor,
+                    functools.partial(
+                        embed_chunks,
+                        cache=self.embedding_cache,
+                        backend=self.embedding_backend,
+                    ),
+                    chunks,
+                )
+                await embedding_queue.put((chunks, doc_ids, sources, embeddings))
+
+            try:
+                chunks, doc_ids, sources = [], [], []
+                async for piece_chunks, piece_ids, source in iterate_queue(chunk_queue):
+                    chunks += piece_chunks
+                    doc_ids += piece_ids
+                    sources += [source] * len(piece_chunks)
+                    while len(chunks) >= batch_size:
+                        await embed(
+                            chunks[:batch_size],
+                            doc_ids[:batch_size],
+                            sources[:batch_size],
+                        )
+                        chunks = chunks[batch_size:]
+                        doc_ids = doc_ids[batch_size:]
+                        sources = sources[batch_size:]
+                if chunks:
+                    await embed(chunks, doc_ids, sources)
+            finally:
+                await embedding_queue.put(END)
+
+        async def encrypt_stage():
+            try:
+                async for chunks, doc_ids, sources, embeddings in iterate_queue(
+                    embedding_queue
+                ):
+                    embeddings_shares, chunks_shares = await loop.run_in_executor(
+                        encrypt_executor,
+                        encrypt_rag_batch,
+                        additive_key,
+                        xor_key,
+                        chunks,
+                        embeddings,
+                    )
+                    await upload_queue.put(
+                        (embeddings_shares, chunks_shares, doc_ids, sources)
+                    )
+            finally:
+                await upload_queue.put(END)
+
+        async def upload_stage():
+            nonlocal uploaded
+            async for (
+                embeddings_shares,
+                chunks_shares,
+                doc_ids,
+                sources,
+            ) in iterate_queue(upload_queue):
+                await self.write_rag_data(
+                    embeddings_shares,
+                    chunks_shares,
+                    batch_size=batch_size,
+                    doc_ids=None if None in doc_ids else doc_ids,
+                )
+                uploaded += len(chunks_shares)
+                if on_uploaded is not None:
+                    on_uploaded(sources)
+                elapsed = time.time() - start_time
+                print(
+                    f"Ingested {uploaded} chunks "
+                    f"({uploaded / elapsed:.1f} chunks/sec)"
+                )
+
+        try:
+            await run_stages(
+                chunk_stage(),
+                embed_stage(),
+                encrypt_stage(),
+                *(upload_stage() for _ in range(max_in_flight)),
+            )
+        finally:
+            if self.embedding_cache is not None:
+                self.embedding_cache.save()
+        return uploaded
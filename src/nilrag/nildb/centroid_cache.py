@@ -0,0 +1,233 @@
+"""
+This module provides a cache of the clusters' centroids, so that queries select their
+closest clusters without reading the clusters schema from a node every time.
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from ..utils.transform import from_fixed_point
+
+# Read the centroids again when they are older than this many seconds
+DEFAULT_CENTROID_TTL = 300.0
+# Refresh the centroids in the background when less than this many seconds of their
+# time to live remain
+DEFAULT_CENTROID_REFRESH_MARGIN = 60.0
+
+
+class CentroidMatrix(NamedTuple):
+    """
+    Centroids as one float32 matrix, with their squared norms and, if known, the number
+    of documents of each cluster and their mean squared distance to its centroid
+    (`spreads`).
+
+    In a two-level index, the matrix holds the fine centroids, `parents` the coarse
+    cluster of each of them, and `coarse` the coarse centroids.
+    """
+
+    matrix: np.ndarray
+    squared_norms: np.ndarray
+    sizes: Optional[np.ndarray] = None
+    parents: Optional[np.ndarray] = None
+    coarse: Optional["CentroidMatrix"] = None
+    spreads: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_fixed_point(
+        cls, centroids: List[List[int]], sizes: Optional[List[int]] = None
+    ) -> "CentroidMatrix":
+        """Build the matrix of centroids stored in fixed-point format."""
+        matrix = from_fixed_point(np.asarray(centroids, dtype=np.float64)).astype(
+            np.float32
+        )
+        return cls(
+            matrix,
+            np.einsum("ij,ij->i", matrix, matrix),
+            None if sizes is None else np.asarray(sizes, dtype=np.int64),
+        )
+
+    @classmethod
+    def from_records(cls, clusters_data: List[Dict]) -> "CentroidMatrix":
+        """
+        Build the centroids from the records of the clusters schema, ordered by index.
+
+        Records of `level` 0 are the coarse clusters of a two-level index; the others
+        are the (fine) clusters the documents are tagged with.
+        """
+
+        def build(records: List[Dict]) -> "CentroidMatrix":
+            sizes = [record.get("size") for record in records]
+            spreads = [record.get("spread") for record in records]
+            return cls.from_fixed_point(
+                [record["cluster_centroid"] for record in records],
+                # Clusters written without sizes are probed by distance only
+                None if None in sizes else sizes,
+            )._replace(
+                spreads=(
+                    None
+                    if None in spreads
+                    else from_fixed_point(np.asarray(spreads, dtype=np.float64))
+                )
+            )
+
+        fine = [record for record in clusters_data if record.get("level") != 0]
+        coarse = [record for record in clusters_data if record.get("level") == 0]
+        centroids = build(fine)
+        if coarse:
+            centroids = centroids._replace(
+                parents=np.array([record["parent"] for record in fine], dtype=np.int64),
+                coarse=build(coarse),
+            )
+        return centroids
+
+    def same_as(self, other: "CentroidMatrix") -> bool:
+        """Whether `other` has the same centroids, sizes, spreads and hierarchy."""
+        if (self.coarse is None) != (other.coarse is None):
+            return False
+        return all(
+            np.array_equal(mine, theirs)
+            for mine, theirs in (
+                (self.matrix, other.matrix),
+                (self.sizes, other.sizes),
+                (self.parents, other.parents),
+                (self.spreads, other.spreads),
+            )
+        ) and (self.coarse is None or self.coarse.same_as(other.coarse))
+
+    def take(self, rows: np.ndarray) -> "CentroidMatrix":
+        """Return the centroids of `rows`, without the coarse level."""
+        return CentroidMatrix(
+            self.matrix[rows],
+            self.squared_norms[rows],
+            None if self.sizes is None else self.sizes[rows],
+            None if self.parents is None else self.parents[rows],
+            spreads=None if self.spreads is None else self.spreads[rows],
+        )
+
+
+# pylint: disable=too-many-instance-attributes
+class CentroidCache:
+    """
+    Cache of the clusters' centroids, with time-to-live and background refresh.
+
+    Cached centroids are returned while they are younger than `ttl` seconds. Within the
+    last `refresh_margin` seconds they are still returned, and read again in the
+    background. Older centroids are read again before returning, by a single read shared
+    by concurrent queries. The absence of centroids (no clustering) is cached too.
+
+    Writing centroids through the vault invalidates the cache. Centroids written by
+    another process are picked up within `ttl` seconds. `version` is incremented each
+    time the centroids read differ from the cached ones, including their sizes, spreads
+    and hierarchy.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_CENTROID_TTL,
+        refresh_margin: float = DEFAULT_CENTROID_REFRESH_MARGIN,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if refresh_margin > ttl:
+            raise ValueError("refresh_margin must not exceed ttl")
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self._centroids: Optional[CentroidMatrix] = None
+        self._loaded_at: Optional[float] = None
+        self._invalidated_at = float("-inf")
+        self._loading: Optional[asyncio.Task] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.background_refreshes = 0
+
+    def _store(self, centroids: Optional[CentroidMatrix], loaded_at: float) -> None:
+        previous = self._centroids
+        if (previous is None) != (centroids is None) or (
+            centroids is not None and not centroids.same_as(previous)
+        ):
+            self.version += 1
+        self._centroids = centroids
+        self._loaded_at = loaded_at
+
+    async def _load(
+        self, load: Callable[[], Awaitable[Optional[CentroidMatrix]]]
+    ) -> Optional[CentroidMatrix]:
+        loaded_at = self.clock()
+        centroids = await load()
+        # A read started before an invalidation may miss the centroids just written
+        if loaded_at > self._invalidated_at and (
+            self._loaded_at is None or loaded_at >= self._loaded_at
+        ):
+            self._store(centroids, loaded_at)
+        return centroids
+
+    def _loading_done(self, task: asyncio.Task) -> None:
+        if self._loading is task:
+            self._loading = None
+
+    async def _refresh(
+        self, load: Callable[[], Awaitable[Optional[CentroidMatrix]]]
+    ) -> None:
+        try:
+            await self._load(load)
+            self.background_refreshes += 1
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Keep serving the cached centroids until they expire
+            print(f"❌ Failed to refresh centroids: {str(e)}")
+        finally:
+            self._refreshing = None
+
+    async def get(
+        self, load: Callable[[], Awaitable[Optional[CentroidMatrix]]]
+    ) -> Optional[CentroidMatrix]:
+        """
+        Return the centroids, reading them with `load` if they are not cached or expired.
+
+        Args:
+            load (callable): Coroutine function that reads the centroids, returning None
+                if no clustering was performed.
+
+        Returns:
+            CentroidMatrix: The centroids (None if no clustering was performed).
+        """
+        if self._loaded_at is not None:
+            age = self.clock() - self._loaded_at
+            if age < self.ttl:
+                self.hits += 1
+                if age >= self.ttl - self.refresh_margin and self._refreshing is None:
+                    self._refreshing = asyncio.create_task(self._refresh(load))
+                return self._centroids
+        self.misses += 1
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load(load))
+            self._loading.add_done_callback(self._loading_done)
+        return await asyncio.shield(self._loading)
+
+    def invalidate(self) -> None:
+        """Drop the cached centroids, e.g. after writing new ones."""
+        self._centroids = None
+        self._loaded_at = None
+        self._invalidated_at = self.clock()
+        # Reads in flight are not shared with the next lookups
+        self._loading = None
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups served from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Return the cache metrics."""
+        return {
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "background_refreshes": self.background_refreshes,
+            "hit_rate": self.hit_rate,
+        }
@@ -113,3 +113,45 @@ class NilDBInit:
         self.subtract_query_id = subtract_query_id
 
         return subtract_query_id
+
+    async def create_batch_subtract_query(
+        self, batch_subtract_query_id: str = None
+    ) -> str:
+        """
+        Creates a new query on all nodes in the cluster concurrently that computes the
+        subtraction for several query embeddings in one execution.
+
+        Args:
+            batch_subtract_query_id (str, optional): A custom query ID. If not provided, a
+                new UUID is generated.
+
+        Returns:
+            str: The created query id.
+        """
+
+        if self.with_clustering:
+            with open(
+                "src/nilrag/nildb/aux_files/subtract_query_batch_with_clustering.json",
+                "r",
+                encoding="utf8",
+            ) as query_file:
+                query = json.load(query_file)
+                query_name = "Returns the differences between the nilDB embeddings and \
+                            several query embeddings with a closest centroid tag"
+        else:
+            with open(
+                "src/nilrag/nildb/aux_files/subtract_query_batch.json",
+                "r",
+                encoding="utf8",
+            ) as query_file:
+                query = json.load(query_file)
+                query_name = "Returns the differences between the nilDB embeddings and \
+                            several query embeddings"
+
+        schema_id = self.schema_id
+        batch_subtract_query_id = await self.create_query(
+            query, schema_id, query_name, batch_subtract_query_id
+        )
+        self.batch_subtract_query_id = batch_subtract_query_id
+
+        return batch_subtract_query_id
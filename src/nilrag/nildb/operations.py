@@ -5,11 +5,21 @@ execution.
 """
 
 import asyncio
+import time
 from collections import defaultdict
 from typing import Any, Dict, List
-from uuid import uuid4
+from uuid import UUID, uuid4
 
+import numpy as np
+
+from nilrag.nildb.centroid_cache import CentroidMatrix
+from nilrag.utils.batching import PAYLOAD_TOO_LARGE, AdaptiveBatcher, json_size
+from nilrag.utils.journal import IngestJournal, ingest_fingerprint
 from nilrag.utils.process import check_inputs_to_upload
+from nilrag.utils.ranking import ClusterDrift, assign_clusters, measure_drift
+
+# Delay in seconds before the first retry of a failed write, doubled on every retry
+RETRY_BACKOFF = 1.0
 
 
 class NilDBOps:
@@ -20,17 +30,47 @@ class NilDBOps:
 
     # pylint: disable=too-many-arguments
     # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-locals
+    # pylint: disable=too-many-statements
+    # pylint: disable=too-many-branches
     async def write_rag_data(
         self,
-        lst_embedding_shares: list[list[int]],
+        lst_embedding_shares: list[list[int]] | np.ndarray,
         lst_chunk_shares: list[list[bytes]],
         batch_size: int = 100,
         labels: list[int] | None = None,
         centroids: list[int] | None = None,
+        max_in_flight: int = 1,
+        target_batch_bytes: int | None = None,
+        doc_ids: list[str] | None = None,
+        journal_path: str | None = None,
+        max_retries: int = 3,
+        parents: list[int] | None = None,
+        coarse_centroids: list[int] | None = None,
+        spreads: list[int] | None = None,
+        write_centroids: bool = True,
     ) -> None:
         """
         Write embeddings and chunks to all nilDB nodes asynchronously in batches.
 
+        Up to `max_in_flight` batches are uploaded concurrently; the next batch is only
+        built once a slot is free. Progress is reported in batch order, and a failed
+        batch does not stop the others.
+
+        With `target_batch_bytes`, batches are sized by payload bytes instead of
+        `batch_size` and adapted to the node responses: a batch a node rejects as too
+        large (HTTP 413) or that times out is retried on that node in two halves, and the
+        byte budget of later batches shrinks; fast batches grow it back up to the target.
+
+        A failed write to a node is retried up to `max_retries` times with exponential
+        backoff. With `journal_path`, every range of documents a node committed is
+        recorded on disk; running the same ingest again (same `doc_ids`, schema and nodes)
+        skips what was committed and only uploads the rest.
+
+        With `parents` and `coarse_centroids` (see `cluster_embeddings_hierarchical`),
+        the clusters form a two-level index: each document is also tagged with its
+        coarse cluster, and the hierarchy is written to the clusters schema.
+
         Args:
             lst_embedding_shares (list): List of embedding shares for each document,
                 e.g. for 3 nodes:
@@ -45,6 +85,8 @@ class NilDBOps:
                     ],
                     # More documents...
                 ]
+                or the equivalent array of shape (n_docs, dim, n_nodes), as returned by
+                `encrypt_float_array`.
             lst_chunk_shares (list): List of chunk shares for each document, e.g. for 3 nodes:
                 [
                     [  # First document's chunk shares
@@ -60,10 +102,30 @@ class NilDBOps:
                 Defaults to None.
             centroids (list[int]): List of clusters centroids when clustering is performed.
                 Defaults to None.
+            max_in_flight (int, optional): Number of batches uploaded concurrently to
+                each node. Defaults to 1.
+            target_batch_bytes (int, optional): Payload size in bytes to aim for in each
+                request. Defaults to None, i.e. fixed `batch_size` batches.
+            doc_ids (list[str], optional): Id of each document, e.g. from
+                `generate_chunk_ids`. Defaults to None, i.e. random ids.
+            journal_path (str, optional): Path of the ingest journal used to resume an
+                interrupted ingest. Requires `doc_ids`. Defaults to None.
+            max_retries (int, optional): Number of retries of a failed write to a node.
+                Defaults to 3.
+            parents (list[int], optional): Coarse cluster of each cluster of `centroids`.
+                Defaults to None.
+            coarse_centroids (list, optional): Centroids of the coarse clusters.
+                Defaults to None.
+            spreads (list[int], optional): Spread of each cluster of `centroids`, from
+                `cluster_spreads`, to measure the drift of documents appended later.
+                Defaults to None.
+            write_centroids (bool, optional): Write `centroids` to the clusters schema
+                after the documents. False when they are already stored, e.g. when
+                appending documents. Defaults to True.
 
         Raises:
             AssertionError: If number of embeddings and chunks don't match
-            ValueError: If write fails on any nilDB node
+            ValueError: If write fails on any nilDB node, listing every failed batch
         """
 
         # Input sanity check
@@ -71,82 +133,366 @@ class NilDBOps:
             lst_embedding_shares, lst_chunk_shares, labels, centroids
         )
 
-        # pylint: disable=too-many-locals
-        async def process_batch(batch_start: int, batch_end: int) -> None:
-            """Process and write a single batch of documents."""
-            print(
-                f"Processing batch {batch_start//batch_size + 1}: "
-                f"documents {batch_start} to {batch_end}"
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        if doc_ids is not None and len(doc_ids) != len(lst_embedding_shares):
+            raise ValueError(
+                f"Mismatch: {len(doc_ids)} ids vs {len(lst_embedding_shares)} documents."
             )
-            # Generate document IDs for this batch
-            doc_ids = [str(uuid4()) for _ in range(batch_start, batch_end)]
-            tasks = []
-            for node_idx, node in enumerate(self.nodes):
-                batch_data = []
-                for batch_idx, doc_idx in enumerate(range(batch_start, batch_end)):
-                    # Join the shares of one embedding in one vector for this node
-                    batch_entry = {
-                        "_id": doc_ids[batch_idx],
-                        "embedding": [
-                            e[node_idx] for e in lst_embedding_shares[doc_idx]
-                        ],
-                        "chunk": lst_chunk_shares[doc_idx][node_idx],
-                    }
-                    # In case clustering is performed,
-                    # join the clusters centroid of the corresponding embedding
+        if journal_path is not None and doc_ids is None:
+            raise ValueError("A journal requires deterministic doc_ids")
+        if parents is not None and (
+            centroids is None or len(parents) != len(centroids)
+        ):
+            raise ValueError("parents must give the coarse cluster of every centroid")
+
+        def make_entry(doc_id: str, doc_idx: int, node_idx: int) -> Dict[str, Any]:
+            """Build the record of one document for one node."""
+            # Join the shares of one embedding in one vector for this node
+            batch_entry = {
+                "_id": doc_id,
+                "embedding": np.asarray(lst_embedding_shares[doc_idx])[
+                    :, node_idx
+                ].tolist(),
+                "chunk": lst_chunk_shares[doc_idx][node_idx],
+            }
+            # In case clustering is performed,
+            # join the clusters centroid of the corresponding embedding
+            if labels is not None and centroids is not None and len(centroids) > 1:
+                batch_entry["cluster_centroid"] = int(labels[doc_idx])
+                # and, in a two-level index, its coarse cluster
+                if parents is not None:
+                    batch_entry["coarse_centroid"] = int(parents[labels[doc_idx]])
+            return batch_entry
+
+        async def timed_write(
+            node_idx: int, batch_start: int, batch_end: int, batch_ids: List[str]
+        ) -> tuple:
+            """Write a batch to one node and return its result and latency."""
+            batch_data = [
+                make_entry(doc_id, doc_idx, node_idx)
+                for doc_id, doc_idx in zip(batch_ids, range(batch_start, batch_end))
+            ]
+            for attempt in range(max_retries + 1):
+                start_time = time.monotonic()
+                try:
+                    result = await self.write_data_to_node(
+                        self.nodes[node_idx], batch_data, self.schema_id
+                    )
+                    if "error" in result:
+                        raise ValueError(f"{result['node']}: {result['error']}")
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # Payloads that are too large are split instead of retried as is,
+                    # and fail at once if they cannot be split
+                    can_split = batcher is not None and batch_end - batch_start > 1
+                    too_large = getattr(e, "status", None) == PAYLOAD_TOO_LARGE
                     if (
-                        labels is not None
-                        and centroids is not None
-                        and len(centroids) > 1
+                        attempt == max_retries
+                        or too_large
+                        or (can_split and batcher.should_split(e))
                     ):
-                        batch_entry["cluster_centroid"] = int(labels[doc_idx])
-                    # Add this entry to the batch data
-                    batch_data.append(batch_entry)
-                rag_schema_id = self.schema_id
-                tasks.append(self.write_data_to_node(node, batch_data, rag_schema_id))
-            try:
-                results = await asyncio.gather(*tasks)
-                print(f"Successfully uploaded batch {batch_start//batch_size + 1}")
-                for result in results:
+                        raise
+                    delay = RETRY_BACKOFF * 2**attempt
                     print(
-                        {
-                            "status_code": 200,
-                            "message": "Success",
-                            "response_json": result,
-                        }
+                        f"Retrying documents {batch_start} to {batch_end} on "
+                        f"{self.nodes[node_idx]['url']} in {delay:.0f}s: {str(e)}"
+                    )
+                    await asyncio.sleep(delay)
+                    continue
+                if journal is not None:
+                    journal.record(node_idx, batch_start, batch_end)
+                return result, time.monotonic() - start_time
+            raise AssertionError("unreachable")
+
+        async def process_batch(
+            batch_start: int,
+            batch_end: int,
+            batch_ids: List[str],
+            node_indices: List[int],
+        ) -> List[Dict]:
+            """Process and write a single batch of documents to the given nodes."""
+            tasks = [
+                timed_write(node_idx, batch_start, batch_end, batch_ids)
+                for node_idx in node_indices
+            ]
+            outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+            results, errors, to_split = [], [], []
+            latency = 0.0
+            for node_idx, outcome in zip(node_indices, outcomes):
+                if not isinstance(outcome, Exception):
+                    results.append(outcome[0])
+                    latency = max(latency, outcome[1])
+                elif (
+                    batcher is not None
+                    and batch_end - batch_start > 1
+                    and batcher.should_split(outcome)
+                ):
+                    batcher.record_failure(
+                        sum(doc_sizes[batch_start:batch_end]), outcome
+                    )
+                    to_split.append(node_idx)
+                else:
+                    errors.append(f"{self.nodes[node_idx]['url']}: {str(outcome)}")
+            if errors:
+                raise ValueError("; ".join(errors))
+            if not to_split:
+                if batcher is not None:
+                    batcher.record_success(latency)
+                return results
+
+            # Retry the nodes that rejected the batch with two halves of it. The other
+            # nodes already stored it, and the halves keep the same document ids.
+            middle = (batch_start + batch_end) // 2
+            print(
+                f"Splitting documents {batch_start} to {batch_end} for "
+                f"{len(to_split)} node(s), budget now {batcher.budget / 1024:.0f} KiB"
+            )
+            for sub_start, sub_end in ((batch_start, middle), (middle, batch_end)):
+                results += await process_batch(
+                    sub_start,
+                    sub_end,
+                    batch_ids[sub_start - batch_start : sub_end - batch_start],
+                    to_split,
+                )
+            return results
+
+        # Outcome (node results or exception) of finished batches not reported yet
+        batches = []
+        outcomes = {}
+        failures = []
+        next_to_report = 0
+
+        def report_in_order() -> None:
+            """Report finished batches in batch order."""
+            nonlocal next_to_report
+            while next_to_report in outcomes:
+                outcome = outcomes.pop(next_to_report)
+                batch_number = next_to_report + 1
+                if isinstance(outcome, Exception):
+                    print(f"Error uploading batch {batch_number}: {str(outcome)}")
+                    failures.append(
+                        (batch_number, *batches[next_to_report][:2], outcome)
                     )
-            except Exception as e:
-                print(f"Error uploading batch {batch_start//batch_size + 1}: {str(e)}")
-                raise
+                else:
+                    print(f"Successfully uploaded batch {batch_number}")
+                    for result in outcome:
+                        print(
+                            {
+                                "status_code": 200,
+                                "message": "Success",
+                                "response_json": result,
+                            }
+                        )
+                next_to_report += 1
+
+        # At most max_in_flight batches are being built and uploaded at any time
+        in_flight = asyncio.Semaphore(max_in_flight)
+
+        async def run_batch(batch_idx: int) -> None:
+            try:
+                batch_start, batch_end, pending = batches[batch_idx]
+                if doc_ids is not None:
+                    batch_ids = doc_ids[batch_start:batch_end]
+                else:
+                    # Generate document IDs for this batch
+                    batch_ids = [str(uuid4()) for _ in range(batch_start, batch_end)]
+                # Write each range to the nodes that have not committed it
+                node_results = await asyncio.gather(
+                    *(
+                        process_batch(
+                            start,
+                            end,
+                            batch_ids[start - batch_start : end - batch_start],
+                            node_indices,
+                        )
+                        for (start, end), node_indices in pending.items()
+                    )
+                )
+                outcomes[batch_idx] = [
+                    result for results in node_results for result in results
+                ]
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                outcomes[batch_idx] = e
+            finally:
+                in_flight.release()
+                report_in_order()
 
-        # Process data in batches
+        # Size batches by payload bytes instead of a fixed number of documents
         total_documents = len(lst_embedding_shares)
-        for batch_start in range(0, total_documents, batch_size):
-            batch_end = min(batch_start + batch_size, total_documents)
-            await process_batch(batch_start, batch_end)
-        # After processing all batches, upload centroids if they exist
-        if centroids is not None and len(centroids) > 1:
-            await self.write_centroids_data(centroids)
-
-    async def write_centroids_data(self, centroids: List[int]) -> None:
+        batcher, doc_sizes = None, []
+        if target_batch_bytes is not None:
+            batcher = AdaptiveBatcher(target_batch_bytes)
+            # The records of a document have about the same size on every node
+            doc_sizes = [
+                json_size(make_entry(str(UUID(int=0)), doc_idx, 0)) + 1
+                for doc_idx in range(total_documents)
+            ]
+
+        journal = None
+        if journal_path is not None:
+            journal = self.open_journal(journal_path, doc_ids, labels)
+
+        try:
+            # Process data in batches
+            tasks = []
+            batch_start = 0
+            while batch_start < total_documents:
+                # Backpressure: wait for a free slot before building the next batch, so
+                # that its size reflects the latest node responses
+                await in_flight.acquire()
+                if batcher is not None:
+                    batch_end = batcher.next_batch(doc_sizes, batch_start)
+                    size_info = (
+                        f" ({batch_end - batch_start} documents, "
+                        f"{sum(doc_sizes[batch_start:batch_end]) / 1024:.0f} KiB)"
+                    )
+                else:
+                    batch_end = min(batch_start + batch_size, total_documents)
+                    size_info = ""
+                # Nodes to upload each range of documents to
+                pending = {(batch_start, batch_end): list(range(len(self.nodes)))}
+                if journal is not None:
+                    # Only upload what each node did not commit yet
+                    pending = defaultdict(list)
+                    for node_idx in range(len(self.nodes)):
+                        for start, end in journal.pending_ranges(
+                            node_idx, batch_start, batch_end
+                        ):
+                            pending[start, end].append(node_idx)
+                    if not pending:
+                        in_flight.release()
+                        print(
+                            f"Skipping documents {batch_start} to {batch_end}: "
+                            "already committed"
+                        )
+                        batch_start = batch_end
+                        continue
+                batches.append((batch_start, batch_end, pending))
+                print(
+                    f"Processing batch {len(batches)}: "
+                    f"documents {batch_start} to {batch_end}{size_info}"
+                )
+                tasks.append(asyncio.create_task(run_batch(len(batches) - 1)))
+                batch_start = batch_end
+            await asyncio.gather(*tasks)
+            if batcher is not None:
+                print(f"Batch sizes: {batcher.summary()}")
+
+            if failures:
+                details = "; ".join(
+                    f"batch {batch_number} (documents {batch_start} to {batch_end}): "
+                    f"{error}"
+                    for batch_number, batch_start, batch_end, error in failures
+                )
+                raise ValueError(
+                    f"Failed to upload {len(failures)} of {len(batches)} batches: "
+                    f"{details}"
+                )
+
+            # After processing all batches, upload centroids if they exist
+            if write_centroids and centroids is not None and len(centroids) > 1:
+                if journal is not None and journal.is_done("centroids"):
+                    print("Skipping centroids: already committed")
+                else:
+                    # Number of documents of each cluster, for adaptive probing
+                    sizes = (
+                        np.bincount(
+                            np.asarray(labels, dtype=int), minlength=len(centroids)
+                        )
+                        if labels is not None
+                        else None
+                    )
+                    await self.write_centroids_data(
+                        centroids, sizes, parents, coarse_centroids, spreads
+                    )
+                    if journal is not None:
+                        journal.mark_done("centroids")
+        finally:
+            if journal is not None:
+                journal.close()
+
+    def open_journal(
+        self, journal_path: str, doc_ids: List[str], labels: List[int] | None = None
+    ) -> IngestJournal:
+        """
+        Open the journal of an ingest of `doc_ids` (and `labels`) to this schema and
+        nodes, resuming it if it exists.
+
+        Raises:
+            ValueError: If the journal belongs to a different ingest
+        """
+        return IngestJournal(
+            journal_path,
+            ingest_fingerprint(
+                self.schema_id, [node["url"] for node in self.nodes], doc_ids, labels
+            ),
+            len(self.nodes),
+        )
+
+    async def write_centroids_data(
+        self,
+        centroids: List[int],
+        sizes: List[int] | None = None,
+        parents: List[int] | None = None,
+        coarse_centroids: List[int] | None = None,
+        spreads: List[int] | None = None,
+    ) -> None:
         """
         Writes the centroids data to all nodes after generating the appropriate IDs.
+
+        With `parents` and `coarse_centroids`, the centroids are the fine level of a
+        two-level index: each fine cluster record holds the index of its coarse cluster
+        (`parent`, with `level` 1), and the coarse centroids are written as records of
+        `level` 0.
+
+        Args:
+            centroids (list): Centroid of each cluster, in fixed-point format
+            sizes (list[int], optional): Number of documents in each cluster, used by
+                adaptive cluster probing. Defaults to None.
+            parents (list[int], optional): Coarse cluster of each cluster. Defaults to
+                None.
+            coarse_centroids (list, optional): Centroid of each coarse cluster, in
+                fixed-point format. Defaults to None.
+            spreads (list[int], optional): Mean squared distance of the documents of
+                each cluster to its centroid, in fixed-point format. Defaults to None.
         """
+        if (parents is None) != (coarse_centroids is None):
+            raise ValueError(
+                "A two-level index needs both parents and coarse_centroids"
+            )
+
+        # Build the records of the (fine) clusters
+        centroids_data = []
+        for centroid_idx, centroid in enumerate(centroids):
+            record = {"cluster_centroid": centroid, "index": centroid_idx}
+            if sizes is not None:
+                record["size"] = int(sizes[centroid_idx])
+            if spreads is not None:
+                record["spread"] = int(spreads[centroid_idx])
+            if parents is not None:
+                record["level"] = 1
+                record["parent"] = int(parents[centroid_idx])
+            centroids_data.append(record)
+        # Then the records of the coarse clusters, if any
+        if coarse_centroids is not None:
+            coarse_sizes = (
+                np.bincount(parents, weights=sizes, minlength=len(coarse_centroids))
+                if sizes is not None
+                else None
+            )
+            for coarse_idx, centroid in enumerate(coarse_centroids):
+                record = {"cluster_centroid": centroid, "index": coarse_idx, "level": 0}
+                if coarse_sizes is not None:
+                    record["size"] = int(coarse_sizes[coarse_idx])
+                centroids_data.append(record)
         # Generate IDs for centroids
-        centroid_ids = [str(uuid4()) for _ in centroids]
+        for record in centroids_data:
+            record["_id"] = str(uuid4())
 
         # Collect tasks for uploading centroids
         tasks = []
         clusters_schema_id = self.clusters_schema_id
-        for _, node in enumerate(self.nodes):
-            centroids_data = [
-                {
-                    "_id": centroid_ids[centroid_idx],
-                    "cluster_centroid": centroid,
-                    "index": centroid_idx,
-                }
-                for centroid_idx, centroid in enumerate(centroids)
-            ]
+        for node in self.nodes:
             tasks.append(
                 self.write_data_to_node(node, centroids_data, clusters_schema_id)
             )
@@ -166,6 +512,161 @@ class NilDBOps:
         except Exception as e:
             print(f"Error uploading centroids: {str(e)}")
             raise
+        finally:
+            # Queries read the new centroids, even if only some nodes were written
+            self.centroid_cache.invalidate()
+
+    async def update_clusters_data(self, updates: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Update fields of cluster records on all nilDB nodes.
+
+        Args:
+            updates (dict): Fields to set, by id of the cluster record
+
+        Raises:
+            ValueError: If an update fails on any nilDB node, listing every failure
+        """
+
+        async def update_on_node(
+            node: Dict[str, str], record_id: str, fields: Dict[str, Any]
+        ) -> None:
+            jwt_token = await self.generate_node_token(node["did"])
+            payload = {
+                "schema": self.clusters_schema_id,
+                "update": {"$set": fields},
+                "filter": {"_id": record_id},
+            }
+            await self.make_request(node["url"], "data/update", jwt_token, payload)
+
+        try:
+            requests = [
+                (node, record_id, fields)
+                for record_id, fields in updates.items()
+                for node in self.nodes
+            ]
+            results = await asyncio.gather(
+                *(update_on_node(*request) for request in requests),
+                return_exceptions=True,
+            )
+        finally:
+            self.centroid_cache.invalidate()
+        failures = [
+            f"{node['url']} (cluster {record_id})"
+            for (node, record_id, _), result in zip(requests, results)
+            if isinstance(result, Exception)
+        ]
+        if failures:
+            raise ValueError(
+                f"Failed to update {len(failures)} cluster records: "
+                f"{'; '.join(failures)}"
+            )
+
+    async def append_rag_data(
+        self,
+        embeddings: np.ndarray,
+        lst_embedding_shares: list[list[int]] | np.ndarray,
+        lst_chunk_shares: list[list[bytes]],
+        update_sizes: bool = True,
+        **kwargs,
+    ) -> ClusterDrift:
+        """
+        Append documents to a clustered collection, without re-clustering it.
+
+        The centroids are read from the clusters schema, each new document is assigned
+        to its closest (fine) centroid, and only the new documents are uploaded, tagged
+        with their cluster (and coarse cluster in a two-level index). The sizes of the
+        clusters are then updated, for adaptive probing. With `journal_path`, the
+        size update is a step of the journal, so that resuming an append does not count
+        the new documents twice.
+
+        The drift of the new documents is measured against the spreads of the clusters
+        when they were computed: once it exceeds a threshold (see
+        `ClusterDrift.needs_reclustering`), re-cluster the whole collection with
+        `write_rag_data`.
+
+        Args:
+            embeddings (np.ndarray): Embedding of each new document, in floating-point
+                format, as returned by `process_rag_data`.
+            lst_embedding_shares (list): Embedding shares of each new document.
+            lst_chunk_shares (list): Chunk shares of each new document.
+            update_sizes (bool, optional): Add the new documents to the sizes of their
+                clusters. Defaults to True.
+            **kwargs: Other arguments of `write_rag_data`, e.g. `doc_ids` or
+                `max_in_flight`.
+
+        Returns:
+            ClusterDrift: The drift of the new documents
+
+        Raises:
+            ValueError: If the collection is not clustered, or if the upload fails
+        """
+        clusters_data = await self.get_clusters_data()
+        if not clusters_data:
+            raise ValueError(
+                "No clusters to append to: write the documents with write_rag_data"
+            )
+        centroids = CentroidMatrix.from_records(clusters_data)
+        labels, squared_distances = assign_clusters(embeddings, centroids)
+        drift = measure_drift(labels, squared_distances, centroids)
+
+        fine_records = [record for record in clusters_data if record.get("level") != 0]
+        await self.write_rag_data(
+            lst_embedding_shares,
+            lst_chunk_shares,
+            labels=labels,
+            centroids=[record["cluster_centroid"] for record in fine_records],
+            parents=None if centroids.parents is None else centroids.parents.tolist(),
+            write_centroids=False,
+            **kwargs,
+        )
+
+        if update_sizes and centroids.sizes is not None:
+            counts = np.bincount(labels, minlength=len(fine_records))
+            updates = {
+                record["_id"]: {"size": int(record["size"] + count)}
+                for record, count in zip(fine_records, counts)
+                if count
+            }
+            if centroids.coarse is not None and centroids.coarse.sizes is not None:
+                coarse_records = [
+                    record for record in clusters_data if record.get("level") == 0
+                ]
+                coarse_counts = np.bincount(
+                    centroids.parents, weights=counts, minlength=len(coarse_records)
+                )
+                updates.update(
+                    {
+                        record["_id"]: {"size": int(record["size"] + count)}
+                        for record, count in zip(coarse_records, coarse_counts)
+                        if count
+                    }
+                )
+            # The upload recorded its progress in the same journal
+            journal = (
+                self.open_journal(kwargs["journal_path"], kwargs.get("doc_ids"), labels)
+                if kwargs.get("journal_path") is not None
+                else None
+            )
+            try:
+                if journal is not None and journal.is_done("sizes"):
+                    print("Skipping the cluster sizes: already updated")
+                else:
+                    await self.update_clusters_data(updates)
+                    if journal is not None:
+                        journal.mark_done("sizes")
+                    print(f"Updated the sizes of {len(updates)} clusters")
+            finally:
+                if journal is not None:
+                    journal.close()
+
+        ratio = "unknown" if drift.ratio is None else f"{drift.ratio:.2f}"
+        print(
+            f"Appended {drift.num_documents} documents to {len(fine_records)} clusters, "
+            f"drift {ratio}"
+        )
+        if drift.needs_reclustering():
+            print("The new documents drift from the clusters: re-cluster the data")
+        return drift
 
     async def write_data_to_node(
         self, node: Dict[str, str], node_data: List[Dict], schema_id: str
@@ -188,29 +689,67 @@ class NilDBOps:
             print(f"❌ Failed to write to {node['url']}: {str(e)}")
             return {"node": node["url"], "error": str(e)}
 
-    async def execute_subtract_query(
+    async def delete_rag_data(self, doc_ids: List[str], batch_size: int = 500) -> None:
+        """
+        Delete documents by id from all nilDB nodes.
+
+        Ids that are not stored on a node are ignored, so a failed deletion can simply be
+        repeated.
+
+        Args:
+            doc_ids (list[str]): Ids of the documents to delete.
+            batch_size (int, optional): Number of ids per delete request. Defaults to 500.
+
+        Raises:
+            ValueError: If a deletion fails on any nilDB node, listing every failure
+        """
+
+        async def delete_from_node(node: Dict[str, str], batch: List[str]) -> None:
+            jwt_token = await self.generate_node_token(node["did"])
+            payload = {
+                "schema": self.schema_id,
+                "filter": {"_id": {"$in": batch}},
+            }
+            await self.make_request(node["url"], "data/delete", jwt_token, payload)
+
+        failures = []
+        for start in range(0, len(doc_ids), batch_size):
+            batch = doc_ids[start : start + batch_size]
+            results = await asyncio.gather(
+                *(delete_from_node(node, batch) for node in self.nodes),
+                return_exceptions=True,
+            )
+            for node, result in zip(self.nodes, results):
+                if isinstance(result, Exception):
+                    failures.append(
+                        f"{node['url']} (ids {start} to {start + len(batch)})"
+                    )
+                    print(f"❌ Failed to delete from {node['url']}: {result}")
+        if failures:
+            raise ValueError(
+                f"Failed to delete documents from {len(failures)} node batches: "
+                f"{'; '.join(failures)}"
+            )
+
+    async def execute_subtract_query_on_nodes(
         self,
-        nilql_query_embedding: List[List[bytes]],
+        nilql_query_embedding: List[List[int]] | np.ndarray,
         closest_centroids: List[int] | None = None,
-    ) -> Dict[str, List[int]]:
+    ) -> List[List[Dict[str, Any]]]:
         """
         Execute the subtract query across all nilDB nodes asynchronously.
 
         Args:
-            nilql_query_embedding (list): Encrypted query embedding for all nilDB nodes.
+            nilql_query_embedding (list): Encrypted query embedding for all nilDB nodes,
+                i.e. one list of node shares per dimension (or an array of shape
+                (dim, n_nodes)).
             closest_centroids (list, optional): The closest centroids to filter by.
 
         Returns:
-            list: List of subtracted shares from each nilDB node.
-
-        Raises:
-            ValueError: If query execution fails on any nilDB node.
+            list: For each nilDB node, the list of records with the subtracted shares.
         """
         # Rearrange nilql_query_embedding to group by party
-        query_embedding_shares = [
-            [entry[party] for entry in nilql_query_embedding]
-            for party in range(len(self.nodes))
-        ]
+        query_embedding_shares = np.asarray(nilql_query_embedding).T.tolist()
 
         # Execute queries on all nodes in parallel
         tasks = []
@@ -231,11 +770,80 @@ class NilDBOps:
             tasks.append(task)
 
         results_from_all_nodes = await asyncio.gather(*tasks)
+        return [node_result.get("data", []) for node_result in results_from_all_nodes]
+
+    async def execute_batch_subtract_query_on_nodes(
+        self,
+        nilql_query_embeddings: np.ndarray,
+        closest_centroids: List[int] | None = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Execute the batch subtract query across all nilDB nodes asynchronously, sending
+        the embeddings of every query in a single query execution per node.
+
+        Args:
+            nilql_query_embeddings (np.ndarray): Encrypted query embeddings of shape
+                (n_queries, dim, n_nodes).
+            closest_centroids (list, optional): The union of the closest centroids of all
+                queries to filter by.
+
+        Returns:
+            list: For each nilDB node, the list of records with one list of subtracted
+                shares per query (`differences`).
+        """
+        # Rearrange nilql_query_embeddings to group by party: (n_nodes, n_queries, dim)
+        query_embeddings_shares = np.moveaxis(
+            np.asarray(nilql_query_embeddings), -1, 0
+        ).tolist()
+
+        # Execute queries on all nodes in parallel
+        tasks = []
+        closest_centroids_key_value = (
+            {"closest_centroids": closest_centroids}
+            if closest_centroids is not None
+            else {}
+        )
+        for node_index, node in enumerate(self.nodes):
+            payload = {
+                "id": self.batch_subtract_query_id,
+                "variables": {
+                    "query_embeddings": query_embeddings_shares[node_index],
+                    **closest_centroids_key_value,
+                },
+            }
+            tasks.append(self.execute_query_on_single_node(node, payload))
+
+        results_from_all_nodes = await asyncio.gather(*tasks)
+        return [node_result.get("data", []) for node_result in results_from_all_nodes]
+
+    async def execute_subtract_query(
+        self,
+        nilql_query_embedding: List[List[int]] | np.ndarray,
+        closest_centroids: List[int] | None = None,
+    ) -> Dict[str, List[int]]:
+        """
+        Execute the subtract query across all nilDB nodes asynchronously and group the
+        results by document.
+
+        Args:
+            nilql_query_embedding (list): Encrypted query embedding for all nilDB nodes.
+            closest_centroids (list, optional): The closest centroids to filter by.
+
+        Returns:
+            dict: Mapping from document `_id` to the list of subtracted shares from each
+                nilDB node.
+
+        Raises:
+            ValueError: If query execution fails on any nilDB node.
+        """
+        results_from_all_nodes = await self.execute_subtract_query_on_nodes(
+            nilql_query_embedding, closest_centroids
+        )
 
         # Groups records from different nodes by _id field
         shares_by_id = defaultdict(list)
         for node_result in results_from_all_nodes:
-            for share in node_result.get("data", []):
+            for share in node_result:
                 shares_by_id[share["_id"]].append(share["difference"])
         return shares_by_id
 
@@ -1,29 +1,69 @@
 """The SecretVault organization configuration"""
 
 import os
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator
 
-from dotenv import load_dotenv
 
-load_dotenv()
+def load_org_config() -> Dict[str, Any]:
+    """
+    Load the organization configuration from the environment and the `.env` file.
 
-# Organization configuration
-ORG_CONFIG = {
-    "org_credentials": {
-        "secret_key": os.getenv("NILLION_ORG_SECRET_KEY"),
-        "org_did": os.getenv("NILLION_ORG_DID"),
-    },
-    "nodes": [
-        {
-            "url": os.getenv("URL1"),
-            "did": os.getenv("DID1"),
-        },
-        {
-            "url": os.getenv("URL2"),
-            "did": os.getenv("DID2"),
-        },
-        {
-            "url": os.getenv("URL3"),
-            "did": os.getenv("DID3"),
+    Returns:
+        dict: Organization credentials and nilDB nodes.
+    """
+    # Imported on first use, like the configuration itself
+    # pylint: disable=import-outside-toplevel
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    # Organization configuration
+    return {
+        "org_credentials": {
+            "secret_key": os.getenv("NILLION_ORG_SECRET_KEY"),
+            "org_did": os.getenv("NILLION_ORG_DID"),
         },
-    ],
-}
+        "nodes": [
+            {
+                "url": os.getenv("URL1"),
+                "did": os.getenv("DID1"),
+            },
+            {
+                "url": os.getenv("URL2"),
+                "did": os.getenv("DID2"),
+            },
+            {
+                "url": os.getenv("URL3"),
+                "did": os.getenv("DID3"),
+            },
+        ],
+    }
+
+
+class LazyConfig(Mapping):
+    """
+    Read-only mapping that is only loaded when one of its keys is first accessed, so that
+    importing nilRAG does not read the `.env` file.
+    """
+
+    def __init__(self, loader: Callable[[], Dict[str, Any]]):
+        self._loader = loader
+        self._config: Dict[str, Any] | None = None
+
+    def _load(self) -> Dict[str, Any]:
+        if self._config is None:
+            self._config = self._loader()
+        return self._config
+
+    def __getitem__(self, key: str) -> Any:
+        return self._load()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+
+ORG_CONFIG = LazyConfig(load_org_config)
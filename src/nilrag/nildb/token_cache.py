@@ -0,0 +1,113 @@
+"""
+This module provides a cache of node JWT tokens, so that tokens are signed once and reused
+until shortly before they expire.
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Tuple
+
+import jwt
+
+# Refresh tokens in the background when less than this many seconds of validity remain
+DEFAULT_REFRESH_MARGIN = 15.0
+# Never hand out a token with less than this many seconds of validity left
+DEFAULT_MIN_VALIDITY = 5.0
+
+
+# pylint: disable=too-many-instance-attributes
+class TokenCache:
+    """
+    Cache of JWT tokens keyed by node DID, with expiry-aware refresh.
+
+    A cached token is returned while it has more than `refresh_margin` seconds of
+    validity left. Within the refresh margin it is still returned, and a new token is
+    signed in the background. Tokens with less than `min_validity` seconds left are
+    replaced before returning.
+    """
+
+    def __init__(
+        self,
+        refresh_margin: float = DEFAULT_REFRESH_MARGIN,
+        min_validity: float = DEFAULT_MIN_VALIDITY,
+        clock: Callable[[], float] = time.time,
+    ):
+        if min_validity > refresh_margin:
+            raise ValueError("min_validity must not exceed refresh_margin")
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.clock = clock
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.background_refreshes = 0
+
+    @staticmethod
+    def _expiry(token: str) -> float:
+        """Read the expiry time of a token we signed ourselves."""
+        claims = jwt.decode(token, options={"verify_signature": False})
+        return float(claims["exp"])
+
+    async def _generate(self, key: str, generate: Callable[[], Awaitable[str]]) -> str:
+        token = await generate()
+        self._tokens[key] = (token, self._expiry(token))
+        return token
+
+    async def _refresh(self, key: str, generate: Callable[[], Awaitable[str]]) -> None:
+        try:
+            await self._generate(key, generate)
+            self.background_refreshes += 1
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Keep serving the current token; it is replaced synchronously once it gets
+            # too close to its expiry
+            print(f"❌ Failed to refresh token for {key}: {str(e)}")
+        finally:
+            self._refreshing.pop(key, None)
+
+    async def get(self, key: str, generate: Callable[[], Awaitable[str]]) -> str:
+        """
+        Return a valid token for `key`, signing a new one with `generate` if needed.
+
+        Args:
+            key (str): Cache key, e.g. the node DID.
+            generate (callable): Coroutine function that signs a new token.
+
+        Returns:
+            str: The JWT token.
+        """
+        cached = self._tokens.get(key)
+        if cached is not None:
+            token, expires_at = cached
+            remaining = expires_at - self.clock()
+            if remaining > self.min_validity:
+                self.hits += 1
+                if remaining <= self.refresh_margin and key not in self._refreshing:
+                    self._refreshing[key] = asyncio.create_task(
+                        self._refresh(key, generate)
+                    )
+                return token
+        self.misses += 1
+        return await self._generate(key, generate)
+
+    def invalidate(self, key: str | None = None) -> None:
+        """Drop the cached token of `key`, or all cached tokens."""
+        if key is None:
+            self._tokens.clear()
+        else:
+            self._tokens.pop(key, None)
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups served from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Return the cache metrics."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "background_refreshes": self.background_refreshes,
+            "hit_rate": self.hit_rate,
+        }
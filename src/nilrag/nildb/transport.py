@@ -0,0 +1,150 @@
+# pylint: disable=no-member
+"""
+This module provides the HTTP transport for nilDB and nilAI requests, based on a long-lived,
+pooled aiohttp session.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from http import HTTPMethod
+from typing import Any, Dict
+
+import aiohttp
+
+# Constants
+TIMEOUT = 3600
+
+
+@dataclass
+class HttpClientConfig:
+    """Configuration of the pooled HTTP client used for nilDB and nilAI requests."""
+
+    limit: int = 100
+    limit_per_host: int = 16
+    keepalive_timeout: float = 60.0
+    ttl_dns_cache: int = 300
+    timeout: float = TIMEOUT
+
+
+class NodeRequestError(ConnectionError):
+    """Error raised when a request to a node fails, with the HTTP status if any."""
+
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+class NodeTimeoutError(NodeRequestError, TimeoutError):
+    """Error raised when a request to a node times out."""
+
+
+class NilDBTransport:
+    """
+    NilDBTransport owns a long-lived aiohttp session with per-host connection limits,
+    keep-alive and DNS caching, and routes all node requests through it.
+    """
+
+    http_config: HttpClientConfig = HttpClientConfig()
+    _session: aiohttp.ClientSession | None = None
+    _session_loop: asyncio.AbstractEventLoop | None = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        Return the shared HTTP session, creating it on first use.
+
+        A session is bound to the event loop it was created in, so a new one is created
+        if the vault is used from a different event loop. Call `aclose()` (or use the vault
+        as an async context manager) before leaving an event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if (
+            self._session is None
+            or self._session.closed
+            or self._session_loop is not loop
+        ):
+            connector = aiohttp.TCPConnector(
+                limit=self.http_config.limit,
+                limit_per_host=self.http_config.limit_per_host,
+                keepalive_timeout=self.http_config.keepalive_timeout,
+                ttl_dns_cache=self.http_config.ttl_dns_cache,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.http_config.timeout),
+            )
+            self._session_loop = loop
+        return self._session
+
+    async def aclose(self) -> None:
+        """Close the shared HTTP session and its pooled connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.aclose()
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    async def make_request(
+        self,
+        node_url: str,
+        endpoint: str,
+        token: str,
+        payload: Dict[str, Any],
+        method: HTTPMethod = HTTPMethod.POST,
+    ) -> Dict[str, Any]:
+        """
+        Makes an HTTP request to the node endpoint using the shared session.
+
+        Args:
+            node_url (str): The base URL of the node.
+            endpoint (str): The API endpoint to call.
+            token (str): The authorization token for the request.
+            payload (Dict[str, Any]): The data to be sent in the request body.
+            method (HTTPMethod): The HTTP method to use. Default is "POST".
+
+        Returns:
+            Dict[str, Any]: The response data parsed as JSON.
+
+        Raises:
+            NodeRequestError: If there is an error with the network connection or server.
+            NodeTimeoutError: If the request times out.
+        """
+        url = f"{node_url}/api/v1/{endpoint}"
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        session = await self.get_session()
+        try:
+            async with session.request(
+                method,
+                url,
+                headers=headers,
+                json=payload if method != HTTPMethod.GET else None,
+                params=payload if method == HTTPMethod.GET else None,
+            ) as response:
+                if response.status >= 300:
+                    raise NodeRequestError(
+                        f"Error: {response.status}, body: {await response.text()}",
+                        status=response.status,
+                    )
+                # Check if response contains a body
+                if (
+                    response.content_type
+                    and "application/json" in response.content_type.lower()
+                ):
+                    return await response.json()
+                return {}
+        except asyncio.TimeoutError as e:
+            raise NodeTimeoutError(f"Request timed out: {url}") from e
+        except aiohttp.ClientConnectionError as e:
+            raise NodeRequestError(f"Connection error: {str(e)}") from e
+        except aiohttp.ClientError as e:
+            raise NodeRequestError(f"Request failed: {str(e)}") from e
@@ -1,9 +1,12 @@
+# pylint: disable=too-many-lines
 """
 This module provides the RAGVault class, which is a wrapper around the SecretVaultWrapper,
-NilDBInit, and NilDBOps classes.
+NilDBInit, NilDBOps, NilDBTransport, and RAGIngest classes.
 """
 
 import asyncio
+import functools
+import operator
 import os
 import time
 from dataclasses import dataclass
@@ -12,17 +15,32 @@ from typing import Dict, List, Optional, Tuple, Union
 import aiohttp
 import nilql
 import numpy as np
-import requests
 from dotenv import set_key
 from secretvaults import SecretVaultWrapper
 
+from .ingest import RAGIngest
+from .nildb.centroid_cache import CentroidCache, CentroidMatrix
 from .nildb.initialization import NilDBInit
 from .nildb.operations import NilDBOps
-from .utils.benchmark import benchmark_time, benchmark_time_async
-from .utils.process import (create_chunks, generate_embeddings_huggingface,
+from .nildb.token_cache import TokenCache
+from .nildb.transport import HttpClientConfig, NilDBTransport
+from .utils.embedding_backends import DEFAULT_BACKEND, get_backend_loader
+from .utils.embedding_cache import EmbeddingCache
+from .utils.offload import CPUOffload
+from .utils.pipeline import run_graph
+from .utils.process import (chunk_token_stats, create_chunks,
+                            create_token_chunks, embed_chunks,
+                            generate_chunk_ids,
+                            generate_embeddings_huggingface, get_tokenizer,
                             load_file)
-from .utils.transform import (decrypt_float_list, encrypt_float_list,
-                              from_fixed_point, group_shares_by_id)
+# compute_closest_centroids is re-exported, it used to be defined here
+# pylint: disable=unused-import
+from .utils.ranking import (AdaptiveProbing, compute_closest_centroids,
+                            select_closest_centroids, top_k_indices)
+# pylint: enable=unused-import
+from .utils.transform import (decrypt_float_array, encrypt_float_array,
+                              encrypt_float_list, generate_rag_keys,
+                              group_shares_by_id, stack_shares_by_id)
 
 # Constants
 TIMEOUT = 3600
@@ -41,12 +59,23 @@ class ChatCompletionConfig:
     stream: bool = False
 
 
-class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=too-many-ancestors
+class RAGVault(
+    NilDBTransport, SecretVaultWrapper, NilDBInit, NilDBOps, RAGIngest, CPUOffload
+):
     """
     RAGVault is a wrapper around the SecretVaultWrapper, NilDBInit, and NilDBOps classes.
+
+    All nilDB and nilAI requests go through one pooled HTTP session owned by the vault
+    (see NilDBTransport). The CPU-bound stages of a query (encoding, encryption and
+    decryption) run in a worker pool of `cpu_workers` threads or processes (see
+    CPUOffload), so that concurrent queries on one vault use all cores. Close the vault
+    with `await rag.aclose()` or use it as an async context manager.
     """
 
     # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-locals
     def __init__(
         self,
         nodes: List[Dict[str, str]],
@@ -55,6 +84,14 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         with_clustering: bool | None = None,
         clusters_schema_id: str | None = None,
         subtract_query_id: str | None = None,
+        batch_subtract_query_id: str | None = None,
+        http_config: HttpClientConfig | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+        embedding_backend: str = DEFAULT_BACKEND,
+        cpu_pool: str = "thread",
+        cpu_workers: int | None = None,
+        centroid_cache: CentroidCache | None = None,
+        num_coarse_clusters: int = 1,
         **kwargs,
     ):
         # SecretVaultWrapper args first
@@ -63,6 +100,30 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         self.clusters_schema_id = clusters_schema_id
         self.with_clustering = with_clustering
         self.subtract_query_id = subtract_query_id
+        self.batch_subtract_query_id = batch_subtract_query_id
+        # Pooled HTTP session, created on first request
+        self.http_config = http_config or HttpClientConfig()
+        self._session = None
+        self._session_loop = None
+        # Node JWT tokens, reused until shortly before they expire
+        self.token_cache = TokenCache()
+        # Clusters' centroids, read again when expired or after writing new ones
+        self.centroid_cache = centroid_cache or CentroidCache()
+        # Coarse clusters a query selects its closest clusters from, in a two-level index
+        self.num_coarse_clusters = num_coarse_clusters
+        # Optional on-disk cache of chunk embeddings used when ingesting
+        self.embedding_cache = embedding_cache
+        # Runtime of the embedding model, e.g. "onnx-int8" on CPU-only hosts; unknown
+        # backends fail here rather than on the first query
+        get_backend_loader(embedding_backend)
+        self.embedding_backend = embedding_backend
+        # Worker pool of the CPU-bound query stages, created on first query
+        self.configure_cpu_pool(cpu_pool, cpu_workers)
+
+    async def aclose(self) -> None:
+        """Close the shared HTTP session and shut down the CPU worker pool."""
+        await super().aclose()
+        self.shutdown_cpu_pool()
 
     # pylint: disable=too-many-arguments
     @classmethod
@@ -74,6 +135,7 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         with_clustering: bool | None = None,
         clusters_schema_id: str | None = None,
         subtract_query_id: str | None = None,
+        batch_subtract_query_id: str | None = None,
         **kwargs,
     ) -> "RAGVault":
         """
@@ -87,6 +149,7 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
             with_clustering=with_clustering,
             clusters_schema_id=clusters_schema_id,
             subtract_query_id=subtract_query_id,
+            batch_subtract_query_id=batch_subtract_query_id,
             **kwargs,
         )
         # Perform async initialization from SecretVaultWrapper (await SecretVaultWrapper.init())
@@ -122,6 +185,7 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         schema_id = config.get("schema_id", None)
         clusters_schema_id = config.get("clusters_schema_id", None)
         subtract_query_id = config.get("subtract_query_id", None)
+        batch_subtract_query_id = config.get("batch_subtract_query_id", None)
 
         # Construct object synchronously
         self = cls(
@@ -132,6 +196,7 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
             with_clustering=with_clustering,
             clusters_schema_id=clusters_schema_id,
             subtract_query_id=subtract_query_id,
+            batch_subtract_query_id=batch_subtract_query_id,
             **kwargs,
         )
         # Perform async initialization from SecretVaultWrapper (await SecretVaultWrapper.init())
@@ -148,11 +213,12 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         """
         First-time setup that allows to:
           • Instantiate & initialize the RAG vault with clustering
-          • Create RAG schema, clusters schema, and subtract query
+          • Create RAG schema, clusters schema, and subtract queries (single and batch)
           • Write all required keys into .env in one pass
 
         Returns:
           (rag_vault, schema_id, clusters_schema_id, subtract_query_id)
+          The batch subtract query id is available as `rag_vault.batch_subtract_query_id`.
         """
         # Ensure .env exists
         if not os.path.exists(env_path):
@@ -168,6 +234,7 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         # Create schemas & query
         schema_id = await rag.create_rag_schema()
         subtract_query_id = await rag.create_subtract_query()
+        batch_subtract_query_id = await rag.create_batch_subtract_query()
         clusters_schema_id = (
             await rag.create_clusters_schema() if with_clustering else None
         )
@@ -176,6 +243,7 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
             "SCHEMA_ID": schema_id,
             "CLUSTERS_SCHEMA_ID": clusters_schema_id if with_clustering else "",
             "QUERY_ID": subtract_query_id,
+            "BATCH_QUERY_ID": batch_subtract_query_id,
         }
 
         for key, value in updates.items():
@@ -183,12 +251,33 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
 
         return rag, schema_id, clusters_schema_id, subtract_query_id
 
+    async def generate_node_token(self, node_did: str) -> str:
+        """
+        Return a JWT token for node authentication, reusing the cached token of the node
+        until shortly before it expires (see TokenCache).
+
+        Args:
+            node_did (str): The decentralized identifier (DID) of the node.
+
+        Returns:
+            str: The JWT token.
+        """
+        return await self.token_cache.get(
+            node_did, functools.partial(super().generate_node_token, node_did)
+        )
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-locals
     async def process_rag_data(
         self,
         file_path: str,
         chunk_size: int = 50,
         overlap: int = 10,
-    ) -> Tuple[List[List[float]], List[List[bytes]], List[List[bytes]]]:
+        return_ids: bool = False,
+        chunking: str = "words",
+        report_token_stats: bool = False,
+    ) -> Tuple:
         """
         Process RAG data.
 
@@ -197,33 +286,130 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         2. Creates chunks from the input file
         3. Generates embeddings for the chunks
         4. Encrypts the chunks and embeddings
+
+        The embedding shares are returned as one array of shape (n_docs, dim, n_nodes).
+        With `return_ids`, the deterministic ids of the chunks (see `generate_chunk_ids`)
+        are returned as a fourth element, e.g. to resume an ingest with a journal.
+
+        With `chunking="tokens"`, chunks are packed up to the maximum sequence length of
+        the embedding model, counted with its tokenizer, and `overlap` is a number of
+        tokens (`chunk_size` is not used). In that mode, or with `report_token_stats`,
+        the number of chunks the encoder truncates or that are mostly padding is
+        printed. Otherwise the tokenizer is not loaded.
         """
+        if chunking not in ("words", "tokens"):
+            raise ValueError(
+                f"Unknown chunking {chunking!r}, expected 'words' or 'tokens'"
+            )
         # Initialize secret keys for different modes of operation
-        num_nodes = len(self.nodes)
-        additive_key = nilql.ClusterKey.generate(
-            {"nodes": [{}] * num_nodes}, {"sum": True}
-        )
-        xor_key = nilql.ClusterKey.generate(
-            {"nodes": [{}] * num_nodes}, {"store": True}
-        )
+        additive_key, xor_key = generate_rag_keys(len(self.nodes))
 
         # Load and process the input file
         paragraphs = load_file(file_path)
-        chunks = create_chunks(paragraphs, chunk_size=chunk_size, overlap=overlap)
+        report_token_stats = report_token_stats or chunking == "tokens"
+        # Loading the tokenizer loads the model, which word chunking does not need
+        tokenizer, max_tokens = (
+            get_tokenizer(backend=self.embedding_backend)
+            if report_token_stats
+            else (None, None)
+        )
+        if chunking == "tokens":
+            chunks = create_token_chunks(paragraphs, tokenizer, max_tokens, overlap)
+        else:
+            chunks = create_chunks(paragraphs, chunk_size=chunk_size, overlap=overlap)
+        if report_token_stats:
+            stats = chunk_token_stats(chunks, tokenizer, max_tokens)
+            print(
+                f"{stats['chunks']} chunks of at most {max_tokens} tokens: "
+                f"{stats['truncated']} truncated ({stats['truncated_tokens']} tokens "
+                f"ignored by the encoder), {stats['padded']} under half the limit, "
+                f"{stats['mean_fill']:.0%} of the limit used on average"
+            )
 
-        # Generate embeddings and chunks
-        embeddings = generate_embeddings_huggingface(chunks)
+        # Generate embeddings, once per distinct chunk and reusing cached ones
+        embeddings = embed_chunks(
+            chunks, cache=self.embedding_cache, backend=self.embedding_backend
+        )
+        if self.embedding_cache is not None:
+            self.embedding_cache.save()
 
         # Encrypt chunks and embeddings
         chunks_shares = [nilql.encrypt(xor_key, chunk) for chunk in chunks]
-        embeddings_shares = [
-            encrypt_float_list(additive_key, embedding) for embedding in embeddings
-        ]
+        embeddings_shares = encrypt_float_array(additive_key, embeddings)
 
+        if return_ids:
+            doc_ids = generate_chunk_ids(chunks, file_path)
+            return embeddings, embeddings_shares, chunks_shares, doc_ids
         return embeddings, embeddings_shares, chunks_shares
 
+    async def get_clusters_data(self) -> List[Dict]:
+        """
+        Read the records of the clusters schema, ordered by cluster index.
+
+        Returns:
+            list[dict]: Records with the `cluster_centroid`, `index` and (if written)
+                `size`, `level` and `parent` of each cluster (empty if no clustering was
+                performed)
+        """
+        # Check if clustering was performed
+        if not self.clusters_schema_id:
+            return []
+        # Read from the first node
+        node = self.nodes[0]
+        schema_id = self.clusters_schema_id
+        data_filter = {}
+        clusters_data = await self.read_from_node(node, schema_id, data_filter)
+        return sorted(clusters_data or [], key=operator.itemgetter("index"))
+
+    async def get_centroids(self) -> Optional[List[List[int]]]:
+        """
+        Read the clusters' centroids, ordered by cluster index.
+
+        In a two-level index, these are the fine centroids, which documents are tagged
+        with.
+
+        Returns:
+            list[list[int]]: Centroids in fixed-point format (None if no clustering was
+                performed)
+        """
+        clusters_data = await self.get_clusters_data()
+        if not clusters_data:
+            # No clusters found
+            return None
+        return [
+            centroid["cluster_centroid"]
+            for centroid in clusters_data
+            if centroid.get("level") != 0
+        ]
+
+    async def get_centroid_matrix(self) -> Optional[CentroidMatrix]:
+        """
+        Return the clusters' centroids as a float32 matrix, from the centroid cache.
+
+        The centroids are read from the first node when they are not cached or expired
+        (see CentroidCache).
+
+        Returns:
+            CentroidMatrix: The centroids (None if no clustering was performed, or if they
+                cannot be read, in which case queries compare against all documents)
+        """
+
+        async def load() -> Optional[CentroidMatrix]:
+            clusters_data = await self.get_clusters_data()
+            return CentroidMatrix.from_records(clusters_data) if clusters_data else None
+
+        try:
+            return await self.centroid_cache.get(load)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            print(f"Error checking clusters and finding closest centroid: {str(e)}")
+            return None
+
     async def get_closest_centroids(
-        self, query_embedding: np.ndarray, num_closest_centroids: int = 1
+        self,
+        query_embedding: np.ndarray,
+        num_closest_centroids: int = 1,
+        probing: AdaptiveProbing | None = None,
+        num_chunks: int = 1,
     ) -> Tuple[int, Optional[List[int]]]:
         """
         Check if clustering was performed and return the number of clusters.
@@ -231,49 +417,63 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         Args:
             query_embedding (np.ndarray): Embedding vector of the query.
             num_closest_centroids (int, optional): Number of closest centroids to return.
+            probing (AdaptiveProbing, optional): Pick the number of closest centroids
+                adaptively instead (`num_closest_centroids` is then ignored).
+            num_chunks (int, optional): Number of chunks the query retrieves, which sets
+                the candidate count targeted by adaptive probing. Defaults to 1.
 
         Returns:
             int: Number of clusters found (0 if no clustering was performed)
             list[int]: List of closest centroids (None if no clustering was performed)
         """
+        return select_closest_centroids(
+            query_embedding,
+            await self.get_centroid_matrix(),
+            num_closest_centroids,
+            probing,
+            num_chunks,
+            self.num_coarse_clusters,
+        )
 
-        try:
-            # Check if clustering was performed
-            if not self.clusters_schema_id:
-                return 0, None
-            # Read from the first node
-            node = self.nodes[0]
-            schema_id = self.clusters_schema_id
-            data_filter = {}
-            clusters_data = await self.read_from_node(node, schema_id, data_filter)
-            if not clusters_data:
-                # No clusters found
-                return 0, None
-            centroids = [centroid["cluster_centroid"] for centroid in clusters_data]
-            indices = [centroid["index"] for centroid in clusters_data]
-            centroids = [centroids[i] for i in indices]
-            closest_centroids = compute_closest_centroids(
-                query_embedding, centroids, num_closest_centroids
-            )
-            return len(clusters_data), closest_centroids
-        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
-            print(f"Error checking clusters and finding closest centroid: {str(e)}")
-            return 0, None
+    @functools.cached_property
+    def query_keys(self) -> tuple:
+        """
+        Keys used to secret share queries and decrypt results, generated once per vault.
+
+        Cluster keys hold no cryptographic material, only the number of nodes and the
+        operation, so the same keys serve every query.
+
+        Returns:
+            tuple: (summation-compatible key for the embeddings, storage key for the chunks)
+        """
+        return generate_rag_keys(len(self.nodes))
+
+    def cache_hit_rates(self) -> Dict[str, str]:
+        """Return the hit rates of the token and centroid caches, for benchmarks."""
+        return {
+            "token cache hit rate": f"{self.token_cache.hit_rate:.0%}",
+            "centroid cache hit rate": f"{self.centroid_cache.hit_rate:.0%}",
+        }
 
     # pylint: disable=too-many-locals
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
     async def top_num_chunks_execute(
         self,
         query: str,
         num_chunks: int,
         enable_benchmark: bool = False,
         num_clusters: int = 1,
+        probing: AdaptiveProbing | None = None,
     ) -> List:
         """
         Retrieves the top `num_chunks` most relevant data chunks for a given query.
 
-        It performs the following steps:
-        1. Generates embeddings for the input query.
-        2. Encrypts the query embeddings.
+        The steps run as a dependency graph, each as soon as its inputs are ready, so
+        that independent steps overlap:
+        1. Generates embeddings for the input query, while the clusters' centroids are
+        read from the first node.
+        2. Encrypts the query embeddings, and selects the closest centroids.
         3. Computes the difference between the encrypted query embeddings and stored data
         embeddings.
         4. Decrypts the differences to compute distances.
@@ -283,132 +483,306 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         Args:
             query (str): The input query string for which relevant data chunks are to be retrieved.
             num_chunks (int): The number of top relevant data chunks to retrieve.
-            enable_benchmark (bool, optional): Whether to benchmark the process. Defaults to False.
+            enable_benchmark (bool, optional): Whether to print the time of each step.
+                Defaults to False.
             num_clusters (int, optional): The number of clusters to consider. Defaults to 1.
+            probing (AdaptiveProbing, optional): Pick the number of clusters to consider
+                adaptively instead. Defaults to None.
 
         Returns:
-            List[Dict[str, Any]]: A list of dictionaries, each containing:
-                - `_id` (Any): The unique identifier of the data chunk.
-                - `distances` (float): The computed distance between the query and the data chunk.
+            str: The relevant context formatted from the top chunks.
         """
         # Check the input format
         if query is None and not isinstance(query, str):
             raise TypeError("Prompt must be a string")
 
-        # Initialize secret keys
-        num_parties = len(self.nodes)
-        additive_key = nilql.ClusterKey.generate(
-            {"nodes": [{}] * num_parties}, {"sum": True}
-        )
-        xor_key = nilql.ClusterKey.generate(
-            {"nodes": [{}] * num_parties}, {"store": True}
-        )
-        # Step 1: Encrypt query embedding and get closest centroid
+        additive_key, xor_key = self.query_keys
         # Note: one string query is assumed.
-        # 1.1 Generate query embedding
-        query_embedding, generate_query_embedding_time_sec = benchmark_time(
-            generate_embeddings_huggingface, query, enable=enable_benchmark
-        )
-
-        # 1.2 Check if clustering was performed and (if existing) get the closest centroids
-        (
-            num_clusters,
-            closest_centroids,
-        ), cluster_check_and_get_closest_centroid_time_sec = await benchmark_time_async(
-            self.get_closest_centroids,
-            query_embedding,
-            num_clusters,
-            enable=enable_benchmark,
-        )
-
-        # 1.3 Encrypt query embedding
-        nilql_query_embedding, encrypt_query_embedding_time_sec = benchmark_time(
-            encrypt_float_list, additive_key, query_embedding, enable=enable_benchmark
-        )
-
-        # Step 2: Ask NilDB to compute the differences
-        difference_shares_by_id, asking_nildb_time_sec = await benchmark_time_async(
-            self.execute_subtract_query,
-            nilql_query_embedding,
-            closest_centroids,
-            enable=enable_benchmark,
-        )
-
-        # Step 3: Compute distances and sort
-        # 3.1 Transpose the lists for each _id
-        difference_shares_by_id, transpose_list_time_sec = benchmark_time(
-            lambda: {
-                id: list(map(list, zip(*differences)))
-                for id, differences in difference_shares_by_id.items()
-            },
-            enable=enable_benchmark,
-        )
+        stages = {
+            # 1. Embed the query while the centroids are read (network I/O)
+            "generate query embedding": (
+                lambda: self.run_cpu(
+                    generate_embeddings_huggingface,
+                    query,
+                    backend=self.embedding_backend,
+                ),
+                (),
+            ),
+            "get centroids": (self.get_centroid_matrix, ()),
+            # 2. Encrypt the query embedding and (if existing) get the closest centroids
+            "encrypt query embedding": (
+                functools.partial(self.run_cpu, encrypt_float_list, additive_key),
+                ("generate query embedding",),
+            ),
+            "get closest centroids": (
+                lambda embedding, centroids: select_closest_centroids(
+                    embedding,
+                    centroids,
+                    num_clusters,
+                    probing,
+                    num_chunks,
+                    self.num_coarse_clusters,
+                ),
+                ("generate query embedding", "get centroids"),
+            ),
+            # 3. Ask NilDB to compute the differences
+            "ask nilDB to compute the differences": (
+                lambda query_shares, closest: self.execute_subtract_query_on_nodes(
+                    query_shares, closest[1]
+                ),
+                ("encrypt query embedding", "get closest centroids"),
+            ),
+            # 4. Load the shares of every node into a (n_nodes, n_docs, dim) array,
+            # reconstruct the differences and compute distances
+            "load shares": (
+                lambda shares_per_node: self.run_cpu(
+                    stack_shares_by_id,
+                    shares_per_node,
+                    operator.itemgetter("difference"),
+                ),
+                ("ask nilDB to compute the differences",),
+            ),
+            "decrypt": (
+                lambda shares: self.run_cpu(decrypt_distances, additive_key, shares[1]),
+                ("load shares",),
+            ),
+            # 5. Select the top num_chunks ids without sorting every candidate, query
+            # and decrypt their chunks
+            "get top chunks ids": (
+                lambda shares, distances: [
+                    shares[0][idx] for idx in top_k_indices(distances, num_chunks)
+                ],
+                ("load shares", "decrypt"),
+            ),
+            "query top chunks": (self.read_chunk_from_nodes, ("get top chunks ids",)),
+            "decrypt top chunks": (
+                functools.partial(self.run_cpu, decrypt_chunk_shares, xor_key),
+                ("query top chunks",),
+            ),
+            # In rank order, whatever the order in which the nodes return the chunks
+            "format top num chunks": (
+                lambda top_ids, chunks_by_id: format_relevant_context(
+                    [chunks_by_id[id] for id in top_ids if id in chunks_by_id]
+                ),
+                ("get top chunks ids", "decrypt top chunks"),
+            ),
+        }
+        start_time = time.perf_counter()
+        results, timings = await run_graph(stages)
+        total_time_sec = time.perf_counter() - start_time
+        relevant_context = results["format top num chunks"]
 
-        # 3.2 Decrypt and compute distances
-        reconstructed, decrypt_time_sec = benchmark_time(
-            lambda: [
+        # Print benchmarks, if enabled
+        if enable_benchmark:
+            print_query_breakdown(
+                "Performance breakdown. Time to:",
+                timings,
+                total_time_sec,
                 {
-                    "_id": id,
-                    "distances": np.linalg.norm(
-                        decrypt_float_list(additive_key, difference_shares)
+                    "Number of clusters found": results["get closest centroids"][0],
+                    "Number of clusters probed": len(
+                        results["get closest centroids"][1] or []
                     ),
-                }
-                for id, difference_shares in difference_shares_by_id.items()
-            ],
-            enable=enable_benchmark,
-        )
-        # 3.3 Sort id list based on the corresponding distances
-        sorted_ids = sorted(reconstructed, key=lambda x: x["distances"])
-
-        # Step 4: Query the top num_chunks
-        top_num_chunks_ids, top_num_chunks_ids_time_sec = benchmark_time(
-            lambda: [item["_id"] for item in sorted_ids[:num_chunks]],
-            enable=enable_benchmark,
-        )
+                    **self.cache_hit_rates(),
+                },
+            )
+        return relevant_context
 
-        # 4.1 Query top num_chunks
-        chunk_shares, query_top_chunks_time_sec = await benchmark_time_async(
-            self.read_chunk_from_nodes, top_num_chunks_ids, enable=enable_benchmark
-        )
+    # pylint: disable=too-many-locals
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    async def top_num_chunks_execute_batch(
+        self,
+        queries: List[str],
+        num_chunks: int,
+        enable_benchmark: bool = False,
+        num_clusters: int = 1,
+        probing: AdaptiveProbing | None = None,
+    ) -> List[str]:
+        """
+        Retrieves the top `num_chunks` most relevant data chunks for each of several queries,
+        with one round trip to the nilDB nodes for the differences and one for the chunks.
+
+        The steps run as a dependency graph, like in `top_num_chunks_execute`:
+        1. Generates the embeddings of all queries in one encoder batch, while the
+        clusters' centroids are read from the first node.
+        2. Encrypts the query embeddings, and selects the closest centroids of each query.
+        3. Computes, in a single query execution per node, the difference between every
+        encrypted query embedding and the stored data embeddings.
+        4. Decrypts the differences and ranks the documents separately for each query.
+        5. Retrieves the union of the top `num_chunks` data chunks of all queries in one read.
 
-        # 4.2 Group chunk shares by ID
-        chunk_shares_by_id = group_shares_by_id(
-            chunk_shares,  # type: ignore
-            lambda share: share["chunk"],
-        )
+        Args:
+            queries (list[str]): The input query strings.
+            num_chunks (int): The number of top relevant data chunks to retrieve per query.
+            enable_benchmark (bool, optional): Whether to benchmark the process. Defaults to False.
+            num_clusters (int, optional): The number of clusters to consider per query.
+                Defaults to 1.
+            probing (AdaptiveProbing, optional): Pick the number of clusters to consider
+                adaptively for each query instead. Defaults to None.
 
-        # 4.3 Decrypt chunks
-        top_num_chunks = [
-            {"_id": id, "chunks": nilql.decrypt(xor_key, chunk_shares)}
-            for id, chunk_shares in chunk_shares_by_id.items()
-        ]
-        # 5: Format top results
-        formatted_results, formatted_results_time_sec = benchmark_time(
-            lambda: "\n".join(
-                f"- {str(result['chunks'])}" for result in top_num_chunks
+        Returns:
+            list[str]: The relevant context of each query, in the order of `queries`.
+        """
+        # Check the input format
+        if not isinstance(queries, list) or not all(
+            isinstance(query, str) for query in queries
+        ):
+            raise TypeError("Prompts must be a list of strings")
+        if not queries:
+            return []
+
+        additive_key, xor_key = self.query_keys
+
+        def closest_centroids_of_queries(query_embeddings, centroids) -> tuple:
+            if centroids is None:
+                return None, None
+            closest_centroids = [
+                select_closest_centroids(
+                    query_embedding,
+                    centroids,
+                    num_clusters,
+                    probing,
+                    num_chunks,
+                    self.num_coarse_clusters,
+                )[1]
+                for query_embedding in query_embeddings
+            ]
+            all_closest_centroids = sorted(
+                {int(c) for closest in closest_centroids for c in closest}
+            )
+            return closest_centroids, all_closest_centroids
+
+        def rank_queries(
+            difference_shares_per_node, shares, distances, closest
+        ) -> List[List[str]]:
+            ids, closest_centroids = shares[0], closest[0]
+            if not ids:
+                distances = np.empty((0, len(queries)))
+            if closest_centroids is not None:
+                doc_clusters = {
+                    share["_id"]: share.get("cluster_centroid")
+                    for share in difference_shares_per_node[0]
+                }
+                doc_clusters = np.array([doc_clusters[id] for id in ids])
+            top_ids = []
+            for query_idx in range(len(queries)):
+                query_distances = distances[:, query_idx]
+                if closest_centroids is not None:
+                    # Only consider the documents of this query's closest clusters
+                    query_distances = np.where(
+                        np.isin(doc_clusters, closest_centroids[query_idx]),
+                        query_distances,
+                        np.inf,
+                    )
+                top_ids.append(
+                    [
+                        ids[idx]
+                        for idx in top_k_indices(query_distances, num_chunks)
+                        if np.isfinite(query_distances[idx])
+                    ]
+                )
+            return top_ids
+
+        stages = {
+            # 1. Embed all queries in one batch while the centroids are read once
+            "generate query embeddings": (
+                lambda: self.run_cpu(
+                    generate_embeddings_huggingface,
+                    queries,
+                    backend=self.embedding_backend,
+                ),
+                (),
             ),
-            enable=enable_benchmark,
-        )
-        relevant_context = f"\n\nRelevant Context:\n{formatted_results}"
+            "get centroids": (self.get_centroid_matrix, ()),
+            # 2. Encrypt query embeddings: (n_queries, dim, n_nodes), and get the
+            # closest centroids of each query
+            "encrypt query embeddings": (
+                functools.partial(self.run_cpu, encrypt_float_array, additive_key),
+                ("generate query embeddings",),
+            ),
+            "get closest centroids": (
+                closest_centroids_of_queries,
+                ("generate query embeddings", "get centroids"),
+            ),
+            # 3. Ask NilDB to compute the differences for all queries at once
+            "ask nilDB to compute the differences": (
+                lambda query_shares, closest: self.execute_batch_subtract_query_on_nodes(
+                    query_shares, closest[1]
+                ),
+                ("encrypt query embeddings", "get closest centroids"),
+            ),
+            # 4. Compute distances: (n_docs, n_queries), and rank the documents
+            # separately for each query
+            "load shares": (
+                lambda shares_per_node: self.run_cpu(
+                    stack_shares_by_id,
+                    shares_per_node,
+                    operator.itemgetter("differences"),
+                ),
+                ("ask nilDB to compute the differences",),
+            ),
+            "decrypt": (
+                lambda shares: self.run_cpu(decrypt_distances, additive_key, shares[1]),
+                ("load shares",),
+            ),
+            "get top chunks ids": (
+                rank_queries,
+                (
+                    "ask nilDB to compute the differences",
+                    "load shares",
+                    "decrypt",
+                    "get closest centroids",
+                ),
+            ),
+            # 5. Query the union of the top chunks of all queries, decrypt each chunk
+            # once and format the results of each query
+            "query top chunks": (
+                lambda top_ids: self.read_chunk_from_nodes(
+                    list(dict.fromkeys(id for ids in top_ids for id in ids))
+                ),
+                ("get top chunks ids",),
+            ),
+            "decrypt top chunks": (
+                functools.partial(self.run_cpu, decrypt_chunk_shares, xor_key),
+                ("query top chunks",),
+            ),
+            "format top num chunks": (
+                lambda top_ids, chunks_by_id: [
+                    format_relevant_context(
+                        [chunks_by_id[id] for id in ids if id in chunks_by_id]
+                    )
+                    for ids in top_ids
+                ],
+                ("get top chunks ids", "decrypt top chunks"),
+            ),
+        }
+        start_time = time.perf_counter()
+        results, timings = await run_graph(stages)
+        total_time_sec = time.perf_counter() - start_time
+        relevant_contexts = results["format top num chunks"]
 
         # Print benchmarks, if enabled
         if enable_benchmark:
-            print(
-                f"""Performance breakdown. Time to:\
-            \n generate query embedding: {generate_query_embedding_time_sec:.2f} seconds \
-            \n check clustering and (if existing) get closest centroid:\
-                {cluster_check_and_get_closest_centroid_time_sec:.2f} seconds\
-            \n Number of clusters found: {num_clusters}\
-            \n encrypt query embedding: {encrypt_query_embedding_time_sec:.2f} seconds\
-            \n ask nilDB to compute the differences: {asking_nildb_time_sec:.2f} seconds\
-            \n transpose list: {transpose_list_time_sec:.2f} seconds\
-            \n decrypt: {decrypt_time_sec:.2f} seconds\
-            \n get top chunks ids: {top_num_chunks_ids_time_sec:.2f} seconds\
-            \n query top chunks: {query_top_chunks_time_sec:.2f} seconds\
-            \n format top num chunks: {formatted_results_time_sec:.2f} seconds\
-            """
+            centroids = results["get centroids"]
+            closest_centroids = results["get closest centroids"][0]
+            print_query_breakdown(
+                f"Performance breakdown for {len(queries)} queries. Time to:",
+                timings,
+                total_time_sec,
+                {
+                    "Number of clusters found": (
+                        len(centroids.matrix) if centroids is not None else 0
+                    ),
+                    "Number of clusters probed per query": (
+                        f"{np.mean([len(c) for c in closest_centroids]):.1f}"
+                        if closest_centroids
+                        else 0
+                    ),
+                    **self.cache_hit_rates(),
+                },
             )
-        return relevant_context
+        return relevant_contexts
 
     def nilai_chat_completion(
         self,
@@ -417,6 +791,33 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
         """
         Query the chat completion endpoint of the nilai API.
 
+        This blocking call runs `nilai_chat_completion_async` in a new event loop and
+        closes the vault's HTTP session when done. From async code, await
+        `nilai_chat_completion_async` instead, which reuses the pooled session.
+
+        Args:
+            config (ChatCompletionConfig): Configuration for the chat completion request
+
+        Returns:
+            dict: Chat response from the nilai API
+        """
+
+        async def run() -> dict:
+            try:
+                return await self.nilai_chat_completion_async(config)
+            finally:
+                await self.aclose()
+
+        return asyncio.run(run())
+
+    async def nilai_chat_completion_async(
+        self,
+        config: ChatCompletionConfig,
+    ) -> dict:
+        """
+        Query the chat completion endpoint of the nilai API, through the vault's pooled
+        HTTP session.
+
         Args:
             config (ChatCompletionConfig): Configuration for the chat completion request
 
@@ -457,6 +858,9 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
             "clusters_schema_id": self.clusters_schema_id,
             "subtract_query_id": self.subtract_query_id,
         }
+        # Only sent when set, for servers that reject unknown fields
+        if self.batch_subtract_query_id:
+            nilrag["batch_subtract_query_id"] = self.batch_subtract_query_id
         # Construct payload
         payload = {
             "model": config.model,
@@ -470,19 +874,23 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
             # Send POST request
             print("Sending request to nilai API...")
             request_start = time.time()
-            response = requests.post(
-                nilai_url, headers=headers, json=payload, timeout=TIMEOUT
-            )
+            session = await self.get_session()
+            async with session.post(
+                nilai_url,
+                headers=headers,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+            ) as response:
+                # Handle response
+                if response.status != 200:
+                    raise ValueError(
+                        f"Error in POST request: {response.status}, {await response.text()}"
+                    )
+                result = await response.json()
             request_time = time.time() - request_start
-            # Handle response
-            if response.status_code != 200:
-                raise ValueError(
-                    f"Error in POST request: {response.status_code}, {response.text}"
-                )
-            result = response.json()
             # Debug print response details
             print("Response details:")
-            print(f"Status code: {response.status_code}")
+            print(f"Status code: {response.status}")
             if "usage" in result:
                 print(f"Tokens used: {result['usage']['total_tokens']}")
             # Check if we have access to the number of documents processed
@@ -504,6 +912,82 @@ class RAGVault(SecretVaultWrapper, NilDBInit, NilDBOps):
             ) from e
 
 
+def format_relevant_context(chunks: List[str]) -> str:
+    """
+    Format retrieved chunks as the relevant context appended to a prompt.
+
+    Args:
+        chunks (list): The retrieved chunks
+
+    Returns:
+        str: The relevant context
+    """
+    formatted_results = "\n".join(f"- {str(chunk)}" for chunk in chunks)
+    return f"\n\nRelevant Context:\n{formatted_results}"
+
+
+def print_query_breakdown(
+    title: str,
+    timings: Dict[str, float],
+    total_time_sec: float,
+    details: Dict[str, object],
+) -> None:
+    """
+    Print the time of each step of a query, the end-to-end time and other details.
+
+    Steps overlap, so the end-to-end time is less than the sum of the steps: it is the
+    time of the longest chain of dependent steps (the critical path).
+    """
+    lines = [title]
+    lines += [f" {step}: {seconds:.2f} seconds" for step, seconds in timings.items()]
+    lines.append(
+        f" end to end: {total_time_sec:.2f} seconds "
+        f"(sum of steps: {sum(timings.values()):.2f} seconds)"
+    )
+    lines += [f" {name}: {value}" for name, value in details.items()]
+    print("\n".join(lines))
+
+
+def decrypt_distances(additive_key, difference_shares: np.ndarray) -> np.ndarray:
+    """
+    Reconstruct differences from their shares and return their Euclidean norms.
+
+    Defined at module level so that it can run in a process pool.
+
+    Args:
+        additive_key: Summation-compatible key of the query embeddings
+        difference_shares (np.ndarray): Shares of shape (n_nodes, ..., dim)
+
+    Returns:
+        np.ndarray: Distances, of the shape of the shares without the first and last axes
+            (empty if there are no shares)
+    """
+    if difference_shares.size == 0:
+        return np.empty(0)
+    return np.linalg.norm(
+        decrypt_float_array(additive_key, difference_shares, axis=0), axis=-1
+    )
+
+
+def decrypt_chunk_shares(xor_key, chunk_shares: list) -> Dict[str, str]:
+    """
+    Group the chunk shares read from every node by ID and decrypt each chunk.
+
+    Defined at module level so that it can run in a process pool.
+
+    Args:
+        xor_key: Storage key of the chunks
+        chunk_shares (list): Records read from each node
+
+    Returns:
+        dict: Decrypted chunk of each ID
+    """
+    chunk_shares_by_id = group_shares_by_id(chunk_shares, operator.itemgetter("chunk"))
+    return {
+        id: nilql.decrypt(xor_key, shares) for id, shares in chunk_shares_by_id.items()
+    }
+
+
 def euclidean_distance(
     a: Union[List[int], np.ndarray], b: Union[List[int], np.ndarray]
 ):
@@ -536,31 +1020,4 @@ def find_closest_chunks(
         list: List of tuples (chunk, distance) for the top_k closest chunks
     """
     distances = [euclidean_distance(query_embedding, emb) for emb in embeddings]
-    sorted_indices = np.argsort(distances)
-    return [(chunks[idx], distances[idx]) for idx in sorted_indices[:top_k]]
-
-
-def compute_closest_centroids(
-    query_embedding: np.ndarray, centroids: List[List[int]], num_closest_centroids: int
-) -> List[int]:
-    """
-    Find the k closest centroids for a given query embedding.
-
-    Args:
-        query_embedding (np.ndarray): The embedding vector of the query in floating-point format
-        centroids (list): List of centroid vectors in fixed-point format
-        num_closest_centroids (int): Number of closest centroids to return.
-
-    Returns:
-        list[int]: The indices of the closest centroids
-    """
-    # Find closest centroids
-    closest = sorted(
-        range(len(centroids)),
-        key=lambda i: euclidean_distance(
-            query_embedding, from_fixed_point(np.array(centroids[i]))
-        ),
-    )
-
-    # Take top closest
-    return closest[:num_closest_centroids]
+    return [(chunks[idx], distances[idx]) for idx in top_k_indices(distances, top_k)]
@@ -0,0 +1,104 @@
+"""
+This module provides an adaptive batcher that sizes upload batches by payload bytes and
+adjusts the size from the observed node latency and errors.
+"""
+
+import asyncio
+import json
+from typing import Any, Dict, List, Sequence
+
+# HTTP status returned by nodes when a request body is too large
+PAYLOAD_TOO_LARGE = 413
+DEFAULT_TARGET_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def json_size(entry: Dict[str, Any]) -> int:
+    """Return the size in bytes of `entry` once serialized as JSON."""
+    return len(json.dumps(entry).encode())
+
+
+# pylint: disable=too-many-instance-attributes
+class AdaptiveBatcher:
+    """
+    Splits documents into batches whose payload stays close to a byte budget.
+
+    The budget starts at `target_bytes`. It is halved when a node rejects a batch as too
+    large (HTTP 413) or times out, and grows by `growth` after batches that all nodes
+    acknowledged within `fast_latency` seconds, never beyond the target or the size of a
+    payload that was rejected. Batches slower than `slow_latency` seconds shrink it by
+    the same factor.
+    """
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def __init__(
+        self,
+        target_bytes: int = DEFAULT_TARGET_BATCH_BYTES,
+        min_bytes: int = 1024,
+        fast_latency: float = 2.0,
+        slow_latency: float = 20.0,
+        growth: float = 1.5,
+    ):
+        if target_bytes < 1:
+            raise ValueError("target_bytes must be at least 1")
+        if growth <= 1:
+            raise ValueError("growth must be greater than 1")
+        self.target_bytes = target_bytes
+        self.min_bytes = min(min_bytes, target_bytes)
+        self.fast_latency = fast_latency
+        self.slow_latency = slow_latency
+        self.growth = growth
+        self.budget = target_bytes
+        # Largest budget allowed: lowered below the size of any rejected payload
+        self.ceiling = target_bytes
+        self.sizes: List[int] = []
+
+    @staticmethod
+    def should_split(error: BaseException) -> bool:
+        """Whether `error` means the batch should be retried in smaller parts."""
+        if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+            return True
+        # Node errors (NodeRequestError) carry the HTTP status of the response
+        return getattr(error, "status", None) == PAYLOAD_TOO_LARGE
+
+    def next_batch(self, doc_sizes: Sequence[int], start: int) -> int:
+        """
+        Return the end of the next batch starting at document `start`.
+
+        Args:
+            doc_sizes (list[int]): Serialized size in bytes of every document.
+            start (int): Index of the first document of the batch.
+
+        Returns:
+            int: Index one past the last document of the batch; the batch holds at least
+                one document even if it exceeds the budget.
+        """
+        end = start + 1
+        payload = doc_sizes[start]
+        while end < len(doc_sizes) and payload + doc_sizes[end] <= self.budget:
+            payload += doc_sizes[end]
+            end += 1
+        self.sizes.append(end - start)
+        return end
+
+    def record_success(self, latency: float) -> None:
+        """Adapt the budget after a batch every node acknowledged in `latency` seconds."""
+        if latency <= self.fast_latency:
+            self.budget = min(int(self.budget * self.growth), self.ceiling)
+        elif latency >= self.slow_latency:
+            self.budget = max(int(self.budget / self.growth), self.min_bytes)
+
+    def record_failure(self, payload_bytes: int, error: BaseException) -> None:
+        """Halve the budget after a batch of `payload_bytes` was rejected or timed out."""
+        if getattr(error, "status", None) == PAYLOAD_TOO_LARGE:
+            self.ceiling = max(min(self.ceiling, payload_bytes - 1), self.min_bytes)
+        self.budget = max(min(self.budget, payload_bytes) // 2, self.min_bytes)
+
+    def summary(self) -> str:
+        """Describe the batch sizes chosen so far."""
+        if not self.sizes:
+            return "no batches"
+        return (
+            f"{len(self.sizes)} batches, {min(self.sizes)}-{max(self.sizes)} documents "
+            f"per batch, budget now {self.budget / 1024:.0f} KiB"
+        )
@@ -0,0 +1,100 @@
+"""
+This module provides the embedding backends, i.e. the runtimes the embedding models are
+loaded with: PyTorch, or ONNX Runtime in full precision or int8-quantized for CPU-only
+hosts.
+"""
+
+import platform
+from typing import Callable, Dict
+
+DEFAULT_BACKEND = "torch"
+
+# Int8-quantized exports shipped with the sentence-transformers models, by CPU family
+ONNX_INT8_FILE_NAMES = {
+    "arm64": "onnx/model_qint8_arm64.onnx",
+    "aarch64": "onnx/model_qint8_arm64.onnx",
+}
+DEFAULT_ONNX_INT8_FILE_NAME = "onnx/model_quint8_avx2.onnx"
+
+
+def load_torch_model(model_name: str):
+    """Load a SentenceTransformer model with PyTorch."""
+    # Imported on first use: sentence_transformers pulls in torch, which takes seconds
+    # pylint: disable=import-outside-toplevel
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name)
+
+
+def load_onnx_model(model_name: str):
+    """Load a SentenceTransformer model with ONNX Runtime, in full precision."""
+    # pylint: disable=import-outside-toplevel
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(
+        model_name, backend="onnx", model_kwargs={"file_name": "onnx/model.onnx"}
+    )
+
+
+def load_onnx_int8_model(model_name: str):
+    """
+    Load a SentenceTransformer model with ONNX Runtime, quantized to int8 for the CPU.
+
+    The quantized export matching the CPU family (ARM64 or AVX2) is used.
+    """
+    # pylint: disable=import-outside-toplevel
+    from sentence_transformers import SentenceTransformer
+
+    file_name = ONNX_INT8_FILE_NAMES.get(
+        platform.machine().lower(), DEFAULT_ONNX_INT8_FILE_NAME
+    )
+    return SentenceTransformer(
+        model_name,
+        backend="onnx",
+        device="cpu",
+        model_kwargs={"file_name": file_name, "provider": "CPUExecutionProvider"},
+    )
+
+
+EMBEDDING_BACKENDS: Dict[str, Callable[[str], object]] = {
+    "torch": load_torch_model,
+    "onnx": load_onnx_model,
+    "onnx-int8": load_onnx_int8_model,
+}
+
+
+def register_backend(name: str, loader: Callable[[str], object]) -> None:
+    """
+    Register an embedding backend.
+
+    Args:
+        name (str): Name of the backend, e.g. "openvino".
+        loader (callable): Function loading a model by name; the model must provide
+            `encode(texts, convert_to_tensor=False)` like a SentenceTransformer.
+    """
+    EMBEDDING_BACKENDS[name] = loader
+
+
+def get_backend_loader(backend: str) -> Callable[[str], object]:
+    """
+    Return the model loader of `backend`.
+
+    Raises:
+        ValueError: If the backend is not registered
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(
+            f"Unknown embedding backend {backend!r}, "
+            f"expected one of {sorted(EMBEDDING_BACKENDS)}"
+        )
+    return EMBEDDING_BACKENDS[backend]
+
+
+def model_key(model_name: str, backend: str = DEFAULT_BACKEND) -> str:
+    """
+    Return the key of a model loaded with a backend, e.g. in the model registry.
+
+    Models of the default backend are keyed by their name alone, so that the keys (and
+    the embedding cache entries) of existing deployments stay valid.
+    """
+    return model_name if backend == DEFAULT_BACKEND else f"{model_name}@{backend}"
@@ -0,0 +1,238 @@
+"""
+This module provides a persistent, content-addressed cache of chunk embeddings, so that
+re-ingesting a corpus only embeds the chunks that changed.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 1_000_000
+# Number of slots of a new store file, doubled whenever it is full up to `max_entries`
+INITIAL_CAPACITY = 1024
+
+
+def text_key(text: str) -> bytes:
+    """Return the cache key of a chunk, i.e. the SHA-256 digest of its text."""
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+# pylint: disable=too-many-instance-attributes
+class _ModelStore:
+    """
+    Bounded store of the embeddings of one model.
+
+    Records (key, vector) live in a memory-mapped file, so the index is rebuilt from the
+    file itself. The file starts with a few slots and doubles when full, up to
+    `max_entries` slots, after which entries are evicted. Evicting an entry clears its
+    key, and a new key is written after its vector, so a process stopped mid-write
+    leaves an empty slot rather than a key with the vector of another entry. The
+    last-use ticks used for LRU eviction are kept next to it.
+    """
+
+    def __init__(self, prefix: str, dim: int, max_entries: int):
+        self.dim = dim
+        self.max_entries = max_entries
+        self.dtype = np.dtype([("key", "u1", (32,)), ("vector", "<f4", (dim,))])
+        self.path = prefix + ".emb"
+        self.lru_path = prefix + ".lru.npy"
+        if not os.path.exists(self.path):
+            # Empty slots hold zero keys
+            with open(self.path, "wb") as f:
+                f.truncate(min(INITIAL_CAPACITY, max_entries) * self.dtype.itemsize)
+        capacity = min(os.path.getsize(self.path) // self.dtype.itemsize, max_entries)
+        self.records = np.memmap(
+            self.path, dtype=self.dtype, mode="r+", shape=(capacity,)
+        )
+        keys = np.asarray(self.records["key"])
+        occupied = keys.any(axis=1)
+        self.index: Dict[bytes, int] = {
+            keys[slot].tobytes(): int(slot) for slot in np.flatnonzero(occupied)
+        }
+        self.free: List[int] = np.flatnonzero(~occupied)[::-1].tolist()
+        self.ticks = np.zeros(capacity, dtype=np.int64)
+        if os.path.exists(self.lru_path):
+            ticks = np.load(self.lru_path)
+            if ticks.shape == self.ticks.shape:
+                self.ticks = ticks
+        self.clock = int(self.ticks.max(initial=0))
+
+    def grow(self, num_entries: int) -> None:
+        """Make room for `num_entries` entries, doubling the file up to `max_entries`."""
+        capacity = len(self.records)
+        new_capacity = min(max(num_entries, 2 * capacity), self.max_entries)
+        if new_capacity <= capacity:
+            return
+        self.records.flush()
+        del self.records
+        with open(self.path, "r+b") as f:
+            f.truncate(new_capacity * self.dtype.itemsize)
+        self.records = np.memmap(
+            self.path, dtype=self.dtype, mode="r+", shape=(new_capacity,)
+        )
+        self.free = list(range(new_capacity - 1, capacity - 1, -1)) + self.free
+        self.ticks = np.concatenate(
+            [self.ticks, np.zeros(new_capacity - capacity, dtype=np.int64)]
+        )
+
+    def get(self, keys: Sequence[bytes]) -> List[Optional[np.ndarray]]:
+        """Return the vector of each key, or None if it is not cached."""
+        self.clock += 1
+        vectors = []
+        for key in keys:
+            slot = self.index.get(key)
+            if slot is None:
+                vectors.append(None)
+            else:
+                self.ticks[slot] = self.clock
+                vectors.append(np.array(self.records["vector"][slot]))
+        return vectors
+
+    def put(self, keys: Sequence[bytes], vectors: np.ndarray) -> None:
+        """Store vectors, evicting the least recently used entries if full."""
+        self.clock += 1
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self.index]
+        if len(new_keys) > len(self.free):
+            self.grow(len(self.index) + len(new_keys))
+        occupied = np.fromiter(self.index.values(), dtype=np.int64)
+        missing_slots = min(len(new_keys) - len(self.free), len(occupied))
+        if missing_slots > 0:
+            evict = occupied[
+                np.argpartition(self.ticks[occupied], missing_slots - 1)[:missing_slots]
+            ]
+            for slot in evict.tolist():
+                del self.index[self.records["key"][slot].tobytes()]
+                self.records["key"][slot] = 0
+                self.free.append(slot)
+        for key, vector in zip(keys, vectors):
+            slot = self.index.get(key)
+            if slot is None:
+                if not self.free:
+                    # More distinct keys in one call than the capacity
+                    continue
+                slot = self.free.pop()
+                self.index[key] = slot
+                self.records["vector"][slot] = vector
+                # The key last: the slot only becomes valid with its vector written
+                self.records["key"][slot] = np.frombuffer(key, dtype=np.uint8)
+            else:
+                self.records["vector"][slot] = vector
+            self.ticks[slot] = self.clock
+
+    def save(self) -> None:
+        """Flush the records and persist the LRU ticks."""
+        self.records.flush()
+        tmp_path = self.lru_path + ".tmp.npy"
+        np.save(tmp_path, self.ticks)
+        os.replace(tmp_path, self.lru_path)
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings keyed by (model name, SHA-256 of the chunk text).
+
+    Each model has its own memory-mapped file of at most `max_entries` float32 vectors,
+    which grows with the number of entries; once full, the least recently used entries
+    are evicted. Call `save()` to persist the recency information (done by the ingestion
+    functions after each run).
+
+    The cache is meant for one process at a time: processes sharing a directory would
+    each keep their own index and free slots, and overwrite each other's entries.
+    """
+
+    def __init__(self, directory: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_entries = max_entries
+        self._stores: Dict[str, _ModelStore] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, model_name: str, dim: int | None) -> Optional[_ModelStore]:
+        """Open the store of `model_name`, creating it if `dim` is given."""
+        if model_name in self._stores:
+            return self._stores[model_name]
+        prefix = os.path.join(
+            self.directory, hashlib.sha256(model_name.encode()).hexdigest()[:16]
+        )
+        meta_path = prefix + ".json"
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["max_entries"] != self.max_entries:
+                raise ValueError(
+                    f"Embedding cache {self.directory} holds {meta['max_entries']} "
+                    f"entries per model, not {self.max_entries}"
+                )
+            dim = meta["dim"]
+        elif dim is None:
+            return None
+        else:
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"model": model_name, "dim": dim, "max_entries": self.max_entries},
+                    f,
+                    indent=4,
+                )
+        self._stores[model_name] = _ModelStore(prefix, dim, self.max_entries)
+        return self._stores[model_name]
+
+    def get(self, model_name: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up the embeddings of `texts`.
+
+        Args:
+            model_name (str): Name of the embedding model.
+            texts (list[str]): Chunk texts.
+
+        Returns:
+            list: The cached embedding of each text, or None if it is not cached.
+        """
+        with self._lock:
+            store = self._store(model_name, None)
+            if store is None:
+                vectors = [None] * len(texts)
+            else:
+                vectors = store.get([text_key(text) for text in texts])
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(texts) - hits
+            return vectors
+
+    def put(self, model_name: str, texts: Sequence[str], embeddings) -> None:
+        """
+        Store the embeddings of `texts`.
+
+        Args:
+            model_name (str): Name of the embedding model.
+            texts (list[str]): Chunk texts.
+            embeddings (array): Embeddings of the texts, of shape (len(texts), dim).
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if not texts:
+            return
+        with self._lock:
+            store = self._store(model_name, embeddings.shape[1])
+            if store.dim != embeddings.shape[1]:
+                raise ValueError(
+                    f"Embeddings of {model_name} have {store.dim} dimensions, "
+                    f"not {embeddings.shape[1]}"
+                )
+            store.put([text_key(text) for text in texts], embeddings)
+
+    def save(self) -> None:
+        """Persist the cache to disk."""
+        with self._lock:
+            for store in self._stores.values():
+                store.save()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(store.index) for store in self._stores.values())
@@ -0,0 +1,148 @@
+"""
+This module provides an on-disk journal of upload progress, so that an interrupted ingest
+can be resumed without uploading the committed documents again.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Sequence
+
+
+def ingest_fingerprint(
+    schema_id: str,
+    node_urls: Sequence[str],
+    doc_ids: Sequence[str],
+    labels: Sequence[int] | None = None,
+) -> str:
+    """
+    Return a fingerprint of an ingest, so that a journal is only resumed by the same one.
+
+    Args:
+        schema_id (str): The schema the documents are written to.
+        node_urls (list[str]): URLs of the nilDB nodes.
+        doc_ids (list[str]): Ids of the documents, in upload order.
+        labels (list[int], optional): Cluster label of each document.
+
+    Returns:
+        str: Hex digest identifying the ingest.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([schema_id, list(node_urls)]).encode())
+    for doc_id in doc_ids:
+        digest.update(doc_id.encode() + b"\n")
+    if labels is not None:
+        digest.update(json.dumps([int(label) for label in labels]).encode())
+    return digest.hexdigest()
+
+
+class IngestJournal:
+    """
+    Append-only JSON lines journal of the document ranges each node has committed.
+
+    The first line holds the fingerprint of the ingest; every following line records
+    either a range of documents `[start, end)` stored by one node or a finished step
+    (e.g. the centroids upload). Each line is flushed to disk before the upload is
+    reported as committed, and a truncated last line left by a crash is ignored.
+    """
+
+    def __init__(self, path: str, fingerprint: str, num_nodes: int):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.ranges: List[List[List[int]]] = [[] for _ in range(num_nodes)]
+        self.steps: set[str] = set()
+        self._truncated = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._load()
+            # pylint: disable=consider-using-with
+            self._file = open(path, "a", encoding="utf-8")
+            if self._truncated:
+                # Terminate the partial line so that new entries start on their own line
+                self._file.write("\n")
+        else:
+            # pylint: disable=consider-using-with
+            self._file = open(path, "w", encoding="utf-8")
+            self._append({"fingerprint": fingerprint, "nodes": num_nodes})
+
+    def _load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            content = f.read()
+        self._truncated = not content.endswith("\n")
+        lines = content.splitlines()
+        header = json.loads(lines[0])
+        if header.get("fingerprint") != self.fingerprint:
+            raise ValueError(
+                f"Journal {self.path} belongs to a different ingest; "
+                "remove it to start over"
+            )
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Partial line written when the previous run was interrupted
+                continue
+            if "step" in entry:
+                self.steps.add(entry["step"])
+            else:
+                self.ranges[entry["node"]].append([entry["start"], entry["end"]])
+        for node_ranges in self.ranges:
+            node_ranges.sort()
+
+    def _append(self, entry: Dict) -> None:
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def pending_ranges(self, node_idx: int, start: int, end: int) -> List[List[int]]:
+        """
+        Return the sub-ranges of `[start, end)` that node `node_idx` has not committed.
+
+        A range may be partly committed, e.g. after a batch was split in halves or when
+        batch boundaries differ between runs.
+        """
+        pending = []
+        covered = start
+        for range_start, range_end in self.ranges[node_idx]:
+            if range_end <= covered:
+                continue
+            if range_start >= end:
+                break
+            if range_start > covered:
+                pending.append([covered, range_start])
+            covered = range_end
+            if covered >= end:
+                return pending
+        if covered < end:
+            pending.append([covered, end])
+        return pending
+
+    def is_committed(self, node_idx: int, start: int, end: int) -> bool:
+        """Whether node `node_idx` has committed every document in `[start, end)`."""
+        return not self.pending_ranges(node_idx, start, end)
+
+    def pending_nodes(self, start: int, end: int) -> List[int]:
+        """Return the nodes that have not committed all documents in `[start, end)`."""
+        return [
+            node_idx
+            for node_idx in range(len(self.ranges))
+            if not self.is_committed(node_idx, start, end)
+        ]
+
+    def record(self, node_idx: int, start: int, end: int) -> None:
+        """Record that node `node_idx` committed the documents in `[start, end)`."""
+        self._append({"node": node_idx, "start": start, "end": end})
+        self.ranges[node_idx].append([start, end])
+        self.ranges[node_idx].sort()
+
+    def is_done(self, step: str) -> bool:
+        """Whether `step` was recorded as finished."""
+        return step in self.steps
+
+    def mark_done(self, step: str) -> None:
+        """Record that `step` finished."""
+        self._append({"step": step})
+        self.steps.add(step)
+
+    def close(self) -> None:
+        """Close the journal file."""
+        self._file.close()
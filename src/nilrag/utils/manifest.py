@@ -0,0 +1,85 @@
+"""
+This module provides the local manifest of the documents uploaded to nilDB, used to sync a
+corpus incrementally instead of flushing and re-writing it.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List, NamedTuple
+
+
+def content_hash(text: str) -> str:
+    """Return the SHA-256 hex digest of a chunk."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ManifestDiff(NamedTuple):
+    """Difference between the uploaded documents and the current chunks of a corpus."""
+
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+    unchanged: int
+
+
+class SyncManifest:
+    """
+    JSON file mapping the id of every document uploaded to a schema to its content hash.
+
+    Ids that are being uploaded are listed as pending until the upload succeeds, so that
+    documents left on some nodes by an interrupted sync can be cleaned up by the next one.
+    The file is replaced atomically on every save.
+    """
+
+    def __init__(self, path: str, schema_id: str):
+        self.path = path
+        self.schema_id = schema_id
+        self.documents: Dict[str, str] = {}
+        self.pending: List[str] = []
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("schema_id") != schema_id:
+                raise ValueError(
+                    f"Manifest {path} belongs to schema {manifest.get('schema_id')}, "
+                    f"not {schema_id}"
+                )
+            self.documents = manifest["documents"]
+            self.pending = manifest.get("pending", [])
+
+    def diff(self, current: Dict[str, str]) -> ManifestDiff:
+        """
+        Compare the uploaded documents with the current ones.
+
+        Args:
+            current (dict): Content hash of each current document, by id.
+
+        Returns:
+            ManifestDiff: Ids to upload, to replace and to delete, in a stable order.
+        """
+        added = [doc_id for doc_id in current if doc_id not in self.documents]
+        changed = [
+            doc_id
+            for doc_id, digest in current.items()
+            if doc_id in self.documents and self.documents[doc_id] != digest
+        ]
+        removed = [doc_id for doc_id in self.documents if doc_id not in current]
+        unchanged = len(current) - len(added) - len(changed)
+        return ManifestDiff(added, changed, removed, unchanged)
+
+    def save(self) -> None:
+        """Write the manifest to disk."""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "schema_id": self.schema_id,
+                    "documents": self.documents,
+                    "pending": self.pending,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,138 @@
+"""
+This module provides a process-wide registry of embedding models, so that each model is
+loaded once per process and reused across queries.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Tuple, Union
+
+from .embedding_backends import DEFAULT_BACKEND, get_backend_loader, model_key
+
+DEFAULT_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_MAX_MODELS = 2
+
+
+class ModelRegistry:
+    """
+    Thread-safe, size-bounded LRU cache of loaded embedding models.
+
+    Models are loaded on first use with their embedding backend (see
+    `embedding_backends`) and kept in memory until more than `max_models` distinct
+    models have been requested, at which point the least recently used model is evicted.
+    A custom `loader` replaces the backends, e.g. in tests.
+    """
+
+    def __init__(
+        self,
+        max_models: int = DEFAULT_MAX_MODELS,
+        loader: Callable[[str], object] | None = None,
+    ):
+        if max_models < 1:
+            raise ValueError("max_models must be at least 1")
+        self.max_models = max_models
+        self.loader = loader
+        self._models: OrderedDict[str, object] = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per model name, so that loading one model does not block lookups of
+        # models that are already in memory.
+        self._load_locks: dict[str, threading.Lock] = {}
+
+    def get(self, model_name: str = DEFAULT_MODEL_NAME, backend: str = DEFAULT_BACKEND):
+        """
+        Return the model called `model_name`, loading it if it is not in memory yet.
+
+        Args:
+            model_name (str, optional): Name of the HuggingFace model.
+                Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+            backend (str, optional): Embedding backend to load the model with.
+                Defaults to 'torch'.
+
+        Returns:
+            The loaded model.
+        """
+        key = model_key(model_name, backend)
+        loader = self.loader or get_backend_loader(backend)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Load outside the registry lock; concurrent callers of the same model wait here
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+            model = loader(model_name)
+            with self._lock:
+                self._models[key] = model
+                while len(self._models) > self.max_models:
+                    self._models.popitem(last=False)
+                self._load_locks.pop(key, None)
+            return model
+
+    def warmup(
+        self,
+        model_names: Union[str, Iterable[str]] = DEFAULT_MODEL_NAME,
+        backend: str = DEFAULT_BACKEND,
+    ):
+        """
+        Load the given models ahead of time, e.g. when a server starts.
+
+        Args:
+            model_names (str or list): Name(s) of the HuggingFace models to load.
+            backend (str, optional): Embedding backend to load the models with.
+                Defaults to 'torch'.
+        """
+        if isinstance(model_names, str):
+            model_names = [model_names]
+        for model_name in model_names:
+            self.get(model_name, backend)
+
+    def evict(self, model_name: str, backend: str = DEFAULT_BACKEND) -> None:
+        """Drop `model_name` loaded with `backend` from memory, if loaded."""
+        with self._lock:
+            self._models.pop(model_key(model_name, backend), None)
+
+    def clear(self) -> None:
+        """Drop all loaded models."""
+        with self._lock:
+            self._models.clear()
+
+    def is_loaded(self, model_name: str, backend: str = DEFAULT_BACKEND) -> bool:
+        """Whether `model_name` loaded with `backend` is in memory."""
+        with self._lock:
+            return model_key(model_name, backend) in self._models
+
+    def __contains__(self, model: Union[str, Tuple[str, str]]) -> bool:
+        """
+        Whether a model is in memory, given its name (loaded with the default backend) or
+        a `(model_name, backend)` pair.
+        """
+        model_name, backend = (
+            (model, DEFAULT_BACKEND) if isinstance(model, str) else model
+        )
+        return self.is_loaded(model_name, backend)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._models)
+
+
+# Registry shared by the whole process
+MODEL_REGISTRY = ModelRegistry()
+
+
+def get_model(model_name: str = DEFAULT_MODEL_NAME, backend: str = DEFAULT_BACKEND):
+    """Return `model_name` loaded with `backend` from the process-wide model registry."""
+    return MODEL_REGISTRY.get(model_name, backend)
+
+
+def warmup(
+    model_names: Union[str, Iterable[str]] = DEFAULT_MODEL_NAME,
+    backend: str = DEFAULT_BACKEND,
+) -> None:
+    """Load the given models into the process-wide model registry ahead of time."""
+    MODEL_REGISTRY.warmup(model_names, backend)
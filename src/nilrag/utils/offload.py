@@ -0,0 +1,82 @@
+"""
+This module provides the offloading of CPU-bound work (encoding, encryption, decryption)
+from the event loop to a thread or process pool.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from typing import Any, Callable
+
+CPU_POOL_KINDS = ("thread", "process")
+
+
+class CPUOffload:
+    """
+    CPUOffload runs CPU-bound functions in a worker pool, so that a large query does not
+    stall the other queries and node requests sharing the event loop.
+
+    The pool is created on first use with `cpu_workers` workers (the number of CPUs by
+    default). A thread pool suits NumPy and the encoder, which release the GIL; a process
+    pool also parallelizes pure-Python work such as `nilql.decrypt`, at the cost of
+    pickling arguments and of loading the embedding model once per worker process. With
+    `cpu_workers=0`, functions run inline on the event loop.
+    """
+
+    cpu_pool: str = "thread"
+    cpu_workers: int | None = None
+    _cpu_executor: Executor | None = None
+
+    def configure_cpu_pool(
+        self, cpu_pool: str = "thread", cpu_workers: int | None = None
+    ):
+        """
+        Set the kind and size of the worker pool.
+
+        Args:
+            cpu_pool (str, optional): "thread" or "process". Defaults to "thread".
+            cpu_workers (int, optional): Number of workers, 0 to run inline.
+                Defaults to the number of CPUs.
+        """
+        if cpu_pool not in CPU_POOL_KINDS:
+            raise ValueError(f"cpu_pool must be one of {CPU_POOL_KINDS}")
+        if cpu_workers is not None and cpu_workers < 0:
+            raise ValueError("cpu_workers must be at least 0")
+        self.shutdown_cpu_pool()
+        self.cpu_pool = cpu_pool
+        self.cpu_workers = os.cpu_count() if cpu_workers is None else cpu_workers
+
+    def get_cpu_executor(self) -> Executor | None:
+        """Return the worker pool, creating it on first use (None when running inline)."""
+        if self.cpu_workers == 0:
+            return None
+        if self._cpu_executor is None:
+            if self.cpu_pool == "process":
+                self._cpu_executor = ProcessPoolExecutor(max_workers=self.cpu_workers)
+            else:
+                self._cpu_executor = ThreadPoolExecutor(
+                    max_workers=self.cpu_workers, thread_name_prefix="nilrag-cpu"
+                )
+        return self._cpu_executor
+
+    async def run_cpu(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run `func(*args, **kwargs)` in the worker pool and return its result.
+
+        With a process pool, `func` and its arguments must be picklable, e.g. module-level
+        functions rather than lambdas.
+        """
+        executor = self.get_cpu_executor()
+        if executor is None:
+            return func(*args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def shutdown_cpu_pool(self) -> None:
+        """Shut down the worker pool, if created; it is re-created on next use."""
+        if self._cpu_executor is not None:
+            self._cpu_executor.shutdown(wait=False, cancel_futures=True)
+            self._cpu_executor = None
@@ -0,0 +1,97 @@
+"""
+This module provides helpers to run concurrent pipeline stages connected by bounded
+asyncio queues, and stages connected by a dependency graph.
+"""
+
+import asyncio
+import inspect
+import time
+from itertools import islice
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable,
+                    Iterator, List, Sequence, Tuple)
+
+# Marks the end of the items of a queue
+END = object()
+
+
+def batched(items: Iterable, size: int) -> Iterator[List]:
+    """Yield lists of `size` consecutive items (the last one may be shorter)."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+async def iterate_queue(queue: asyncio.Queue) -> AsyncIterator:
+    """
+    Yield the items of `queue` until the END marker.
+
+    The marker is put back, so that several consumers of the same queue all stop.
+    """
+    while True:
+        item = await queue.get()
+        if item is END:
+            await queue.put(END)
+            return
+        yield item
+
+
+async def run_stages(*stages: Awaitable) -> List:
+    """
+    Run pipeline stages concurrently.
+
+    If a stage fails, the other stages are cancelled, so that none of them stays blocked
+    on a queue, and the error is raised.
+
+    Returns:
+        list: The results of the stages.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def run_graph(
+    stages: Dict[str, Tuple[Callable, Sequence[str]]],
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Run the stages of a dependency graph, each as soon as the stages it depends on are
+    done, so that independent stages overlap.
+
+    Args:
+        stages (dict): `name: (func, dependencies)` of each stage, listed after its
+            dependencies. `func` is called with the results of the dependencies, in
+            order, and may return an awaitable.
+
+    Returns:
+        tuple: (result of each stage, seconds spent in each stage, not counting the wait
+            for its dependencies)
+
+    Raises:
+        ValueError: If a stage depends on a stage not listed before it
+    """
+    for position, (name, (_, dependencies)) in enumerate(stages.items()):
+        unknown = set(dependencies) - set(list(stages)[:position])
+        if unknown:
+            raise ValueError(f"Stage {name!r} depends on unknown stages {unknown}")
+
+    tasks = {}
+    timings = {}
+
+    async def run(name: str, func: Callable, dependencies: Sequence[str]) -> Any:
+        args = [await tasks[dependency] for dependency in dependencies]
+        start_time = time.perf_counter()
+        result = func(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        timings[name] = time.perf_counter() - start_time
+        return result
+
+    for name, (func, dependencies) in stages.items():
+        tasks[name] = asyncio.ensure_future(run(name, func, dependencies))
+    results = await run_stages(*tasks.values())
+    return dict(zip(tasks, results)), {name: timings[name] for name in stages}
@@ -2,13 +2,32 @@
 This module provides functions to process embeddings and chunks.
 """
 
-from typing import Union
+import bisect
+import glob
+import itertools
+import mmap
+import os
+import re
+from typing import Iterable, Iterator, NamedTuple, Union
+from uuid import NAMESPACE_URL, uuid5
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
 
-from .transform import to_fixed_point
+from .embedding_backends import DEFAULT_BACKEND, model_key
+from .embedding_cache import EmbeddingCache
+from .model_registry import DEFAULT_MODEL_NAME, get_model
+from .transform import from_fixed_point, to_fixed_point_array
+
+# Two consecutive line breaks, as written by any platform. Text mode reads "\r\n", "\r" and
+# "\n" as one "\n" each; atomic groups keep "\r\n" from counting as two line breaks.
+PARAGRAPH_SEPARATOR = re.compile(rb"(?>\r\n|\r|\n)(?>\r\n|\r|\n)")
+WORD = re.compile(r"\S+")
+
+# Number of embeddings per mini-batch of K-Means training and of label assignment
+DEFAULT_CLUSTER_BATCH_SIZE = 4096
+
+# Namespace of the deterministic document ids
+CHUNK_ID_NAMESPACE = uuid5(NAMESPACE_URL, "https://github.com/NillionNetwork/nilrag")
 
 
 def check_inputs_to_upload(
@@ -79,26 +98,365 @@ def create_chunks(paragraphs: list[str], chunk_size: int = 500, overlap: int = 1
     return chunks
 
 
+def get_tokenizer(
+    model_name: str = DEFAULT_MODEL_NAME, backend: str = DEFAULT_BACKEND
+) -> tuple:
+    """
+    Return the tokenizer of an embedding model and the number of text tokens it encodes.
+
+    Tokens beyond the model's maximum sequence length (minus the special tokens the
+    tokenizer adds) are truncated by the encoder.
+
+    Args:
+        model_name (str, optional): Name of the HuggingFace model.
+            Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+        backend (str, optional): Embedding backend. Defaults to 'torch'.
+
+    Returns:
+        tuple: (tokenizer, maximum number of text tokens per chunk)
+    """
+    model = get_model(model_name, backend)
+    tokenizer = model.tokenizer
+    return tokenizer, model.max_seq_length - tokenizer.num_special_tokens_to_add()
+
+
+# pylint: disable=too-many-locals
+def create_token_chunks(
+    paragraphs: list[str], tokenizer, max_tokens: int, overlap: int = 32
+) -> list[str]:
+    """
+    Split paragraphs into overlapping chunks of at most `max_tokens` tokens.
+
+    Tokens are counted with the model's own tokenizer, so chunks are packed up to what
+    the encoder reads and none is truncated. Chunks end on word boundaries and, like
+    `create_chunks`, do not span paragraphs; a single word longer than `max_tokens`
+    makes its own chunk. When the overlap would leave no room for the next word, the
+    next chunk starts without it, so that every chunk ends past the previous one.
+
+    Args:
+        paragraphs (list): List of paragraph strings to chunk
+        tokenizer: Fast HuggingFace tokenizer of the embedding model (see
+            `get_tokenizer`), which provides token offsets
+        max_tokens (int): Maximum number of tokens per chunk
+        overlap (int, optional): Maximum number of tokens repeated from the end of a
+            chunk at the start of the next one. Defaults to 32.
+
+    Returns:
+        list: List of chunk strings
+    """
+    if not 0 <= overlap < max_tokens:
+        raise ValueError("overlap must be at least 0 and less than max_tokens")
+    chunks = []
+    for para in paragraphs:
+        spans = [match.span() for match in WORD.finditer(para)]
+        if not spans:
+            continue
+        words = [para[start:end] for start, end in spans]
+        word_starts = [start for start, _ in spans]
+        # Count the tokens of each word, assigning a token to the word of its last
+        # character (e.g. SentencePiece tokens include the preceding space)
+        counts = [0] * len(words)
+        offsets = tokenizer(
+            para, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        for token_start, token_end in offsets:
+            if token_end > token_start:
+                counts[bisect.bisect_right(word_starts, token_end - 1) - 1] += 1
+        cumulative = [0, *itertools.accumulate(counts)]
+
+        start = 0
+        while True:
+            # Longest run of words from `start` that fits, and at least one word
+            end = bisect.bisect_right(cumulative, cumulative[start] + max_tokens) - 1
+            end = max(end, start + 1)
+            chunks.append(" ".join(words[start:end]))
+            if end >= len(words):
+                break
+            # Repeat the last words of the chunk, up to `overlap` tokens, unless the
+            # next chunk would then end no further than this one (before a long word)
+            next_start = max(
+                bisect.bisect_left(cumulative, cumulative[end] - overlap), start + 1
+            )
+            next_end = bisect.bisect_right(
+                cumulative, cumulative[next_start] + max_tokens
+            )
+            start = next_start if next_end - 1 > end else end
+    return chunks
+
+
+def chunk_token_stats(chunks: list[str], tokenizer, max_tokens: int) -> dict:
+    """
+    Measure how well chunks fit the encoder.
+
+    Args:
+        chunks (list): List of chunk strings
+        tokenizer: HuggingFace tokenizer of the embedding model
+        max_tokens (int): Number of text tokens the encoder reads (see `get_tokenizer`)
+
+    Returns:
+        dict: Number of chunks; number of `truncated` chunks and of tokens the encoder
+            ignores; number of `padded` chunks, which fill less than half of the limit
+            and are mostly padding; and the mean fill ratio of the limit.
+    """
+    if not chunks:
+        return {
+            "chunks": 0,
+            "truncated": 0,
+            "truncated_tokens": 0,
+            "padded": 0,
+            "mean_fill": 0.0,
+        }
+    lengths = np.array(
+        [
+            len(input_ids)
+            for input_ids in tokenizer(chunks, add_special_tokens=False)["input_ids"]
+        ]
+    )
+    return {
+        "chunks": len(chunks),
+        "truncated": int(np.sum(lengths > max_tokens)),
+        "truncated_tokens": int(np.sum(np.maximum(lengths - max_tokens, 0))),
+        "padded": int(np.sum(lengths * 2 < max_tokens)),
+        "mean_fill": float(np.mean(np.minimum(lengths, max_tokens)) / max_tokens),
+    }
+
+
+class Paragraph(NamedTuple):
+    """A paragraph of a file and its byte offsets in the file."""
+
+    text: str  # As returned by load_file, i.e. with line breaks translated to "\n"
+    start: int
+    end: int
+    source: str  # As stored in the file
+
+
+class TextChunk(NamedTuple):
+    """A chunk and the byte offsets of its first and last word in the file."""
+
+    text: str
+    start: int
+    end: int
+
+
+def iter_paragraphs(file_path: str) -> Iterator[Paragraph]:
+    """
+    Lazily read the paragraphs of a file through a memory map.
+
+    Yields the same paragraphs as `load_file`, without reading the whole file in memory.
+
+    Args:
+        file_path (str): Path to the text file to load
+
+    Yields:
+        Paragraph: Non-empty paragraph with whitespace stripped, and its byte offsets
+    """
+    with open(file_path, "rb") as f:
+        # Empty files cannot be memory-mapped
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            segment_start = 0
+            for separator in PARAGRAPH_SEPARATOR.finditer(data):
+                paragraph = _make_paragraph(
+                    data[segment_start : separator.start()], segment_start
+                )
+                if paragraph is not None:
+                    yield paragraph
+                segment_start = separator.end()
+            paragraph = _make_paragraph(data[segment_start:], segment_start)
+            if paragraph is not None:
+                yield paragraph
+
+
+def _make_paragraph(segment: bytes, offset: int) -> Paragraph | None:
+    """Strip a segment of the file at `offset` into a paragraph, if not empty."""
+    text = segment.decode("utf-8")
+    source = text.strip()
+    if not source:
+        return None
+    start = offset + len(text[: len(text) - len(text.lstrip())].encode("utf-8"))
+    end = start + len(source.encode("utf-8"))
+    if "\r" in source:
+        text = source.replace("\r\n", "\n").replace("\r", "\n")
+    else:
+        text = source
+    return Paragraph(text, start, end, source)
+
+
+def iter_chunks(
+    paragraphs: Iterable[Paragraph], chunk_size: int = 500, overlap: int = 100
+) -> Iterator[TextChunk]:
+    """
+    Lazily split paragraphs into overlapping chunks of words.
+
+    Yields the same chunks as `create_chunks`, with their byte offsets in the file.
+
+    Args:
+        paragraphs (iterable): Paragraphs, e.g. from `iter_paragraphs`
+        chunk_size (int, optional): Maximum number of words per chunk. Defaults to 500.
+        overlap (int, optional): Number of overlapping words between chunks. Defaults to 100.
+
+    Yields:
+        TextChunk: Chunk string with specified size and overlap, and its byte offsets
+    """
+    for paragraph in paragraphs:
+        words, starts, ends = [], [], []
+        position, byte_position = 0, paragraph.start
+        for word in WORD.finditer(paragraph.source):
+            byte_position += len(
+                paragraph.source[position : word.start()].encode("utf-8")
+            )
+            starts.append(byte_position)
+            byte_position += len(word.group().encode("utf-8"))
+            ends.append(byte_position)
+            words.append(word.group())
+            position = word.end()
+        for i in range(0, len(words), chunk_size - overlap):
+            last = min(i + chunk_size, len(words)) - 1
+            yield TextChunk(" ".join(words[i : i + chunk_size]), starts[i], ends[last])
+
+
+def expand_sources(source: Union[str, list[str]]) -> list[str]:
+    """
+    Expand a directory, a glob pattern or a list of them into the text files to ingest.
+
+    Args:
+        source (str or list): Directory (all `*.txt` files below it), file path or glob
+            pattern such as `corpus/**/*.md`, or a list of them
+
+    Returns:
+        list: Sorted paths of the matching files, without duplicates
+
+    Raises:
+        FileNotFoundError: If no file matches
+    """
+    sources = [source] if isinstance(source, str) else source
+    paths = set()
+    for pattern in sources:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*.txt")
+        paths.update(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+    if not paths:
+        raise FileNotFoundError(f"No files match {source}")
+    return sorted(paths)
+
+
+def load_and_chunk_file(
+    file_path: str, chunk_size: int = 500, overlap: int = 100
+) -> tuple[list[str], list[str]]:
+    """
+    Load and chunk a file, and derive the ids of its chunks.
+
+    Defined at module level so that it can run in a process pool.
+
+    Args:
+        file_path (str): Path to the text file to load
+        chunk_size (int, optional): Maximum number of words per chunk. Defaults to 500.
+        overlap (int, optional): Number of overlapping words between chunks. Defaults to 100.
+
+    Returns:
+        tuple: (chunks, chunk ids)
+    """
+    chunks = [
+        chunk.text
+        for chunk in iter_chunks(iter_paragraphs(file_path), chunk_size, overlap)
+    ]
+    return chunks, generate_chunk_ids(chunks, file_path)
+
+
+def generate_chunk_ids(chunks: list[str], source: str) -> list[str]:
+    """
+    Generate deterministic document ids for the chunks of a source.
+
+    Each id is a UUIDv5 of the source and the position of the chunk within it, so
+    re-processing the same file yields the same ids, and an edited chunk keeps its id:
+    an incremental sync replaces it instead of adding a document and removing another.
+
+    Args:
+        chunks (list): List of chunk strings
+        source (str): Name of the source of the chunks, e.g. the file path
+
+    Returns:
+        list: One id string per chunk
+    """
+    return [
+        str(uuid5(CHUNK_ID_NAMESPACE, f"{source}:{position}"))
+        for position in range(len(chunks))
+    ]
+
+
 def generate_embeddings_huggingface(
     chunks_or_query: Union[str, list],
-    model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+    model_name: str = DEFAULT_MODEL_NAME,
+    backend: str = DEFAULT_BACKEND,
 ):
     """
     Generate embeddings for text using a HuggingFace sentence transformer model.
 
+    The model is loaded once per process through the model registry, so repeated calls
+    only pay for encoding. On CPU-only hosts, the 'onnx-int8' backend runs the int8-quantized
+    ONNX export of the model with ONNX Runtime, which encodes faster and with less memory.
+
     Args:
         chunks_or_query (str or list): Text string(s) to generate embeddings for
         model_name (str, optional): Name of the HuggingFace model to use.
             Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+        backend (str, optional): Embedding backend: 'torch', 'onnx' or 'onnx-int8' (see
+            `embedding_backends`). Defaults to 'torch'.
 
     Returns:
         numpy.ndarray: Array of embeddings for the input text
     """
-    model = SentenceTransformer(model_name)
+    model = get_model(model_name, backend)
     embeddings = model.encode(chunks_or_query, convert_to_tensor=False)
     return embeddings
 
 
+def embed_chunks(
+    chunks: list[str],
+    model_name: str = DEFAULT_MODEL_NAME,
+    cache: EmbeddingCache | None = None,
+    backend: str = DEFAULT_BACKEND,
+) -> np.ndarray:
+    """
+    Generate embeddings for chunks, embedding each distinct chunk once.
+
+    Chunks that repeat (e.g. overlap windows of short paragraphs) are embedded once, and
+    with a cache, chunks embedded in earlier runs are not embedded again.
+
+    Args:
+        chunks (list): Chunk strings to generate embeddings for
+        model_name (str, optional): Name of the HuggingFace model to use.
+            Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+        cache (EmbeddingCache, optional): Persistent embedding cache. Defaults to None.
+        backend (str, optional): Embedding backend. Defaults to 'torch'.
+
+    Returns:
+        numpy.ndarray: Array of embeddings, one row per chunk
+    """
+    unique_chunks = list(dict.fromkeys(chunks))
+    if not unique_chunks:
+        return generate_embeddings_huggingface(chunks, model_name, backend)
+    # Quantized backends give slightly different embeddings, so they are cached apart
+    cache_key = model_key(model_name, backend)
+    if cache is not None:
+        vectors = cache.get(cache_key, unique_chunks)
+    else:
+        vectors = [None] * len(unique_chunks)
+    missing = [chunk for chunk, vector in zip(unique_chunks, vectors) if vector is None]
+    embedded = {}
+    if missing:
+        embeddings = generate_embeddings_huggingface(missing, model_name, backend)
+        if cache is not None:
+            cache.put(cache_key, missing, embeddings)
+        embedded = dict(zip(missing, embeddings))
+    by_chunk = {
+        chunk: embedded[chunk] if vector is None else vector
+        for chunk, vector in zip(unique_chunks, vectors)
+    }
+    return np.stack([by_chunk[chunk] for chunk in chunks])
+
+
 def cluster_embeddings(embeddings: np.ndarray, num_clusters: int):
     """
     Cluster the given embeddings using K-Means.
@@ -110,11 +468,162 @@ def cluster_embeddings(embeddings: np.ndarray, num_clusters: int):
     Returns:
         tuple: (labels, centroids)
     """
+    # Imported on first use to keep `import nilrag` fast
+    # pylint: disable=import-outside-toplevel
+    from sklearn.cluster import KMeans
+
     embeddings_array = np.array(embeddings)  # Convert to NumPy array
     kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init=10)
     labels = kmeans.fit_predict(embeddings_array)
-    centroids = kmeans.cluster_centers_
 
-    # Convert each centroid to a fixed-point
-    centroids = [[to_fixed_point(val) for val in centroid] for centroid in centroids]
-    return labels, centroids
+    # Convert the centroids to fixed-point
+    return labels, to_fixed_point_array(kmeans.cluster_centers_).tolist()
+
+
+def cluster_embeddings_minibatch(
+    embeddings: np.ndarray,
+    num_clusters: int,
+    batch_size: int = DEFAULT_CLUSTER_BATCH_SIZE,
+    sample_size: int | None = None,
+):
+    """
+    Cluster the given embeddings using mini-batch K-Means, without holding them all in
+    memory.
+
+    By default, the centroids are trained in one pass over the embeddings, one mini-batch
+    at a time. With `sample_size`, they are trained on a random sample of the embeddings
+    instead. Labels are then assigned one batch at a time, so `embeddings` can be a
+    memory-mapped array, e.g. of an `EmbeddingCache`, larger than the memory.
+
+    Args:
+        embeddings (np.ndarray): The embeddings to cluster, one per row.
+        num_clusters (int): The number of clusters to form.
+        batch_size (int, optional): Number of embeddings per mini-batch.
+            Defaults to DEFAULT_CLUSTER_BATCH_SIZE.
+        sample_size (int, optional): Number of embeddings to train on. Defaults to None
+            (all of them).
+
+    Returns:
+        tuple: (labels, centroids)
+    """
+    # pylint: disable=import-outside-toplevel
+    from sklearn.cluster import MiniBatchKMeans
+
+    if not hasattr(embeddings, "shape"):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+    num_embeddings = len(embeddings)
+    # The first mini-batch must hold at least one embedding per cluster
+    batch_size = max(batch_size, num_clusters)
+    kmeans = MiniBatchKMeans(
+        n_clusters=num_clusters, batch_size=batch_size, random_state=42, n_init=3
+    )
+    if sample_size is not None and sample_size < num_embeddings:
+        rows = np.random.default_rng(42).choice(num_embeddings, sample_size, False)
+        kmeans.fit(np.asarray(embeddings[np.sort(rows)], dtype=np.float32))
+    else:
+        # Fit the first batches, trying several initializations on them like
+        # MiniBatchKMeans (3 batches); the next batches update the centroids
+        head = 3 * batch_size
+        kmeans.fit(np.asarray(embeddings[:head], dtype=np.float32))
+        for start in range(head, num_embeddings, batch_size):
+            kmeans.partial_fit(
+                np.asarray(embeddings[start : start + batch_size], dtype=np.float32)
+            )
+
+    labels = np.empty(num_embeddings, dtype=np.int32)
+    for start in range(0, num_embeddings, batch_size):
+        labels[start : start + batch_size] = kmeans.predict(
+            np.asarray(embeddings[start : start + batch_size], dtype=np.float32)
+        )
+    return labels, to_fixed_point_array(kmeans.cluster_centers_).tolist()
+
+
+def cluster_spreads(
+    embeddings: np.ndarray,
+    labels: np.ndarray,
+    centroids: list,
+    batch_size: int = DEFAULT_CLUSTER_BATCH_SIZE,
+) -> list:
+    """
+    Compute the mean squared distance of the embeddings of each cluster to its centroid.
+
+    Written with the centroids, the spreads are the reference against which the drift of
+    documents appended later is measured.
+
+    Args:
+        embeddings (np.ndarray): The clustered embeddings, one per row.
+        labels (np.ndarray): The cluster of each embedding.
+        centroids (list): Centroid of each cluster, in fixed-point format.
+        batch_size (int, optional): Number of embeddings compared at a time.
+            Defaults to DEFAULT_CLUSTER_BATCH_SIZE.
+
+    Returns:
+        list[int]: Spread of each cluster in fixed-point format (0 for empty clusters)
+    """
+    centroids = from_fixed_point(np.asarray(centroids, dtype=np.float64))
+    labels = np.asarray(labels)
+    totals = np.zeros(len(centroids))
+    for start in range(0, len(labels), batch_size):
+        batch_labels = labels[start : start + batch_size]
+        differences = (
+            np.asarray(embeddings[start : start + batch_size], dtype=np.float64)
+            - centroids[batch_labels]
+        )
+        totals += np.bincount(
+            batch_labels,
+            weights=np.einsum("ij,ij->i", differences, differences),
+            minlength=len(centroids),
+        )
+    counts = np.bincount(labels, minlength=len(centroids))
+    return to_fixed_point_array(totals / np.maximum(counts, 1)).tolist()
+
+
+def cluster_embeddings_hierarchical(
+    embeddings: np.ndarray, num_coarse_clusters: int, num_fine_clusters: int
+):
+    """
+    Cluster the given embeddings in a two-level index: K-Means into coarse clusters, then
+    each coarse cluster into fine clusters.
+
+    Documents are labelled with their fine cluster. Queries pick the closest coarse
+    clusters, then the closest fine clusters among theirs, so the documents scanned per
+    query stay bounded as the collection grows.
+
+    Args:
+        embeddings (list of list of float): The embeddings to cluster.
+        num_coarse_clusters (int): The number of coarse clusters to form.
+        num_fine_clusters (int): The number of fine clusters to form in each coarse
+            cluster (fewer in coarse clusters with fewer embeddings).
+
+    Returns:
+        tuple: (labels, centroids, parents, coarse_centroids): the fine cluster of each
+            embedding, the fine centroids, the coarse cluster of each fine cluster and
+            the coarse centroids, with centroids in fixed-point format
+    """
+    # pylint: disable=import-outside-toplevel
+    from sklearn.cluster import KMeans
+
+    embeddings_array = np.array(embeddings)
+    coarse_kmeans = KMeans(n_clusters=num_coarse_clusters, random_state=42, n_init=10)
+    coarse_labels = coarse_kmeans.fit_predict(embeddings_array)
+
+    labels = np.empty(len(embeddings_array), dtype=int)
+    centroids, parents = [], []
+    for coarse_idx in range(num_coarse_clusters):
+        members = np.flatnonzero(coarse_labels == coarse_idx)
+        fine_kmeans = KMeans(
+            n_clusters=min(num_fine_clusters, len(members)), random_state=42, n_init=10
+        )
+        fine_labels = fine_kmeans.fit_predict(embeddings_array[members])
+        # Fine clusters are numbered across all coarse clusters
+        labels[members] = fine_labels + len(centroids)
+        centroids.extend(fine_kmeans.cluster_centers_)
+        parents.extend([coarse_idx] * len(fine_kmeans.cluster_centers_))
+
+    # Convert the centroids to fixed-point
+    return (
+        labels,
+        to_fixed_point_array(centroids).tolist(),
+        parents,
+        to_fixed_point_array(coarse_kmeans.cluster_centers_).tolist(),
+    )
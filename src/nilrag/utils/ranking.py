@@ -0,0 +1,266 @@
+"""
+This module provides the ranking of candidates by distance to a query: the top-k
+documents, and the clusters to probe when the documents are clustered. It also assigns
+new documents to existing clusters.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from ..nildb.centroid_cache import CentroidMatrix
+
+# Number of embeddings assigned to clusters at a time
+ASSIGN_BATCH_SIZE = 4096
+# Re-cluster once appended documents are this many times as far from their centroid, in
+# mean squared distance, as the documents the clusters were computed from
+DEFAULT_MAX_DRIFT = 1.5
+
+
+@dataclass
+class AdaptiveProbing:
+    """
+    Settings of adaptive cluster probing, which picks the number of clusters to probe for
+    each query instead of a fixed `num_clusters`.
+
+    Clusters are probed in order of distance to the query. The next cluster is only
+    probed while it is at most `max_distance_ratio` times as far as the closest one, and
+    while the clusters probed so far hold fewer than `candidates_per_chunk` documents per
+    chunk to retrieve (when the cluster sizes are known).
+    """
+
+    max_distance_ratio: float = 1.2
+    candidates_per_chunk: float = 10.0
+    max_clusters: int | None = None
+
+
+@dataclass
+class ClusterDrift:
+    """
+    Drift of documents appended to existing clusters, without re-clustering.
+
+    `ratio` is the mean squared distance of the appended documents to their centroid,
+    divided by the spread their clusters had when they were computed (None if the
+    clusters were written without spreads). Close to 1, the clusters still fit the new
+    documents. Well above 1, the new documents come from another distribution, and
+    queries probing their clusters get worse candidates: re-cluster the collection.
+    """
+
+    num_documents: int
+    mean_squared_distance: float
+    ratio: float | None
+
+    def needs_reclustering(self, max_ratio: float = DEFAULT_MAX_DRIFT) -> bool:
+        """Whether the drift exceeds `max_ratio` and a full re-cluster is due."""
+        return self.ratio is not None and self.ratio > max_ratio
+
+
+def top_k_indices(distances: Union[List[float], np.ndarray], k: int) -> np.ndarray:
+    """
+    Find the indices of the `k` smallest distances, in increasing order of distance.
+
+    Uses a partial selection (`np.argpartition`), so only the `k` selected candidates
+    are sorted.
+
+    Args:
+        distances (array-like): Distance of each candidate
+        k (int): Number of indices to return
+
+    Returns:
+        np.ndarray: Indices of the `k` closest candidates (fewer if there are fewer
+            candidates)
+    """
+    distances = np.asarray(distances)
+    k = min(k, distances.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < distances.size:
+        candidates = np.argpartition(distances, k - 1)[:k]
+    else:
+        candidates = np.arange(distances.size)
+    return candidates[np.argsort(distances[candidates], kind="stable")]
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def select_closest_centroids(
+    query_embedding: np.ndarray,
+    centroids: Optional[CentroidMatrix],
+    num_closest_centroids: int,
+    probing: AdaptiveProbing | None = None,
+    num_chunks: int = 1,
+    num_coarse_clusters: int = 1,
+) -> Tuple[int, Optional[List[int]]]:
+    """
+    Select the closest centroids of a query, if clustering was performed.
+
+    In a two-level index, the closest coarse clusters are selected first, and the
+    closest centroids only among their fine clusters.
+
+    Args:
+        query_embedding (np.ndarray): Embedding vector of the query
+        centroids (CentroidMatrix, optional): Centroids, None if no clustering was
+            performed
+        num_closest_centroids (int): Number of closest centroids to return
+        probing (AdaptiveProbing, optional): Pick the number of closest centroids (and
+            coarse clusters) adaptively instead. Defaults to None.
+        num_chunks (int, optional): Number of chunks the query retrieves. Defaults to 1.
+        num_coarse_clusters (int, optional): Number of coarse clusters to select from,
+            in a two-level index. Defaults to 1.
+
+    Returns:
+        int: Number of clusters found (0 if no clustering was performed)
+        list[int]: List of closest centroids (None if no clustering was performed)
+    """
+    if centroids is None:
+        return 0, None
+    num_clusters = len(centroids.matrix)
+
+    def closest(centroids: CentroidMatrix, num_closest: int) -> List[int]:
+        if probing is None:
+            return compute_closest_centroids(query_embedding, centroids, num_closest)
+        return probe_closest_centroids(query_embedding, centroids, probing, num_chunks)
+
+    try:
+        if centroids.coarse is None:
+            return num_clusters, closest(centroids, num_closest_centroids)
+        # Only rank the fine clusters of the closest coarse clusters
+        coarse = closest(centroids.coarse, num_coarse_clusters)
+        rows = np.flatnonzero(np.isin(centroids.parents, coarse))
+        closest_rows = closest(centroids.take(rows), num_closest_centroids)
+        return num_clusters, rows[closest_rows].tolist()
+    except ValueError as e:
+        print(f"Error checking clusters and finding closest centroid: {str(e)}")
+        return 0, None
+
+
+def compute_closest_centroids(
+    query_embedding: np.ndarray,
+    centroids: Union[CentroidMatrix, List[List[int]]],
+    num_closest_centroids: int,
+) -> List[int]:
+    """
+    Find the k closest centroids for a given query embedding.
+
+    The squared distances are ranked from one matrix-vector product, as
+    `|c|^2 - 2 c.q` (`|q|^2` is the same for every centroid), and only the closest
+    centroids are sorted.
+
+    Args:
+        query_embedding (np.ndarray): The embedding vector of the query in floating-point format
+        centroids (CentroidMatrix | list): Centroid matrix, or list of centroid vectors in
+            fixed-point format
+        num_closest_centroids (int): Number of closest centroids to return.
+
+    Returns:
+        list[int]: The indices of the closest centroids
+    """
+    if not isinstance(centroids, CentroidMatrix):
+        centroids = CentroidMatrix.from_fixed_point(centroids)
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    distances = centroids.squared_norms - 2 * (centroids.matrix @ query_embedding)
+    return top_k_indices(distances, num_closest_centroids).tolist()
+
+
+def probe_closest_centroids(
+    query_embedding: np.ndarray,
+    centroids: CentroidMatrix,
+    probing: AdaptiveProbing,
+    num_chunks: int,
+) -> List[int]:
+    """
+    Pick the clusters to probe for a query, closest first, from the distances of the
+    centroids and the sizes of the clusters (see AdaptiveProbing).
+
+    A query deep inside one cluster, far from every other centroid, probes that cluster
+    only; a query near the border of several clusters probes all of them, until they
+    hold enough candidate documents.
+
+    Args:
+        query_embedding (np.ndarray): The embedding vector of the query
+        centroids (CentroidMatrix): Centroids, with the cluster sizes if known
+        probing (AdaptiveProbing): Settings of adaptive probing
+        num_chunks (int): Number of chunks the query retrieves
+
+    Returns:
+        list[int]: The indices of the clusters to probe, closest first
+    """
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    squared_distances = (
+        centroids.squared_norms
+        - 2 * (centroids.matrix @ query_embedding)
+        + query_embedding @ query_embedding
+    )
+    distances = np.sqrt(np.maximum(squared_distances, 0))
+    order = top_k_indices(distances, probing.max_clusters or distances.size)
+
+    # Stop before the first cluster too far compared with the closest one
+    too_far = distances[order] > probing.max_distance_ratio * distances[order[0]]
+    num_probed = int(np.argmax(too_far)) if too_far.any() else order.size
+    # Stop once the clusters probed hold enough candidates
+    if centroids.sizes is not None:
+        candidates = np.cumsum(centroids.sizes[order])
+        target = probing.candidates_per_chunk * num_chunks
+        num_probed = min(num_probed, int(np.searchsorted(candidates, target)) + 1)
+    return order[: max(num_probed, 1)].tolist()
+
+
+def assign_clusters(
+    embeddings: np.ndarray,
+    centroids: CentroidMatrix,
+    batch_size: int = ASSIGN_BATCH_SIZE,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Assign each embedding to its closest centroid.
+
+    In a two-level index, embeddings are assigned to the closest fine centroid, among
+    all of them.
+
+    Args:
+        embeddings (np.ndarray): Embeddings to assign, one per row
+        centroids (CentroidMatrix): Centroids of the clusters
+        batch_size (int, optional): Number of embeddings assigned at a time.
+            Defaults to ASSIGN_BATCH_SIZE.
+
+    Returns:
+        np.ndarray: Cluster of each embedding
+        np.ndarray: Squared distance of each embedding to its centroid
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.empty(len(embeddings), dtype=np.int64)
+    squared_distances = np.empty(len(embeddings), dtype=np.float64)
+    for start in range(0, len(embeddings), batch_size):
+        batch = embeddings[start : start + batch_size]
+        distances = centroids.squared_norms - 2 * (batch @ centroids.matrix.T)
+        batch_labels = np.argmin(distances, axis=1)
+        labels[start : start + len(batch)] = batch_labels
+        squared_distances[start : start + len(batch)] = np.maximum(
+            distances[np.arange(len(batch)), batch_labels]
+            + np.einsum("ij,ij->i", batch, batch),
+            0,
+        )
+    return labels, squared_distances
+
+
+def measure_drift(
+    labels: np.ndarray, squared_distances: np.ndarray, centroids: CentroidMatrix
+) -> ClusterDrift:
+    """
+    Measure the drift of documents assigned to existing clusters (see ClusterDrift).
+
+    Args:
+        labels (np.ndarray): Cluster of each document, from `assign_clusters`
+        squared_distances (np.ndarray): Squared distance of each document to its centroid
+        centroids (CentroidMatrix): Centroids of the clusters, with their spreads if known
+
+    Returns:
+        ClusterDrift: The drift of the documents
+    """
+    if len(labels) == 0:
+        return ClusterDrift(0, 0.0, None)
+    ratio = None
+    if centroids.spreads is not None:
+        reference = float(np.sum(centroids.spreads[labels]))
+        ratio = float(np.sum(squared_distances)) / reference if reference > 0 else None
+    return ClusterDrift(len(labels), float(np.mean(squared_distances)), ratio)
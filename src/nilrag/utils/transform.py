@@ -2,11 +2,19 @@
 Transform util functions
 """
 
+import secrets
+
 import nilql
+import numpy as np
 
 PRECISION = 7
 SCALING_FACTOR = 10**PRECISION
 
+# Modulus used by nilql for additive (summation-compatible) secret shares
+SHARE_MODULUS = (2**32) + 15
+# Largest multiple of SHARE_MODULUS below 2^64, used for unbiased rejection sampling
+_SAMPLE_LIMIT = ((2**64) // SHARE_MODULUS) * SHARE_MODULUS
+
 
 def group_shares_by_id(shares_per_party: list, transform_share_fn: callable):
     """
@@ -29,6 +37,41 @@ def group_shares_by_id(shares_per_party: list, transform_share_fn: callable):
     return shares_by_id
 
 
+def stack_shares_by_id(
+    shares_per_node: list, transform_share_fn: callable
+) -> tuple[list, np.ndarray]:
+    """
+    Aligns the shares returned by each node by their ID and stacks them in one array.
+
+    Only IDs returned by every node are kept, in the order of the first node.
+
+    Args:
+        shares_per_node (list): List with the records returned by each node
+        transform_share_fn (callable): Function extracting the share value of a record
+
+    Returns:
+        tuple: (ids, shares) where shares is an int64 array of shape
+            (n_nodes, n_ids, ...)
+    """
+    ids = [share["_id"] for share in shares_per_node[0]]
+    common_ids = set(ids)
+    for node_shares in shares_per_node[1:]:
+        common_ids &= {share["_id"] for share in node_shares}
+    if len(common_ids) < len(ids):
+        ids = [share_id for share_id in ids if share_id in common_ids]
+    positions = {share_id: idx for idx, share_id in enumerate(ids)}
+
+    stacked = []
+    for node_shares in shares_per_node:
+        rows = [None] * len(ids)
+        for share in node_shares:
+            idx = positions.get(share["_id"])
+            if idx is not None:
+                rows[idx] = transform_share_fn(share)
+        stacked.append(rows)
+    return ids, np.array(stacked, dtype=np.int64)
+
+
 def to_fixed_point(value: float) -> int:
     """
     Convert a floating-point value to fixed-point representation.
@@ -83,6 +126,116 @@ def decrypt_float_list(sk, lst: list[list]) -> list[float]:
     return [from_fixed_point(nilql.decrypt(sk, l)) for l in lst]
 
 
+def to_fixed_point_array(values) -> np.ndarray:
+    """
+    Convert an array of floating-point values to fixed-point representation.
+
+    Produces the same integers as applying `to_fixed_point` element-wise.
+
+    Args:
+        values (array-like): Values to convert
+
+    Returns:
+        np.ndarray: int64 array with PRECISION decimal places
+    """
+    return np.rint(np.asarray(values, dtype=np.float64) * SCALING_FACTOR).astype(
+        np.int64
+    )
+
+
+def _check_additive_key(sk) -> int:
+    """
+    Check that `sk` is a multi-node summation key without threshold or masks, i.e. the
+    key for which nilql uses plain additive secret sharing, and return its node count.
+    """
+    num_nodes = len(sk["cluster"]["nodes"])
+    if (
+        not sk["operations"].get("sum")
+        or num_nodes < 2
+        or "threshold" in sk
+        or "material" in sk
+    ):
+        raise ValueError(
+            "vectorized secret sharing requires a multi-node 'sum' cluster key "
+            "without threshold"
+        )
+    return num_nodes
+
+
+def _random_shares(shape: tuple) -> np.ndarray:
+    """
+    Sample uniformly random values in [0, SHARE_MODULUS) from the OS CSPRNG.
+    """
+    size = int(np.prod(shape, dtype=np.int64))
+    samples = np.empty(size, dtype=np.uint64)
+    missing = np.arange(size)
+    while missing.size:
+        candidates = np.frombuffer(
+            secrets.token_bytes(8 * missing.size), dtype=np.uint64
+        )
+        accepted = candidates < _SAMPLE_LIMIT
+        samples[missing[accepted]] = candidates[accepted] % SHARE_MODULUS
+        missing = missing[~accepted]
+    return samples.astype(np.int64).reshape(shape)
+
+
+def encrypt_float_array(sk, values) -> np.ndarray:
+    """
+    Encrypt a whole array of floats using additive secret sharing in one pass.
+
+    This is the vectorized counterpart of `encrypt_float_list`: shares are uniformly
+    random modulo SHARE_MODULUS and sum to the fixed-point plaintext, exactly as with
+    `nilql.encrypt` on a `sum` cluster key, so each `result[..., :]` can be decrypted
+    with `nilql.decrypt`.
+
+    Args:
+        sk: Summation cluster key for encryption
+        values (array-like): Float values of any shape, e.g. (n_docs, dim)
+
+    Returns:
+        np.ndarray: int64 array of shape `values.shape + (n_nodes,)` with the shares of
+            each value along the last axis
+    """
+    num_nodes = _check_additive_key(sk)
+    plaintext = to_fixed_point_array(values)
+    if plaintext.size and (
+        plaintext.min() < -(2**31) or plaintext.max() >= (2**31) - 1
+    ):
+        raise ValueError("fixed-point values are outside the signed 32-bit range")
+    shares = np.empty(plaintext.shape + (num_nodes,), dtype=np.int64)
+    shares[..., :-1] = _random_shares(plaintext.shape + (num_nodes - 1,))
+    shares[..., -1] = np.mod(plaintext - shares[..., :-1].sum(axis=-1), SHARE_MODULUS)
+    return shares
+
+
+def decrypt_float_array(sk, shares, axis: int = -1) -> np.ndarray:
+    """
+    Reconstruct a whole array of additive shares to floats in one pass.
+
+    This is the vectorized counterpart of `decrypt_float_list`, and also accepts shares
+    that were combined by the nodes (e.g. differences of shares).
+
+    Args:
+        sk: Summation cluster key used for encryption
+        shares (array-like): Integer shares with the node shares along `axis`
+        axis (int, optional): Axis holding the shares of each node. Defaults to -1.
+
+    Returns:
+        np.ndarray: Float array with `axis` removed
+    """
+    num_nodes = _check_additive_key(sk)
+    shares = np.asarray(shares, dtype=np.int64)
+    if shares.shape[axis] != num_nodes:
+        raise ValueError(
+            f"expected {num_nodes} shares per value, got {shares.shape[axis]}"
+        )
+    # Reduce each share first so that the sum cannot overflow int64
+    plaintext = np.mod(np.mod(shares, SHARE_MODULUS).sum(axis=axis), SHARE_MODULUS)
+    # Field elements in the upper half of the field represent negative integers
+    plaintext = np.where(plaintext > (2**31) - 1, plaintext - SHARE_MODULUS, plaintext)
+    return plaintext / SCALING_FACTOR
+
+
 def encrypt_string_list(sk, lst: list) -> list:
     """
     Encrypt a list of strings using a secret key.
@@ -109,3 +262,35 @@ def decrypt_string_list(sk, lst: list) -> list:
         list: List of decrypted strings
     """
     return [nilql.decrypt(sk, l) for l in lst]
+
+
+def generate_rag_keys(num_nodes: int) -> tuple:
+    """
+    Generate the keys used to secret share RAG data among `num_nodes` nodes.
+
+    Returns:
+        tuple: (summation-compatible key for the embeddings, storage key for the chunks)
+    """
+    additive_key = nilql.ClusterKey.generate({"nodes": [{}] * num_nodes}, {"sum": True})
+    xor_key = nilql.ClusterKey.generate({"nodes": [{}] * num_nodes}, {"store": True})
+    return additive_key, xor_key
+
+
+def encrypt_rag_batch(additive_key, xor_key, chunks: list, embeddings) -> tuple:
+    """
+    Encrypt a batch of chunks and their embeddings for upload.
+
+    Defined at module level so that it can run in a process pool.
+
+    Args:
+        additive_key: Summation-compatible key for the embeddings
+        xor_key: Storage key for the chunks
+        chunks (list): List of chunk strings
+        embeddings: Embeddings of the chunks, of shape (n_chunks, dim)
+
+    Returns:
+        tuple: (embedding shares of shape (n_chunks, dim, n_nodes), chunk shares)
+    """
+    return encrypt_float_array(additive_key, embeddings), encrypt_string_list(
+        xor_key, chunks
+    )
@@ -1,26 +1,88 @@
+# pylint: disable=too-many-lines
 """
 Test suite containing functional unit tests of exported functions.
 """
 
+import asyncio
+import collections
+import contextlib
+import glob
+import importlib.util
+import io
 import json
 import os
+import tempfile
+import threading
 import time
 import unittest
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+from unittest import mock
 
+import jwt
 import nilql
 import numpy as np
 from dotenv import load_dotenv
 
+from nilrag.nildb.centroid_cache import CentroidCache, CentroidMatrix
 from nilrag.nildb.org_config import ORG_CONFIG
-from nilrag.rag_vault import RAGVault, find_closest_chunks
-from nilrag.utils.process import (create_chunks,
-                                  generate_embeddings_huggingface, load_file)
-from nilrag.utils.transform import decrypt_float_list, encrypt_float_list
+from nilrag.nildb.token_cache import TokenCache
+from nilrag.nildb.transport import NodeRequestError
+from nilrag.rag_vault import (ChatCompletionConfig, RAGVault,
+                              euclidean_distance, find_closest_chunks,
+                              top_k_indices)
+from nilrag.utils.batching import AdaptiveBatcher
+from nilrag.utils.embedding_backends import (EMBEDDING_BACKENDS,
+                                             register_backend)
+from nilrag.utils.embedding_cache import EmbeddingCache
+from nilrag.utils.journal import IngestJournal, ingest_fingerprint
+from nilrag.utils.manifest import SyncManifest
+from nilrag.utils.model_registry import ModelRegistry
+from nilrag.utils.offload import CPUOffload
+from nilrag.utils.pipeline import (END, batched, iterate_queue, run_graph,
+                                   run_stages)
+from nilrag.utils.process import (chunk_token_stats, cluster_embeddings,
+                                  cluster_embeddings_minibatch,
+                                  cluster_spreads, create_chunks,
+                                  create_token_chunks, expand_sources,
+                                  generate_chunk_ids,
+                                  generate_embeddings_huggingface,
+                                  get_tokenizer, iter_chunks, iter_paragraphs,
+                                  load_and_chunk_file, load_file)
+from nilrag.utils.ranking import (AdaptiveProbing, assign_clusters,
+                                  compute_closest_centroids, measure_drift,
+                                  probe_closest_centroids,
+                                  select_closest_centroids)
+from nilrag.utils.transform import (SCALING_FACTOR, SHARE_MODULUS,
+                                    decrypt_float_array, decrypt_float_list,
+                                    encrypt_float_array, encrypt_float_list,
+                                    encrypt_rag_batch, stack_shares_by_id,
+                                    to_fixed_point)
 
 DEFAULT_PROMPT = "Who is Michelle Ross?"
 RUN_OPTIONAL_TESTS = False
+# The ONNX backends need the `onnx` extra (onnxruntime and optimum)
+HAS_ONNX = all(
+    importlib.util.find_spec(module) is not None
+    for module in ("onnxruntime", "optimum", "torch")
+)
+
+# Nodes of the vaults whose node calls are stubbed in the tests
+OFFLINE_NODES = [
+    {"url": f"http://node-{node_idx}", "did": f"did:nil:node{node_idx}"}
+    for node_idx in range(3)
+]
+
+
+async def create_offline_vault(**kwargs) -> RAGVault:
+    """Create a vault on OFFLINE_NODES; tests stub the node calls they make."""
+    return await RAGVault.create(
+        OFFLINE_NODES,
+        {"secret_key": "11" * 32, "org_did": "did:nil:org"},
+        schema_id="rag",
+        cpu_workers=0,
+        **kwargs,
+    )
 
 
 @dataclass
@@ -278,6 +340,148 @@ class TestRAGMethods(unittest.IsolatedAsyncioTestCase):
             # Assertions
             self.check_top_results(top_results, case.expected_results)
 
+    def test_top_k_indices(self):
+        """
+        Test that partial top-k selection matches a full sort.
+        """
+        distances = np.random.default_rng(2).random(1000)
+        for k in (0, 1, 7, 999, 1000, 2000):
+            np.testing.assert_array_equal(
+                top_k_indices(distances, k), np.argsort(distances)[:k]
+            )
+
+    def test_load_and_chunk_files(self):
+        """
+        Test that directory and glob sources expand to the text files below them, and
+        that files are chunked as by load_file and create_chunks.
+        """
+        paths = expand_sources("examples/data")
+        self.assertEqual(paths, sorted(glob.glob("examples/data/*.txt")))
+        self.assertEqual(
+            expand_sources(["examples/data/c*.txt", paths[0]])[0], paths[0]
+        )
+        with self.assertRaises(FileNotFoundError):
+            expand_sources("examples/data/*.missing")
+
+        chunks, doc_ids = load_and_chunk_file(paths[0], chunk_size=50, overlap=10)
+        self.assertEqual(chunks, create_chunks(load_file(paths[0]), 50, 10))
+        self.assertEqual(doc_ids, generate_chunk_ids(chunks, paths[0]))
+
+    def test_create_token_chunks(self):
+        """
+        Test that token chunks fit the encoder, overlap, and keep every word in order.
+        """
+        tokenizer, max_tokens = get_tokenizer()
+        paragraphs = load_file("examples/data/cities.txt")
+        chunks = create_token_chunks(paragraphs, tokenizer, max_tokens, overlap=8)
+        stats = chunk_token_stats(chunks, tokenizer, max_tokens)
+        self.assertEqual(stats["chunks"], len(chunks))
+        self.assertEqual(stats["truncated"], 0)
+
+        small = create_token_chunks(paragraphs[:1], tokenizer, 16, overlap=4)
+        self.assertEqual(chunk_token_stats(small, tokenizer, 16)["truncated"], 0)
+        self.assertGreater(len(small), 1)
+        # Dropping the words each chunk repeats from the previous one gives the paragraph
+        words = small[0].split()
+        repeated = 0
+        for previous, chunk in zip(small, small[1:]):
+            previous_words, chunk_words = previous.split(), chunk.split()
+            shared = max(
+                k
+                for k in range(len(chunk_words))
+                if k == 0 or previous_words[-k:] == chunk_words[:k]
+            )
+            repeated += shared
+            words += chunk_words[shared:]
+        self.assertEqual(words, paragraphs[0].split())
+        self.assertGreater(repeated, 0)
+        with self.assertRaises(ValueError):
+            create_token_chunks(paragraphs, tokenizer, 16, overlap=16)
+
+    def test_token_chunks_advance_past_long_words(self):
+        """
+        Test that a word too long to follow the overlap does not make chunks that only
+        repeat words of the previous chunk.
+        """
+
+        def tokenizer(text, **_kwargs):
+            # One token per character
+            return {
+                "offset_mapping": [
+                    (idx, idx + 1)
+                    for idx, char in enumerate(text)
+                    if not char.isspace()
+                ]
+            }
+
+        paragraph = "a b c ddddddddd e f g"
+        chunks = create_token_chunks([paragraph], tokenizer, 10, overlap=8)
+        self.assertEqual(chunks, ["a b c", "ddddddddd e", "e f g"])
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertFalse(set(chunk.split()) <= set(previous.split()))
+
+    @unittest.skipUnless(HAS_ONNX, "onnxruntime and optimum are not installed.")
+    def test_rag_plaintext_onnx_int8(self):
+        """
+        Test that the int8 ONNX backend gives embeddings close to the PyTorch ones and
+        retrieves the same top results.
+        """
+        for case in self.test_cases:
+            chunks = create_chunks(
+                load_file(case.file_path),
+                chunk_size=self.chunk_size,
+                overlap=self.overlap,
+            )
+            torch_embeddings = generate_embeddings_huggingface(chunks)
+            embeddings = generate_embeddings_huggingface(chunks, backend="onnx-int8")
+            cosine = np.sum(torch_embeddings * embeddings, axis=1) / (
+                np.linalg.norm(torch_embeddings, axis=1)
+                * np.linalg.norm(embeddings, axis=1)
+            )
+            self.assertGreaterEqual(cosine.min(), 0.99)
+
+            query_embedding = generate_embeddings_huggingface(
+                [case.query], backend="onnx-int8"
+            )[0]
+            top_results = find_closest_chunks(query_embedding, chunks, embeddings)
+            self.assertEqual(
+                [chunk for chunk, _ in top_results],
+                [chunk for chunk, _ in case.expected_results],
+            )
+
+    def test_iter_chunks_matches_create_chunks(self):
+        """
+        Test that the lazy, memory-mapped loading and chunking give the same chunks as
+        load_file and create_chunks, with offsets pointing at the chunk in the file.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            crlf_path = os.path.join(tmp_dir, "crlf.txt")
+            with open(crlf_path, "wb") as f:
+                f.write(
+                    " Café au\r\nlait \r\n\r\n\r\nsecond\rparagraph\r\rthird \n\n".encode()
+                )
+            empty_path = os.path.join(tmp_dir, "empty.txt")
+            open(empty_path, "wb").close()  # pylint: disable=consider-using-with
+
+            for path in [case.file_path for case in self.test_cases] + [
+                crlf_path,
+                empty_path,
+            ]:
+                paragraphs = list(iter_paragraphs(path))
+                self.assertEqual([p.text for p in paragraphs], load_file(path))
+                chunks = list(iter_chunks(paragraphs, chunk_size=3, overlap=1))
+                self.assertEqual(
+                    [chunk.text for chunk in chunks],
+                    create_chunks(load_file(path), chunk_size=3, overlap=1),
+                )
+                with open(path, "rb") as f:
+                    data = f.read()
+                for chunk in chunks:
+                    self.assertEqual(
+                        data[chunk.start : chunk.end].decode().split(),
+                        chunk.text.split(),
+                    )
+
     @unittest.skipUnless(RUN_OPTIONAL_TESTS, "Skipping optional test.")
     async def test_1_top_num_chunks_execute(self):
         """
@@ -305,6 +509,7 @@ class TestRAGMethods(unittest.IsolatedAsyncioTestCase):
         query = DEFAULT_PROMPT
         top_chunks = await rag.top_num_chunks_execute(query, 2)
         end_time = time.time()
+        await rag.aclose()
         print(json.dumps(top_chunks, indent=4))
         print(f"Query took {end_time - start_time:.2f} seconds")
 
@@ -341,11 +546,1325 @@ class TestRAGMethods(unittest.IsolatedAsyncioTestCase):
         query = DEFAULT_PROMPT
         top_chunks = await rag.top_num_chunks_execute(query, 2)
         end_time = time.time()
+        await rag.aclose()
         print(json.dumps(top_chunks, indent=4))
         print(f"Query took {end_time - start_time:.2f} seconds")
 
         print(f"Relevant Context:\n{top_chunks}")
 
 
+class TestModelRegistry(unittest.TestCase):
+    """
+    Test suite for the process-wide embedding model registry.
+    """
+
+    def setUp(self):
+        self.loads = []
+
+        def loader(model_name):
+            self.loads.append(model_name)
+            return object()
+
+        self.loader = loader
+
+    def test_model_loaded_once(self):
+        """
+        Test that repeated and concurrent lookups load a model only once.
+        """
+        registry = ModelRegistry(loader=self.loader)
+        threads = [
+            threading.Thread(target=registry.get, args=("model-a",)) for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIs(registry.get("model-a"), registry.get("model-a"))
+        self.assertEqual(self.loads, ["model-a"])
+
+    def test_lru_eviction(self):
+        """
+        Test that the least recently used model is evicted when the registry is full.
+        """
+        registry = ModelRegistry(max_models=2, loader=self.loader)
+        registry.warmup(["model-a", "model-b"])
+        registry.get("model-a")
+        registry.get("model-c")
+        self.assertIn("model-a", registry)
+        self.assertNotIn("model-b", registry)
+        self.assertIn("model-c", registry)
+        self.assertEqual(len(registry), 2)
+
+    def test_models_keyed_by_backend(self):
+        """
+        Test that a model is loaded once per backend, and that unknown backends fail.
+        """
+        for backend in ("fake-a", "fake-b"):
+            register_backend(
+                backend,
+                lambda model_name, backend=backend: self.loads.append(
+                    (model_name, backend)
+                ),
+            )
+            self.addCleanup(EMBEDDING_BACKENDS.pop, backend)
+        registry = ModelRegistry()
+        registry.get("model-a", "fake-a")
+        registry.get("model-a", "fake-b")
+        registry.get("model-a", "fake-a")
+        self.assertEqual(self.loads, [("model-a", "fake-a"), ("model-a", "fake-b")])
+        self.assertTrue(registry.is_loaded("model-a", "fake-a"))
+        self.assertIn(("model-a", "fake-b"), registry)
+        self.assertNotIn("model-a", registry)
+        registry.evict("model-a", "fake-b")
+        self.assertNotIn(("model-a", "fake-b"), registry)
+        with self.assertRaises(ValueError):
+            registry.get("model-a", "missing")
+
+
+class TestVectorizedSecretSharing(unittest.TestCase):
+    """
+    Test suite for the vectorized (NumPy) additive secret sharing.
+    """
+
+    def test_encrypt_float_array_compatible_with_nilql(self):
+        """
+        Test that shares produced in bulk decrypt with nilql to the fixed-point values.
+        """
+        num_parties = 3
+        additive_key = nilql.ClusterKey.generate(
+            {"nodes": [{}] * num_parties}, {"sum": True}
+        )
+        values = np.random.default_rng(0).normal(size=(4, 16)).astype(np.float32)
+
+        shares = encrypt_float_array(additive_key, values)
+
+        self.assertEqual(shares.shape, (4, 16, num_parties))
+        self.assertTrue(((shares >= 0) & (shares < SHARE_MODULUS)).all())
+        for doc, doc_shares in zip(values, shares):
+            self.assertEqual(
+                [nilql.decrypt(additive_key, share.tolist()) for share in doc_shares],
+                [to_fixed_point(value) for value in doc],
+            )
+        np.testing.assert_allclose(
+            decrypt_float_list(additive_key, shares[0].tolist()), values[0], atol=1e-7
+        )
+
+    # pylint: disable=too-many-locals
+    def test_decrypt_difference_shares(self):
+        """
+        Test that distances reconstructed from stacked node responses match the
+        per-value nilql reconstruction.
+        """
+        num_parties = 3
+        additive_key = nilql.ClusterKey.generate(
+            {"nodes": [{}] * num_parties}, {"sum": True}
+        )
+        rng = np.random.default_rng(1)
+        embeddings = rng.normal(size=(5, 8))
+        query = rng.normal(size=8)
+        ids = [f"doc-{i}" for i in range(len(embeddings))]
+        embedding_shares = encrypt_float_array(additive_key, embeddings)
+        query_shares = encrypt_float_array(additive_key, query)
+
+        # Each node subtracts its query share from its embedding shares, and nodes may
+        # return the documents in any order
+        node_results = [
+            [
+                {
+                    "_id": ids[doc],
+                    "difference": (
+                        embedding_shares[doc, :, party] - query_shares[:, party]
+                    ).tolist(),
+                }
+                for doc in rng.permutation(len(ids))
+            ]
+            for party in range(num_parties)
+        ]
+
+        stacked_ids, shares = stack_shares_by_id(
+            node_results, lambda share: share["difference"]
+        )
+        distances = np.linalg.norm(
+            decrypt_float_array(additive_key, shares, axis=0), axis=-1
+        )
+
+        self.assertEqual(shares.shape, (num_parties, len(ids), 8))
+        for share_id, distance in zip(stacked_ids, distances):
+            doc = ids.index(share_id)
+            differences = zip(
+                *[
+                    next(r["difference"] for r in result if r["_id"] == share_id)
+                    for result in node_results
+                ]
+            )
+            expected = np.linalg.norm(
+                decrypt_float_list(additive_key, [list(d) for d in differences])
+            )
+            self.assertAlmostEqual(distance, expected, places=9)
+            self.assertAlmostEqual(
+                distance, np.linalg.norm(embeddings[doc] - query), places=5
+            )
+
+    def test_encrypt_float_array_rejects_threshold_keys(self):
+        """
+        Test that keys that do not use plain additive sharing are rejected.
+        """
+        threshold_key = nilql.ClusterKey.generate(
+            {"nodes": [{}] * 3}, {"sum": True}, threshold=2
+        )
+        with self.assertRaises(ValueError):
+            encrypt_float_array(threshold_key, np.zeros((1, 4)))
+
+
+class TestTokenCache(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the expiry-aware node token cache.
+    """
+
+    async def test_token_reuse_and_refresh(self):
+        """
+        Test that tokens are reused, refreshed in the background near expiry, and
+        regenerated once they are about to expire.
+        """
+        now = [1000.0]
+        signed = []
+
+        async def generate():
+            token = jwt.encode(
+                {"exp": int(now[0]) + 60, "n": len(signed)}, "secret", algorithm="HS256"
+            )
+            signed.append(token)
+            return token
+
+        cache = TokenCache(refresh_margin=15, min_validity=5, clock=lambda: now[0])
+        first = await cache.get("did:node", generate)
+        self.assertEqual(await cache.get("did:node", generate), first)
+        self.assertEqual(len(signed), 1)
+
+        # Within the refresh margin: the current token is served and refreshed
+        now[0] += 50
+        self.assertEqual(await cache.get("did:node", generate), first)
+        await asyncio.sleep(0)
+        self.assertEqual(len(signed), 2)
+        self.assertEqual(await cache.get("did:node", generate), signed[1])
+
+        # Too close to expiry: a new token is signed before returning
+        now[0] += 57
+        self.assertEqual(await cache.get("did:node", generate), signed[2])
+        self.assertEqual(cache.stats()["misses"], 2)
+        self.assertEqual(cache.stats()["background_refreshes"], 1)
+        self.assertAlmostEqual(cache.hit_rate, 3 / 5)
+
+
+class TestCentroidCache(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the centroid cache and the nearest-centroid search.
+    """
+
+    async def test_centroid_reuse_refresh_and_invalidation(self):
+        """
+        Test that concurrent lookups share one read, that centroids are refreshed in the
+        background near expiry, and that invalidation forces a new read.
+        """
+        now = [0.0]
+        reads = []
+
+        async def load():
+            reads.append(now[0])
+            await asyncio.sleep(0)
+            return CentroidMatrix.from_fixed_point([[len(reads) * 2**16, 0]])
+
+        cache = CentroidCache(ttl=60, refresh_margin=10, clock=lambda: now[0])
+        first, second = await asyncio.gather(cache.get(load), cache.get(load))
+        self.assertIs(first, second)
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(first.matrix.dtype, np.float32)
+
+        # Within the refresh margin: the cached centroids are served and refreshed
+        now[0] += 55
+        self.assertIs(await cache.get(load), first)
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(reads), 2)
+        self.assertEqual(cache.version, 2)
+
+        cache.invalidate()
+        await cache.get(load)
+        self.assertEqual(len(reads), 3)
+        # Both concurrent lookups missed, though they shared one read
+        self.assertEqual(cache.stats()["misses"], 3)
+        self.assertEqual(cache.stats()["background_refreshes"], 1)
+
+    async def test_version_tracks_spreads_and_hierarchy(self):
+        """
+        Test that the version changes when only the spreads or the parents of the
+        clusters change, and not when the same clusters are read again.
+        """
+        records = [
+            {"cluster_centroid": [0, 0], "index": 0, "level": 0},
+            {"cluster_centroid": [2**16, 0], "index": 1, "level": 0},
+            {"cluster_centroid": [0, 2**16], "index": 2, "parent": 0, "spread": 1},
+            {"cluster_centroid": [2**16, 2**16], "index": 3, "parent": 1, "spread": 1},
+        ]
+
+        async def load():
+            return CentroidMatrix.from_records(records)
+
+        now = [0.0]
+        cache = CentroidCache(ttl=60, refresh_margin=10, clock=lambda: now[0])
+        versions = []
+        for change in [{}, {}, {"spread": 2}, {"parent": 0}]:
+            # The cached centroids expired
+            now[0] += 100
+            records[3].update(change)
+            await cache.get(load)
+            versions.append(cache.version)
+        self.assertEqual(versions, [1, 1, 2, 3])
+
+    def test_compute_closest_centroids(self):
+        """
+        Test that the vectorized search ranks centroids like the Euclidean distance.
+        """
+        rng = np.random.default_rng(0)
+        centroids = [
+            [to_fixed_point(x) for x in row] for row in rng.normal(size=(50, 8))
+        ]
+        query = rng.normal(size=8)
+        expected = sorted(
+            range(len(centroids)),
+            key=lambda i: euclidean_distance(
+                query, np.array(centroids[i]) / SCALING_FACTOR
+            ),
+        )[:3]
+        self.assertEqual(compute_closest_centroids(query, centroids, 3), expected)
+        matrix = CentroidMatrix.from_fixed_point(centroids)
+        self.assertEqual(compute_closest_centroids(query, matrix, 3), expected)
+
+    def test_adaptive_probing(self):
+        """
+        Test that a query deep inside a cluster probes it alone, and that a query on
+        the border of clusters probes them until they hold enough candidates.
+        """
+        centroids = CentroidMatrix.from_fixed_point(
+            [[to_fixed_point(x) for x in row] for row in [[0, 0], [4, 0], [0, 9]]],
+            sizes=[5, 50, 50],
+        )
+        probing = AdaptiveProbing(max_distance_ratio=1.5, candidates_per_chunk=10)
+        self.assertEqual(probe_closest_centroids([0.1, 0], centroids, probing, 1), [0])
+        self.assertEqual(
+            probe_closest_centroids([1.9, 0], centroids, probing, 1), [0, 1]
+        )
+        # The closest cluster alone holds enough candidates
+        probing.candidates_per_chunk = 5
+        self.assertEqual(probe_closest_centroids([1.9, 0], centroids, probing, 1), [0])
+        # Without sizes, only the distance ratio applies
+        self.assertEqual(
+            probe_closest_centroids(
+                [1.9, 0], centroids._replace(sizes=None), probing, 1
+            ),
+            [0, 1],
+        )
+
+    def test_two_level_index(self):
+        """
+        Test that a two-level index only ranks the fine clusters of the closest coarse
+        cluster, while fine clusters of another coarse cluster may be closer.
+        """
+        records = [
+            {"index": 0, "level": 0, "cluster_centroid": [to_fixed_point(0)] * 2},
+            {
+                "index": 1,
+                "level": 0,
+                "cluster_centroid": [to_fixed_point(10), to_fixed_point(0)],
+            },
+        ]
+        for index, (centroid, parent) in enumerate(
+            [([-1, 0], 0), ([1, 1], 0), ([6, 0], 1), ([14, 0], 1)]
+        ):
+            records.append(
+                {
+                    "index": index,
+                    "level": 1,
+                    "parent": parent,
+                    "cluster_centroid": [to_fixed_point(x) for x in centroid],
+                }
+            )
+        centroids = CentroidMatrix.from_records(records)
+        self.assertEqual(centroids.matrix.shape, (4, 2))
+        self.assertEqual(centroids.parents.tolist(), [0, 0, 1, 1])
+        # [4, 0] is closest to fine cluster 2, but to coarse cluster 0
+        self.assertEqual(
+            select_closest_centroids([4, 0], centroids, 2, num_coarse_clusters=1),
+            (4, [1, 0]),
+        )
+        self.assertEqual(
+            select_closest_centroids([4, 0], centroids, 1, num_coarse_clusters=2),
+            (4, [2]),
+        )
+
+
+class TestClustering(unittest.TestCase):
+    """
+    Test suite for the clustering of embeddings at ingest.
+    """
+
+    def test_minibatch_clustering(self):
+        """
+        Test that mini-batch K-Means, streamed or trained on a sample, finds the clusters
+        K-Means finds on well-separated embeddings.
+        """
+        rng = np.random.default_rng(0)
+        centers = np.array([[0, 0, 5], [5, 0, 0], [0, 5, 0]], dtype=np.float32)
+        truth = rng.integers(0, 3, 2000)
+        embeddings = centers[truth] + 0.1 * rng.normal(size=(2000, 3))
+
+        expected_labels, expected_centroids = cluster_embeddings(embeddings, 3)
+        for sample_size in [None, 300]:
+            labels, centroids = cluster_embeddings_minibatch(
+                embeddings, 3, batch_size=128, sample_size=sample_size
+            )
+            self.assertEqual(len(labels), len(embeddings))
+            # Same partition, up to the numbering of the clusters
+            mapping = dict(zip(labels.tolist(), expected_labels.tolist()))
+            self.assertEqual(len(set(mapping.values())), 3)
+            self.assertTrue(
+                np.array_equal([mapping[label] for label in labels], expected_labels)
+            )
+            self.assertIsInstance(centroids[0][0], int)
+            np.testing.assert_allclose(
+                [centroids[label] for label in mapping],
+                [expected_centroids[label] for label in mapping.values()],
+                atol=0.05 * SCALING_FACTOR,
+            )
+
+    def test_assign_clusters_and_drift(self):
+        """
+        Test that new embeddings are assigned to their closest centroid, and that the
+        drift compares their distances with the spreads of the clusters.
+        """
+        embeddings = np.array([[0, 0.1], [0, -0.1], [4, 0.2], [4, -0.2]])
+        labels = np.array([0, 0, 1, 1])
+        centroids = [[0, 0], [to_fixed_point(4), 0]]
+        spreads = cluster_spreads(embeddings, labels, centroids)
+        self.assertEqual(spreads, [to_fixed_point(0.01), to_fixed_point(0.04)])
+
+        matrix = CentroidMatrix.from_fixed_point(centroids)._replace(
+            spreads=np.array([0.01, 0.04])
+        )
+        new_labels, squared_distances = assign_clusters([[0.1, 0], [3.8, 0]], matrix)
+        self.assertEqual(new_labels.tolist(), [0, 1])
+        np.testing.assert_allclose(squared_distances, [0.01, 0.04], atol=1e-6)
+        drift = measure_drift(new_labels, squared_distances, matrix)
+        self.assertAlmostEqual(drift.ratio, 1.0, places=4)
+        self.assertFalse(drift.needs_reclustering())
+
+        new_labels, squared_distances = assign_clusters([[1, 0]], matrix)
+        self.assertTrue(
+            measure_drift(new_labels, squared_distances, matrix).needs_reclustering()
+        )
+        # Without spreads, the drift is unknown
+        drift = measure_drift(
+            new_labels, squared_distances, matrix._replace(spreads=None)
+        )
+        self.assertIsNone(drift.ratio)
+        self.assertFalse(drift.needs_reclustering())
+
+
+class TestAdaptiveBatcher(unittest.TestCase):
+    """
+    Test suite for the byte-size-aware adaptive upload batcher.
+    """
+
+    def test_batches_follow_byte_budget(self):
+        """
+        Test that batches fill the byte budget, shrink after a rejected payload, and
+        grow back on fast successes without exceeding the rejected size.
+        """
+        doc_sizes = [100] * 50
+        batcher = AdaptiveBatcher(target_bytes=1000, min_bytes=100)
+        self.assertEqual(batcher.next_batch(doc_sizes, 0), 10)
+        # A single document larger than the budget still makes a batch
+        self.assertEqual(batcher.next_batch([5000, 100], 0), 1)
+
+        self.assertTrue(batcher.should_split(NodeRequestError("too large", 413)))
+        self.assertTrue(batcher.should_split(asyncio.TimeoutError()))
+        self.assertFalse(batcher.should_split(NodeRequestError("error", 500)))
+
+        batcher.record_failure(1000, NodeRequestError("too large", 413))
+        self.assertEqual(batcher.next_batch(doc_sizes, 10), 15)
+        for _ in range(5):
+            batcher.record_success(latency=0.1)
+        self.assertEqual(batcher.budget, 999)
+        # Slow batches shrink the budget
+        batcher.record_success(latency=60.0)
+        self.assertLess(batcher.budget, 999)
+        self.assertEqual(batcher.sizes, [10, 1, 5])
+
+
+class TestIngestJournal(unittest.TestCase):
+    """
+    Test suite for resumable ingestion: deterministic ids and the ingest journal.
+    """
+
+    def test_generate_chunk_ids(self):
+        """
+        Test that chunk ids only depend on the source and the position of the chunk.
+        """
+        chunks = ["alpha", "beta", "alpha"]
+        ids = generate_chunk_ids(chunks, "a.txt")
+        self.assertEqual(ids, generate_chunk_ids(chunks, "a.txt"))
+        self.assertEqual(len(set(ids)), 3)
+        self.assertNotEqual(ids, generate_chunk_ids(chunks, "b.txt"))
+        # Editing one chunk keeps every id
+        self.assertEqual(ids, generate_chunk_ids(["alpha", "gamma", "alpha"], "a.txt"))
+
+    def test_resume_from_journal(self):
+        """
+        Test that committed ranges survive a restart, including a truncated last line,
+        and that a journal cannot be resumed by a different ingest.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "ingest.jsonl")
+            journal = IngestJournal(path, "fingerprint", num_nodes=2)
+            journal.record(0, 0, 10)
+            journal.record(0, 10, 20)
+            journal.record(1, 0, 10)
+            journal.mark_done("centroids")
+            journal.close()
+            with open(path, "a", encoding="utf-8") as f:
+                f.write('{"node": 1, "sta')
+
+            journal = IngestJournal(path, "fingerprint", num_nodes=2)
+            self.assertTrue(journal.is_committed(0, 5, 20))
+            self.assertEqual(journal.pending_nodes(0, 10), [])
+            self.assertEqual(journal.pending_nodes(10, 20), [1])
+            self.assertEqual(journal.pending_nodes(15, 25), [0, 1])
+            self.assertTrue(journal.is_done("centroids"))
+            # Only the documents a node did not commit are pending
+            journal.record(1, 12, 15)
+            self.assertEqual(journal.pending_ranges(1, 5, 20), [[10, 12], [15, 20]])
+            self.assertEqual(journal.pending_ranges(0, 15, 25), [[20, 25]])
+            journal.record(1, 10, 20)
+            journal.close()
+            journal = IngestJournal(path, "fingerprint", num_nodes=2)
+            self.assertEqual(journal.pending_nodes(10, 20), [])
+            journal.close()
+
+            with self.assertRaises(ValueError):
+                IngestJournal(path, "other fingerprint", num_nodes=2)
+
+
+class TestWriteRAGData(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the upload of documents, with the node writes stubbed.
+    """
+
+    async def asyncSetUp(self):
+        self.rag = await create_offline_vault()
+        self.embedding_shares = np.zeros((10, 4, len(OFFLINE_NODES)), dtype=np.int64)
+        self.chunk_shares = [["share"] * len(OFFLINE_NODES) for _ in range(10)]
+        self.doc_ids = generate_chunk_ids([f"chunk {i}" for i in range(10)], "a.txt")
+        # Ids written to each node, in order
+        self.written = {node["url"]: [] for node in OFFLINE_NODES}
+
+        async def write_data_to_node(node, node_data, _schema_id):
+            await asyncio.sleep(0)
+            self.written[node["url"]] += [record["_id"] for record in node_data]
+            return {"node": node["url"], "result": {}}
+
+        self.rag.write_data_to_node = write_data_to_node
+
+    async def asyncTearDown(self):
+        await self.rag.aclose()
+
+    async def test_resume_uploads_uncommitted_ranges(self):
+        """
+        Test that resuming from a journal only sends each node the documents it did not
+        commit, also when a batch was only partly committed.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "ingest.jsonl")
+            journal = IngestJournal(
+                path,
+                ingest_fingerprint(
+                    "rag", [node["url"] for node in OFFLINE_NODES], self.doc_ids
+                ),
+                len(OFFLINE_NODES),
+            )
+            # Node 0 stored the first half of a split batch, node 1 everything
+            journal.record(0, 0, 5)
+            journal.record(1, 0, 10)
+            journal.record(2, 2, 4)
+            journal.record(2, 6, 10)
+            journal.close()
+
+            await self.rag.write_rag_data(
+                self.embedding_shares,
+                self.chunk_shares,
+                batch_size=10,
+                doc_ids=self.doc_ids,
+                journal_path=path,
+            )
+        self.assertEqual(
+            self.written,
+            {
+                "http://node-0": self.doc_ids[5:10],
+                "http://node-1": [],
+                "http://node-2": self.doc_ids[0:2] + self.doc_ids[4:6],
+            },
+        )
+
+    async def test_max_in_flight(self):
+        """
+        Test that at most `max_in_flight` batches are uploaded at once, that batches
+        finishing out of order are reported in order, and that a failed batch does not
+        stop the others and is the only one reported in the error.
+        """
+        doc_indices = {doc_id: idx for idx, doc_id in enumerate(self.doc_ids)}
+        # Number of node writes in flight for each batch, by first document
+        writes_in_flight = collections.Counter()
+        peak = 0
+
+        async def write_data_to_node(node, node_data, _schema_id):
+            nonlocal peak
+            batch_start = doc_indices[node_data[0]["_id"]]
+            writes_in_flight[batch_start] += 1
+            peak = max(peak, len(+writes_in_flight))
+            try:
+                # Later batches finish first
+                await asyncio.sleep(0.01 * (10 - batch_start))
+                if batch_start == 4:
+                    raise ValueError("node unavailable")
+                return {"node": node["url"], "result": {}}
+            finally:
+                writes_in_flight[batch_start] -= 1
+
+        self.rag.write_data_to_node = write_data_to_node
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with self.assertRaises(ValueError) as context:
+                await self.rag.write_rag_data(
+                    self.embedding_shares,
+                    self.chunk_shares,
+                    batch_size=2,
+                    max_in_flight=2,
+                    doc_ids=self.doc_ids,
+                    max_retries=0,
+                )
+
+        self.assertEqual(peak, 2)
+        reported = [
+            line
+            for line in output.getvalue().splitlines()
+            if line.startswith(("Successfully uploaded batch", "Error uploading batch"))
+        ]
+        self.assertEqual(
+            [line.split(":")[0] for line in reported],
+            [
+                "Successfully uploaded batch 1",
+                "Successfully uploaded batch 2",
+                "Error uploading batch 3",
+                "Successfully uploaded batch 4",
+                "Successfully uploaded batch 5",
+            ],
+        )
+        self.assertRegex(
+            str(context.exception),
+            r"^Failed to upload 1 of 5 batches: batch 3 \(documents 4 to 6\): "
+            r".*node unavailable",
+        )
+
+    async def test_oversized_document_fails_without_retries(self):
+        """
+        Test that a single document a node rejects as too large fails at once instead
+        of being retried.
+        """
+        attempts = collections.Counter()
+
+        async def write_data_to_node(node, node_data, _schema_id):
+            attempts[node_data[0]["_id"]] += 1
+            if node_data[0]["_id"] == self.doc_ids[1]:
+                raise NodeRequestError("too large", 413)
+            return {"node": node["url"], "result": {}}
+
+        self.rag.write_data_to_node = write_data_to_node
+        for target_batch_bytes in (None, 1):
+            attempts.clear()
+            with mock.patch("nilrag.nildb.operations.RETRY_BACKOFF", 0):
+                with self.assertRaisesRegex(ValueError, "batch 2 "):
+                    await self.rag.write_rag_data(
+                        self.embedding_shares[:2],
+                        self.chunk_shares[:2],
+                        batch_size=1,
+                        target_batch_bytes=target_batch_bytes,
+                        doc_ids=self.doc_ids[:2],
+                    )
+            self.assertEqual(attempts[self.doc_ids[1]], len(OFFLINE_NODES))
+
+
+class TestAppendRAGData(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for appending documents to a two-level index, with the node calls
+    stubbed.
+    """
+
+    # Fine clusters 0 and 1 belong to coarse cluster 0, fine cluster 2 to coarse cluster 1
+    FINE_CENTROIDS = [[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0]]
+    PARENTS = [0, 0, 1]
+    COARSE_CENTROIDS = [[0.5, 0.5, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0]]
+    EMBEDDINGS = [
+        [0.9, 0.1, 0.0, 0.0],
+        [1.0, 0.0, 0.1, 0.0],
+        [0.0, 0.1, 0.9, 0.0],
+        [0.1, 0.8, 0.0, 0.1],
+    ]
+
+    async def asyncSetUp(self):
+        self.rag = await create_offline_vault(clusters_schema_id="clusters")
+
+        def record(record_id, centroid, index, size, **fields):
+            return {
+                "_id": record_id,
+                "cluster_centroid": [to_fixed_point(value) for value in centroid],
+                "index": index,
+                "size": size,
+                **fields,
+            }
+
+        clusters_data = [
+            record(f"fine-{idx}", centroid, idx, size, level=1, parent=parent)
+            for idx, (centroid, size, parent) in enumerate(
+                zip(self.FINE_CENTROIDS, [10, 20, 5], self.PARENTS)
+            )
+        ] + [
+            record(
+                f"coarse-{idx}", centroid, len(self.FINE_CENTROIDS) + idx, size, level=0
+            )
+            for idx, (centroid, size) in enumerate(zip(self.COARSE_CENTROIDS, [30, 5]))
+        ]
+        # Records written to each node, and fields set on each cluster record
+        self.written = {node["url"]: [] for node in OFFLINE_NODES}
+        self.updates = []
+
+        async def get_clusters_data():
+            return clusters_data
+
+        async def write_data_to_node(node, node_data, schema_id):
+            self.assertEqual(schema_id, "rag")
+            self.written[node["url"]] += node_data
+            return {"node": node["url"], "result": {}}
+
+        async def generate_node_token(_node_did):
+            return "token"
+
+        async def make_request(node_url, endpoint, _token, payload):
+            self.assertEqual((endpoint, payload["schema"]), ("data/update", "clusters"))
+            self.updates.append(
+                (node_url, payload["filter"]["_id"], payload["update"]["$set"])
+            )
+            return {}
+
+        self.rag.get_clusters_data = get_clusters_data
+        self.rag.write_data_to_node = write_data_to_node
+        self.rag.generate_node_token = generate_node_token
+        self.rag.make_request = make_request
+        self.rag.write_centroids_data = mock.AsyncMock()
+
+    async def asyncTearDown(self):
+        await self.rag.aclose()
+
+    async def append(self, **kwargs):
+        """Append EMBEDDINGS, whose shares are not read by the stubbed nodes."""
+        num_docs = len(self.EMBEDDINGS)
+        return await self.rag.append_rag_data(
+            np.array(self.EMBEDDINGS, dtype=np.float32),
+            np.zeros((num_docs, 4, len(OFFLINE_NODES)), dtype=np.int64),
+            [["share"] * len(OFFLINE_NODES) for _ in range(num_docs)],
+            **kwargs,
+        )
+
+    async def test_append_tags_documents_and_updates_sizes_once(self):
+        """
+        Test that appended documents are tagged with their fine and coarse clusters,
+        that the centroids are not written again, and that resuming the append from its
+        journal adds the documents to the cluster sizes only once.
+        """
+        doc_ids = generate_chunk_ids([f"chunk {i}" for i in range(4)], "a.txt")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "append.jsonl")
+            drift = await self.append(doc_ids=doc_ids, journal_path=path)
+            await self.append(doc_ids=doc_ids, journal_path=path)
+
+        self.assertEqual(drift.num_documents, 4)
+        for records in self.written.values():
+            self.assertEqual([record["_id"] for record in records], doc_ids)
+            self.assertEqual(
+                [
+                    (record["cluster_centroid"], record["coarse_centroid"])
+                    for record in records
+                ],
+                [(0, 0), (0, 0), (2, 1), (1, 0)],
+            )
+        self.rag.write_centroids_data.assert_not_called()
+        expected = {
+            "fine-0": {"size": 12},
+            "fine-1": {"size": 21},
+            "fine-2": {"size": 6},
+            "coarse-0": {"size": 33},
+            "coarse-1": {"size": 6},
+        }
+        self.assertCountEqual(
+            self.updates,
+            [
+                (node["url"], record_id, fields)
+                for record_id, fields in expected.items()
+                for node in OFFLINE_NODES
+            ],
+        )
+
+    async def test_append_without_size_updates(self):
+        """
+        Test that the sizes are left alone with `update_sizes=False`.
+        """
+        await self.append(update_sizes=False)
+
+        self.assertEqual(
+            [len(records) for records in self.written.values()],
+            [4] * len(OFFLINE_NODES),
+        )
+        self.assertEqual(self.updates, [])
+
+
+class TestBatchQuery(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the batch query, with the embedding model and node queries stubbed
+    by nodes holding real secret shares.
+    """
+
+    # Documents 0-3 are in cluster 0 and 4-7 in cluster 1, but document 3 lies closer
+    # to the queries of cluster 1 than document 6
+    EMBEDDINGS = [
+        [1.0, 0.0, 0.0, 0.0],
+        [0.9, 0.1, 0.0, 0.0],
+        [0.8, 0.0, 0.2, 0.0],
+        [0.2, 0.75, 0.0, 0.0],
+        [0.0, 1.0, 0.0, 0.0],
+        [0.1, 0.9, 0.1, 0.0],
+        [0.0, 0.6, 0.4, 0.0],
+        [0.0, 0.5, 0.0, 0.5],
+    ]
+    LABELS = [0, 0, 0, 0, 1, 1, 1, 1]
+    CENTROIDS = [[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0]]
+    QUERIES = {
+        "first": [1.0, 0.0, 0.0, 0.0],
+        "second": [0.1, 0.9, 0.0, 0.0],
+        "third": [0.85, 0.0, 0.15, 0.0],
+    }
+
+    async def asyncSetUp(self):
+        self.rag = await create_offline_vault(
+            subtract_query_id="subtract", batch_subtract_query_id="batch-subtract"
+        )
+        additive_key, xor_key = self.rag.query_keys
+        chunks = [f"chunk {i}" for i in range(len(self.EMBEDDINGS))]
+        embedding_shares, chunk_shares = encrypt_rag_batch(
+            additive_key, xor_key, chunks, np.array(self.EMBEDDINGS)
+        )
+        rng = np.random.default_rng(5)
+        # Records of each node, in a different order on each node
+        self.records = [
+            [
+                {
+                    "_id": f"doc-{doc}",
+                    "embedding": embedding_shares[doc, :, node],
+                    "chunk": chunk_shares[doc][node],
+                    "cluster_centroid": self.LABELS[doc],
+                }
+                for doc in rng.permutation(len(chunks))
+            ]
+            for node in range(len(OFFLINE_NODES))
+        ]
+        self.centroids = None
+        self.reads = []
+        self.closest = []
+
+        def subtract(node_records, closest_centroids, query_shares):
+            return [
+                (
+                    record,
+                    [
+                        np.mod(record["embedding"] - np.asarray(share), SHARE_MODULUS)
+                        for share in query_shares
+                    ],
+                )
+                for record in node_records
+                if closest_centroids is None
+                or record["cluster_centroid"] in closest_centroids
+            ]
+
+        async def execute_subtract_query_on_nodes(query_shares, closest_centroids):
+            query_shares = np.asarray(query_shares)
+            return [
+                [
+                    {"_id": record["_id"], "difference": differences[0].tolist()}
+                    for record, differences in subtract(
+                        node_records, closest_centroids, [query_shares[:, node]]
+                    )
+                ]
+                for node, node_records in enumerate(self.records)
+            ]
+
+        async def execute_batch_subtract_query_on_nodes(
+            query_shares, closest_centroids
+        ):
+            self.closest.append(closest_centroids)
+            return [
+                [
+                    {
+                        "_id": record["_id"],
+                        **(
+                            {"cluster_centroid": record["cluster_centroid"]}
+                            if closest_centroids is not None
+                            else {}
+                        ),
+                        "differences": [share.tolist() for share in differences],
+                    }
+                    for record, differences in subtract(
+                        node_records, closest_centroids, query_shares[..., node]
+                    )
+                ]
+                for node, node_records in enumerate(self.records)
+            ]
+
+        async def read_chunk_from_nodes(chunk_ids):
+            self.reads.append(chunk_ids)
+            return [
+                {
+                    "shares": [
+                        {"_id": record["_id"], "chunk": record["chunk"]}
+                        for record in node_records
+                        if record["_id"] in chunk_ids
+                    ]
+                }
+                for node_records in self.records
+            ]
+
+        async def get_centroid_matrix():
+            return self.centroids
+
+        self.rag.execute_subtract_query_on_nodes = execute_subtract_query_on_nodes
+        self.rag.execute_batch_subtract_query_on_nodes = (
+            execute_batch_subtract_query_on_nodes
+        )
+        self.rag.read_chunk_from_nodes = read_chunk_from_nodes
+        self.rag.get_centroid_matrix = get_centroid_matrix
+
+    async def asyncTearDown(self):
+        await self.rag.aclose()
+
+    def embed(self, queries, **_kwargs):
+        """Return the embedding of a query, or of each query of a list."""
+        if isinstance(queries, str):
+            return np.array(self.QUERIES[queries])
+        return np.array([self.QUERIES[query] for query in queries])
+
+    async def retrieve(self) -> Tuple[List[str], List[str]]:
+        """Return the contexts of the queries, from the batch and one at a time."""
+        queries = list(self.QUERIES)
+        with mock.patch(
+            "nilrag.rag_vault.generate_embeddings_huggingface", side_effect=self.embed
+        ):
+            batch = await self.rag.top_num_chunks_execute_batch(queries, 3)
+            self.assertEqual(len(self.reads), 1)
+            single = [
+                await self.rag.top_num_chunks_execute(query, 3) for query in queries
+            ]
+        return batch, single
+
+    @staticmethod
+    def context(docs: List[int]) -> str:
+        """Format the relevant context of chunks of the given documents."""
+        lines = "\n".join(f"- chunk {doc}" for doc in docs)
+        return f"\n\nRelevant Context:\n{lines}"
+
+    async def test_batch_matches_single_queries(self):
+        """
+        Test that without clustering, each query of a batch returns the context of the
+        query run alone, and that the top chunks of all queries are read once.
+        """
+        batch, single = await self.retrieve()
+
+        self.assertEqual(batch, single)
+        self.assertEqual(
+            batch,
+            [self.context([0, 1, 2]), self.context([5, 4, 3]), self.context([2, 1, 0])],
+        )
+        self.assertEqual(self.closest, [None])
+        self.assertEqual(self.reads[0], [f"doc-{doc}" for doc in [0, 1, 2, 5, 4, 3]])
+
+    async def test_batch_filters_clusters_per_query(self):
+        """
+        Test that with clustering, the batch asks the nodes for the union of the closest
+        clusters but ranks each query only among the documents of its own clusters.
+        """
+        self.centroids = CentroidMatrix.from_fixed_point(
+            [
+                [to_fixed_point(value) for value in centroid]
+                for centroid in self.CENTROIDS
+            ]
+        )
+
+        batch, single = await self.retrieve()
+
+        self.assertEqual(batch, single)
+        # Document 3 is closer to the second query, but not in its cluster
+        self.assertEqual(
+            batch,
+            [self.context([0, 1, 2]), self.context([5, 4, 6]), self.context([2, 1, 0])],
+        )
+        self.assertEqual(self.closest, [[0, 1]])
+        self.assertEqual(self.reads[0], [f"doc-{doc}" for doc in [0, 1, 2, 5, 4, 6]])
+
+
+class TestProcessRAGData(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the preparation of documents, with the embedding model stubbed.
+    """
+
+    async def asyncSetUp(self):
+        self.rag = await create_offline_vault()
+
+    async def asyncTearDown(self):
+        await self.rag.aclose()
+
+    async def test_tokenizer_only_loaded_for_token_stats(self):
+        """
+        Test that word chunking does not load the tokenizer (and so the model), unless
+        the token statistics are requested.
+        """
+
+        def embed_chunks(chunks, **_kwargs):
+            return np.zeros((len(chunks), 4))
+
+        def tokenizer(chunks, **_kwargs):
+            return {"input_ids": [chunk.split() for chunk in chunks]}
+
+        get_tokenizer_mock = mock.Mock(return_value=(tokenizer, 256))
+        with mock.patch("nilrag.rag_vault.embed_chunks", side_effect=embed_chunks):
+            with mock.patch("nilrag.rag_vault.get_tokenizer", get_tokenizer_mock):
+                _, embeddings_shares, chunks_shares = await self.rag.process_rag_data(
+                    "examples/data/cities.txt"
+                )
+                get_tokenizer_mock.assert_not_called()
+                self.assertEqual(len(embeddings_shares), len(chunks_shares))
+
+                await self.rag.process_rag_data(
+                    "examples/data/cities.txt", report_token_stats=True
+                )
+                get_tokenizer_mock.assert_called_once()
+
+
+class TestNilAIChatCompletion(unittest.TestCase):
+    """
+    Test suite for the nilAI chat completion request, with the HTTP session stubbed.
+    """
+
+    def setUp(self):
+        self.rag = asyncio.run(create_offline_vault(subtract_query_id="subtract"))
+        response = mock.MagicMock(status=200)
+        response.json = mock.AsyncMock(return_value={"choices": []})
+        self.session = mock.MagicMock()
+        self.session.post.return_value.__aenter__.return_value = response
+        self.rag.get_session = mock.AsyncMock(return_value=self.session)
+        self.config = ChatCompletionConfig(
+            nilai_url="http://nilai", token="token", messages=[]
+        )
+
+    def tearDown(self):
+        asyncio.run(self.rag.aclose())
+
+    def test_blocking_call_and_optional_batch_query(self):
+        """
+        Test that the blocking call returns the response outside of an event loop, and
+        that the batch subtract query id is only sent when set.
+        """
+        self.assertEqual(self.rag.nilai_chat_completion(self.config), {"choices": []})
+        self.rag.batch_subtract_query_id = "batch-subtract"
+        asyncio.run(self.rag.nilai_chat_completion_async(self.config))
+
+        payloads = [call.kwargs["json"] for call in self.session.post.call_args_list]
+        self.assertNotIn("batch_subtract_query_id", payloads[0]["nilrag"])
+        self.assertEqual(payloads[0]["nilrag"]["subtract_query_id"], "subtract")
+        self.assertEqual(
+            payloads[1]["nilrag"]["batch_subtract_query_id"], "batch-subtract"
+        )
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    """
+    Test suite for the persistent embedding cache.
+    """
+
+    def test_persistence_and_lru_eviction(self):
+        """
+        Test that embeddings are kept per model across instances, and that the least
+        recently used entries are evicted once the cache is full.
+        """
+        vectors = np.random.default_rng(3).random((4, 8), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = EmbeddingCache(tmp_dir, max_entries=3)
+            cache.put("model-a", ["a", "b", "c"], vectors[:3])
+            self.assertEqual(cache.get("model-b", ["a"]), [None])
+            cache.get("model-a", ["a"])
+            cache.save()
+
+            cache = EmbeddingCache(tmp_dir, max_entries=3)
+            np.testing.assert_array_equal(cache.get("model-a", ["b"])[0], vectors[1])
+            # "c" is the least recently used entry
+            cache.put("model-a", ["d"], vectors[3:])
+            found = cache.get("model-a", ["a", "b", "c", "d"])
+            self.assertIsNone(found[2])
+            np.testing.assert_array_equal(found[0], vectors[0])
+            np.testing.assert_array_equal(found[3], vectors[3])
+            self.assertEqual(len(cache), 3)
+            self.assertEqual((cache.hits, cache.misses), (4, 1))
+
+            with self.assertRaises(ValueError):
+                EmbeddingCache(tmp_dir, max_entries=10).get("model-a", ["a"])
+
+    def test_store_grows_with_entries(self):
+        """
+        Test that a store file starts small and grows as entries are added, keeping the
+        entries it already holds.
+        """
+        vectors = np.random.default_rng(5).random((1500, 8), dtype=np.float32)
+        texts = [f"chunk {i}" for i in range(len(vectors))]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = EmbeddingCache(tmp_dir, max_entries=3000)
+            cache.put("model-a", texts[:10], vectors[:10])
+            (path,) = glob.glob(os.path.join(tmp_dir, "*.emb"))
+            record_size = 32 + 8 * 4
+            self.assertEqual(os.path.getsize(path), 1024 * record_size)
+
+            cache.put("model-a", texts[10:], vectors[10:])
+            cache.save()
+            self.assertEqual(os.path.getsize(path), 2048 * record_size)
+
+            found = EmbeddingCache(tmp_dir, max_entries=3000).get("model-a", texts)
+            np.testing.assert_array_equal(np.array(found), vectors)
+
+    def test_interrupted_write_leaves_no_stale_vector(self):
+        """
+        Test that a put interrupted before the vector of a new entry is written leaves
+        neither that key nor the evicted entry in the file.
+        """
+        vectors = np.random.default_rng(4).random((4, 8), dtype=np.float32)
+        write = np.ndarray.__setitem__
+
+        def interrupted_write(array, index, value):
+            if np.asarray(value).dtype == np.float32:
+                raise RuntimeError("interrupted")
+            write(array, index, value)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = EmbeddingCache(tmp_dir, max_entries=3)
+            cache.put("model-a", ["a", "b", "c"], vectors[:3])
+            cache.get("model-a", ["a", "b"])
+            with mock.patch.object(np.memmap, "__setitem__", interrupted_write):
+                with self.assertRaises(RuntimeError):
+                    cache.put("model-a", ["d"], vectors[3:])
+
+            found = EmbeddingCache(tmp_dir, max_entries=3).get(
+                "model-a", ["a", "b", "c", "d"]
+            )
+            self.assertEqual(
+                [vector is None for vector in found], [False, False, True, True]
+            )
+
+
+class TestSyncManifest(unittest.TestCase):
+    """
+    Test suite for the manifest of incremental corpus syncs.
+    """
+
+    def test_diff_and_persistence(self):
+        """
+        Test that the manifest tells additions, changes and removals apart, survives a
+        restart and cannot be used with another schema.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "manifest.json")
+            manifest = SyncManifest(path, "schema")
+            self.assertEqual(manifest.diff({"a": "1"}).added, ["a"])
+            manifest.documents = {"a": "1", "b": "2", "c": "3"}
+            manifest.pending = ["d"]
+            manifest.save()
+
+            manifest = SyncManifest(path, "schema")
+            self.assertEqual(manifest.pending, ["d"])
+            diff = manifest.diff({"a": "1", "b": "changed", "d": "4"})
+            self.assertEqual(diff.added, ["d"])
+            self.assertEqual(diff.changed, ["b"])
+            self.assertEqual(diff.removed, ["c"])
+            self.assertEqual(diff.unchanged, 1)
+
+            with self.assertRaises(ValueError):
+                SyncManifest(path, "other schema")
+
+
+class TestSyncRAGData(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the incremental sync of a corpus, with the embedding model and node
+    calls stubbed.
+    """
+
+    async def asyncSetUp(self):
+        self.rag = await create_offline_vault()
+        # Ids written to the first node and deleted, in order
+        self.written = []
+        self.deleted = []
+
+        async def write_data_to_node(node, node_data, _schema_id):
+            if node["url"] == OFFLINE_NODES[0]["url"]:
+                self.written += [record["_id"] for record in node_data]
+            return {"node": node["url"], "result": {}}
+
+        async def delete_rag_data(doc_ids, **_kwargs):
+            self.deleted += doc_ids
+
+        self.rag.write_data_to_node = write_data_to_node
+        self.rag.delete_rag_data = delete_rag_data
+
+    async def asyncTearDown(self):
+        await self.rag.aclose()
+
+    async def test_edited_chunk_is_replaced(self):
+        """
+        Test that editing one chunk of a synced file replaces exactly that document,
+        without adding or removing any other.
+        """
+
+        def embed_chunks(chunks, **_kwargs):
+            return np.zeros((len(chunks), 4))
+
+        words = [f"word{i}" for i in range(20)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "corpus.txt")
+            manifest_path = os.path.join(tmp_dir, "manifest.json")
+
+            async def sync(text: str) -> Dict[str, int]:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(text)
+                return await self.rag.sync_rag_data(
+                    path, manifest_path, chunk_size=5, overlap=0, max_workers=1
+                )
+
+            with mock.patch("nilrag.ingest.embed_chunks", side_effect=embed_chunks):
+                first = await sync(" ".join(words))
+                ids = list(self.written)
+                self.written.clear()
+                words[7] = "edited"
+                second = await sync(" ".join(words))
+
+        self.assertEqual(
+            first, {"added": 4, "changed": 0, "removed": 0, "unchanged": 0}
+        )
+        self.assertEqual(
+            second, {"added": 0, "changed": 1, "removed": 0, "unchanged": 3}
+        )
+        # The old version of the second chunk is deleted before it is uploaded again
+        self.assertEqual(self.deleted, [ids[1]])
+        self.assertEqual(self.written, [ids[1]])
+
+
+class TestPipeline(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the streaming pipeline helpers.
+    """
+
+    async def test_stages_with_bounded_queue(self):
+        """
+        Test that stages hand batches over a bounded queue to several consumers, and that
+        a failing stage cancels the stages blocked on a queue.
+        """
+        self.assertEqual(list(batched(range(5), 2)), [[0, 1], [2, 3], [4]])
+        queue = asyncio.Queue(maxsize=1)
+        consumed = []
+
+        async def produce():
+            for batch in batched(range(10), 3):
+                await queue.put(batch)
+            await queue.put(END)
+
+        async def consume():
+            async for batch in iterate_queue(queue):
+                consumed.extend(batch)
+
+        await run_stages(produce(), consume(), consume())
+        self.assertEqual(sorted(consumed), list(range(10)))
+
+        async def fail():
+            raise RuntimeError("stage failed")
+
+        blocked = asyncio.Queue(maxsize=1)
+        with self.assertRaises(RuntimeError):
+            await asyncio.wait_for(run_stages(fail(), blocked.get()), timeout=5)
+
+    async def test_graph_overlaps_independent_stages(self):
+        """
+        Test that independent stages of a dependency graph run concurrently, that each
+        stage gets the results of its dependencies, and that unknown dependencies fail.
+        """
+
+        async def delayed(value):
+            await asyncio.sleep(0.2)
+            return value
+
+        start_time = time.perf_counter()
+        results, timings = await run_graph(
+            {
+                "a": (lambda: delayed(1), ()),
+                "b": (lambda: delayed(2), ()),
+                "sum": (lambda a, b: a + b, ("a", "b")),
+            }
+        )
+        self.assertLess(time.perf_counter() - start_time, 0.35)
+        self.assertEqual(results, {"a": 1, "b": 2, "sum": 3})
+        self.assertEqual(list(timings), ["a", "b", "sum"])
+        self.assertGreaterEqual(timings["a"], 0.15)
+
+        with self.assertRaises(ValueError):
+            await run_graph({"sum": (lambda a: a, ("a",)), "a": (lambda: 1, ())})
+
+
+class TestCPUOffload(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the offloading of CPU-bound work to a worker pool.
+    """
+
+    async def test_run_cpu_in_pool_or_inline(self):
+        """
+        Test that functions run in the worker pool, or on the event loop with
+        cpu_workers=0, and that the pool is re-created after a shutdown.
+        """
+        offload = CPUOffload()
+        offload.configure_cpu_pool("thread", 2)
+        thread_name = await offload.run_cpu(lambda: threading.current_thread().name)
+        self.assertTrue(thread_name.startswith("nilrag-cpu"))
+        self.assertEqual(await offload.run_cpu(sum, [1, 2], start=3), 6)
+        offload.shutdown_cpu_pool()
+        self.assertEqual(await offload.run_cpu(max, 1, 2), 2)
+        offload.shutdown_cpu_pool()
+
+        offload.configure_cpu_pool("thread", 0)
+        self.assertIsNone(offload.get_cpu_executor())
+        thread_name = await offload.run_cpu(lambda: threading.current_thread().name)
+        self.assertEqual(thread_name, threading.current_thread().name)
+
+        with self.assertRaises(ValueError):
+            offload.configure_cpu_pool("gpu")
+        with self.assertRaises(ValueError):
+            offload.configure_cpu_pool("thread", -1)
+
+
 if __name__ == "__main__":
     unittest.main()